@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import collections
+import logging
+import wave
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+ENVELOPE_RATE = 100 # envelope samples per second
+WAV_CHUNK_FRAMES = 1048576
+# Correlation values this close to the peak belong to the peak itself
+# when judging how distinct it is.
+PEAK_EXCLUSION = 1.0 # seconds
+
+Alignment = collections.namedtuple('Alignment', 'offset confidence')
+
+
+class Error(Exception):
+  """Base level error."""
+
+class OperationError(Error):
+  """Operation Error."""
+
+
+def _require_numpy():
+  if numpy is None:
+    raise OperationError('Offset detection requires numpy')
+
+
+def _decode_frames(data, width, channels):
+  """Decode little-endian PCM frames to a mono float32 array."""
+  if width == 1:
+    samples = numpy.frombuffer(data, numpy.uint8).astype(numpy.float32) - 128
+  elif width == 2:
+    samples = numpy.frombuffer(data, '<i2').astype(numpy.float32)
+  elif width == 3:
+    raw = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3)
+    raw = raw.astype(numpy.int32)
+    samples = (raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)) << 8
+    samples = samples.astype(numpy.float32)
+  elif width == 4:
+    samples = numpy.frombuffer(data, '<i4').astype(numpy.float32)
+  else:
+    raise OperationError('Unsupported sample width: %d' % width)
+  if channels > 1:
+    samples = samples.reshape(-1, channels).sum(axis=1)
+  return samples
+
+
+def wav_envelope(path, envelope_rate=ENVELOPE_RATE):
+  """Return the energy envelope of a WAV file.
+
+  The file is read in chunks of WAV_CHUNK_FRAMES frames, so memory use
+  is bounded by the size of the envelope rather than of the file.
+
+  Args:
+    path: path of a PCM WAV file
+    envelope_rate: envelope samples per second
+
+  Returns:
+    numpy array - summed signal power of each 1/envelope_rate seconds
+  """
+  _require_numpy()
+  try:
+    wav = wave.open(path, 'rb')
+  except (IOError, EOFError, wave.Error), e:
+    raise OperationError('%s: %s' % (path, e))
+  try:
+    channels = wav.getnchannels()
+    width = wav.getsampwidth()
+    rate = wav.getframerate()
+    envelope = numpy.zeros(wav.getnframes() * envelope_rate // rate + 1)
+    # Fast path: every envelope bin spans a whole number of frames
+    hop = rate // envelope_rate if rate % envelope_rate == 0 else None
+    chunk_frames = WAV_CHUNK_FRAMES
+    if hop:
+      chunk_frames -= chunk_frames % hop
+    position = 0
+    while True:
+      data = wav.readframes(chunk_frames)
+      if not data:
+        break
+      power = numpy.square(_decode_frames(data, width, channels))
+      if hop and position % hop == 0 and len(power) % hop == 0:
+        energy = power.reshape(-1, hop).sum(axis=1)
+        first = position // hop
+      else:
+        bins = numpy.arange(position, position + len(power),
+                            dtype=numpy.int64) * envelope_rate // rate
+        first = bins[0]
+        energy = numpy.bincount(bins - first, weights=power)
+      envelope[first:first + len(energy)] += energy[:len(envelope) - first]
+      position += len(power)
+  except (IOError, EOFError, wave.Error), e:
+    raise OperationError('%s: %s' % (path, e))
+  finally:
+    wav.close()
+  return envelope
+
+
+def _onset_strength(envelope):
+  """Reduce an energy envelope to a zero-mean, unit-variance onset signal."""
+  onsets = numpy.diff(numpy.log1p(envelope))
+  onsets -= onsets.mean()
+  deviation = onsets.std()
+  if deviation > 0:
+    onsets /= deviation
+  return onsets
+
+
+def envelope_offset(video_envelope, riff_envelope, envelope_rate=ENVELOPE_RATE,
+                    max_offset=None):
+  """Estimate the offset between two energy envelopes.
+
+  Args:
+    video_envelope, riff_envelope: envelopes as returned by wav_envelope
+    envelope_rate: envelope samples per second
+    max_offset: if given, only consider offsets up to this many
+      milliseconds either way
+
+  Returns:
+    Alignment - offset is the riff position minus the video position in
+      milliseconds, as used by RiffPlayerFrame.SetOffset; confidence is in
+      [0, 1], where 0 means a competing offset correlates equally well
+  """
+  _require_numpy()
+  video = _onset_strength(numpy.asarray(video_envelope, numpy.float64))
+  riff = _onset_strength(numpy.asarray(riff_envelope, numpy.float64))
+  if not len(video) or not len(riff):
+    raise OperationError('Signals too short to align')
+  size = 1
+  while size < len(video) + len(riff) - 1:
+    size *= 2
+  # correlation[lag] = sum(video[t] * riff[t + lag]), negative lags wrap
+  correlation = numpy.fft.irfft(
+    numpy.conj(numpy.fft.rfft(video, size)) * numpy.fft.rfft(riff, size), size)
+  lags = numpy.arange(size)
+  lags[lags >= size // 2] -= size
+  valid = (lags > -len(video)) & (lags < len(riff))
+  if max_offset is not None:
+    valid &= numpy.abs(lags) <= max_offset * envelope_rate / 1000.0
+  correlation[~valid] = -numpy.inf
+  peak = int(numpy.argmax(correlation))
+  peak_value = correlation[peak]
+  lag = float(lags[peak])
+  # Refine the lag to a fraction of an envelope sample with a parabola
+  # through the peak and its neighbours.
+  before = correlation[peak - 1]
+  after = correlation[(peak + 1) % size]
+  curvature = before - 2 * peak_value + after
+  if numpy.isfinite(curvature) and curvature < 0:
+    lag += 0.5 * (before - after) / curvature
+  exclusion = int(PEAK_EXCLUSION * envelope_rate)
+  distance = numpy.abs(lags - lags[peak])
+  rivals = correlation[valid & (distance > exclusion)]
+  confidence = 1.0
+  if len(rivals) and peak_value > 0:
+    confidence = max(0.0, 1.0 - max(rivals.max(), 0) / peak_value)
+  elif peak_value <= 0:
+    confidence = 0.0
+  offset = lag * 1000.0 / envelope_rate
+  logging.debug('Estimated offset %.1f ms, confidence %.2f', offset,
+                confidence)
+  return Alignment(offset, confidence)
+
+
+def estimate_offset(video_wav, riff_wav, envelope_rate=ENVELOPE_RATE,
+                    max_offset=None):
+  """Estimate the riff offset from the audio of a video and a riff.
+
+  Args:
+    video_wav: path of a WAV file holding the audio track of the video
+    riff_wav: path of the riff decoded to WAV
+    envelope_rate: envelope samples per second; the estimate is refined
+      to a fraction of 1/envelope_rate seconds
+    max_offset: if given, only consider offsets up to this many
+      milliseconds either way
+
+  Returns:
+    Alignment - see envelope_offset
+  """
+  return envelope_offset(wav_envelope(video_wav, envelope_rate),
+                         wav_envelope(riff_wav, envelope_rate),
+                         envelope_rate, max_offset)
@@ -27,17 +27,64 @@ OTHER DEALINGS IN THE SOFTWARE.
 __author__ = 'Jon Allie (jon@jonallie.com)'
 
 
+import binascii
+import collections
+import contextlib
+import csv
 import hashlib
 import httplib
+import itertools
+import json
 import logging
+import mmap
 import os
+import Queue
+import re
+import socket
 import sqlite3
+import sys
+import threading
+import time
 import urllib
-import urllib2
+import urlparse
+
+import metrics_lib
+import sync_lib
 
 DEFAULT_DB_FILE = 'riffdb.sqlite'
 DEFAULT_REMOTE_URL = 'http://www.openriff.com/db'
+HTTP_POOL_SIZE = 4
+HTTP_CONNECT_TIMEOUT = 5.0 # seconds
+HTTP_READ_TIMEOUT = 10.0 # seconds
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.25 # seconds, doubled after every attempt
+PROBE_TIMEOUT = 2.0 # seconds
+BATCH_SIZE = 400 # pairs per batched query or request
+CACHE_POSITIVE_TTL = 604800 # a week, in seconds
+CACHE_NEGATIVE_TTL = 300 # 5 minutes, in seconds
+OUTBOX_RETRY_BACKOFF = 1.0 # seconds, doubled after every failed attempt
+OUTBOX_MAX_BACKOFF = 600.0 # seconds
+OUTBOX_MAX_ATTEMPTS = 10
+SQLITE_BUSY_TIMEOUT = 10.0 # seconds to wait for a locked database
+SYNC_MAP_OFFSET_TOLERANCE = 0.001 # ms within which an offset matches a map
+OFFSET_CACHE_SIZE = 1024 # offsets kept in memory per database
+HASH_MEMORY_CACHE_SIZE = 4096 # file hashes kept in memory per hash cache
 HASH_SAMPLE_SIZE = 26214400 # 25 megs
+HASH_CHUNK_SIZE = 262144 # 256k
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 65536 # 64k
+
+# Field names of offsets in import/export files, matching the remote protocol
+OFFSET_FIELDS = ('video_hash', 'audio_hash', 'offset')
+OFFSET_FORMATS = ('csv', 'jsonl')
+
+# Hash algorithm tags. Keys produced by the legacy algorithm are plain
+# hex digests; keys of any other algorithm are prefixed with its tag.
+LEGACY_HASH = 'md5'
+SPARSE_HASH = 'sparse1'
+# The md5 of a file read in text mode, as calculated by Windows builds
+# before hashes were read in binary. Its keys are plain hex digests too.
+LEGACY_TEXT_HASH = 'md5text'
 
 class Error(Exception):
   """Base level error."""
@@ -45,111 +92,1285 @@ class Error(Exception):
 class OperationError(Error):
   """Operation Error."""
 
+class HttpStatusError(OperationError):
+  """A remote request completed with a non-200 HTTP status."""
+
+  def __init__(self, status, message):
+    OperationError.__init__(self, message)
+    self.status = status
+
+
+def _update_hash_chunked(hash_val, handle, length):
+  """Feed up to length bytes of handle to hash_val through a reused buffer."""
+  buf = bytearray(HASH_CHUNK_SIZE)
+  view = memoryview(buf)
+  while length > 0:
+    count = handle.readinto(view[:min(length, HASH_CHUNK_SIZE)])
+    if not count:
+      break
+    hash_val.update(view[:count])
+    length -= count
+
+
+def _update_hash_mmap(hash_val, handle, length):
+  """Feed up to length bytes of handle to hash_val from a memory map."""
+  length = min(length, os.fstat(handle.fileno()).st_size)
+  if not length:
+    return
+  mapped = mmap.mmap(handle.fileno(), length, access=mmap.ACCESS_READ)
+  try:
+    for start in xrange(0, length, HASH_CHUNK_SIZE):
+      hash_val.update(mapped[start:start + HASH_CHUNK_SIZE])
+  finally:
+    mapped.close()
+
+
+@metrics_lib.timed_function('db.calculate_hash')
+def calculate_hash(filename, use_mmap=False):
+  """Return the md5 of the first HASH_SAMPLE_SIZE bytes of filename.
+
+  The sample is streamed through the digest HASH_CHUNK_SIZE bytes at a
+  time, so memory use does not grow with the sample size.
+
+  Args:
+    filename: path of the file to hash
+    use_mmap: read the file through a memory map rather than read calls
+
+  Returns:
+    str - hex digest
+  """
+  hash_val = hashlib.md5()
+  try:
+    handle = open(filename, 'rb')
+    try:
+      if use_mmap:
+        _update_hash_mmap(hash_val, handle, HASH_SAMPLE_SIZE)
+      else:
+        _update_hash_chunked(hash_val, handle, HASH_SAMPLE_SIZE)
+    finally:
+      handle.close()
+  except (IOError, OSError, TypeError, ValueError, mmap.error), e:
+    raise OperationError(e)
+  return hash_val.hexdigest()
+
+
+def calculate_text_hash(filename):
+  """Return the md5 of the first HASH_SAMPLE_SIZE characters of filename.
 
-def calculate_hash(filename):
+  The file is read in text mode, as calculate_hash once did. On Windows
+  this translates CRLF to LF and stops at the first ^Z, so the digest
+  differs from calculate_hash for most media files; elsewhere the two
+  are identical.
+
+  Returns:
+    str - hex digest
+  """
   hash_val = hashlib.md5()
   try:
-    hash_val.update(open(filename).read(HASH_SAMPLE_SIZE))
+    handle = open(filename)
+    try:
+      length = HASH_SAMPLE_SIZE
+      while length > 0:
+        data = handle.read(min(length, HASH_CHUNK_SIZE))
+        if not data:
+          break
+        hash_val.update(data)
+        length -= len(data)
+    finally:
+      handle.close()
   except (IOError, OSError, TypeError), e:
     raise OperationError(e)
   return hash_val.hexdigest()
 
 
+@metrics_lib.timed_function('db.calculate_fingerprint')
+def calculate_fingerprint(filename):
+  """Return a sparse-sample fingerprint of filename.
+
+  The fingerprint covers the file size and FINGERPRINT_BLOCKS blocks taken
+  from the head, the tail and evenly spaced offsets in between, so the
+  amount of I/O is constant regardless of the size of the file.
+
+  Returns:
+    str - key of the form 'sparse1:<hex digest>'
+  """
+  hash_val = hashlib.sha1()
+  try:
+    handle = open(filename, 'rb')
+    try:
+      size = os.fstat(handle.fileno()).st_size
+      hash_val.update('%d\0' % size)
+      span = size - FINGERPRINT_BLOCK_SIZE
+      if span <= 0:
+        _update_hash_chunked(hash_val, handle, size)
+      else:
+        for i in xrange(FINGERPRINT_BLOCKS):
+          handle.seek(span * i // (FINGERPRINT_BLOCKS - 1))
+          _update_hash_chunked(hash_val, handle, FINGERPRINT_BLOCK_SIZE)
+    finally:
+      handle.close()
+  except (IOError, OSError, TypeError), e:
+    raise OperationError(e)
+  return '%s:%s' % (SPARSE_HASH, hash_val.hexdigest())
+
+
+HASH_FUNCTIONS = {
+  LEGACY_HASH: calculate_hash,
+  LEGACY_TEXT_HASH: calculate_text_hash,
+  SPARSE_HASH: calculate_fingerprint,
+}
+
+# Algorithms of plain hex keys, in order of preference. Keys saved by
+# Windows builds were text mode digests, which are only worth trying
+# there.
+if sys.platform == 'win32':
+  LEGACY_HASHES = (LEGACY_HASH, LEGACY_TEXT_HASH)
+else:
+  LEGACY_HASHES = (LEGACY_HASH,)
+
+
+def offset_format(filename):
+  """Guess the import/export format of filename from its extension."""
+  ext = os.path.splitext(filename)[1].lstrip('.').lower()
+  if ext not in OFFSET_FORMATS:
+    raise OperationError('Unknown offset file format: %s' % filename)
+  return ext
+
+
+def read_offsets(handle, fmt):
+  """Yield (video_hash, audio_hash, offset) triples read from handle.
+
+  Args:
+    handle: file object to read from
+    fmt: 'csv', with a header row naming OFFSET_FIELDS, or 'jsonl', with
+      one object holding OFFSET_FIELDS per line. A jsonl object may also
+      hold a sync_map, a list of [video_ms, riff_ms, rate] breakpoints,
+      which is yielded as a sync_lib.SyncMap in place of the offset.
+  """
+  try:
+    if fmt == 'csv':
+      reader = csv.reader(handle)
+      header = next(reader, None)
+      if header is None:
+        return
+      try:
+        columns = [header.index(field) for field in OFFSET_FIELDS]
+      except ValueError:
+        raise OperationError(
+          'CSV header must name %s' % ', '.join(OFFSET_FIELDS))
+      video_col, audio_col, offset_col = columns
+      for row in reader:
+        yield row[video_col], row[audio_col], float(row[offset_col])
+    else:
+      for line in handle:
+        if line.strip():
+          record = json.loads(line)
+          offset = float(record['offset'])
+          if record.get('sync_map') is not None:
+            offset = sync_lib.SyncMap(
+              [tuple(float(value) for value in point)
+               for point in record['sync_map']])
+          yield str(record['video_hash']), str(record['audio_hash']), offset
+  except (csv.Error, ValueError, KeyError, IndexError, TypeError,
+          sync_lib.SyncMapError), e:
+    raise OperationError('Bad offset record: %s' % e)
+
+
+def write_offsets(triples, handle, fmt):
+  """Write (video_hash, audio_hash, offset) triples to handle.
+
+  An offset may be a sync_lib.SyncMap, which is written as the sync_map
+  of a jsonl record. CSV files only hold plain offsets.
+
+  Returns:
+    int - number of triples written
+  """
+  count = 0
+  if fmt == 'csv':
+    writer = csv.writer(handle)
+    writer.writerow(OFFSET_FIELDS)
+    for triple in triples:
+      if isinstance(triple[2], sync_lib.SyncMap):
+        raise OperationError('CSV files can not hold sync maps')
+      writer.writerow(triple)
+      count += 1
+  else:
+    for video_hash, audio_hash, offset in triples:
+      record = dict(video_hash=video_hash, audio_hash=audio_hash)
+      if isinstance(offset, sync_lib.SyncMap):
+        record['sync_map'] = offset.breakpoints()
+        offset = offset.offset_at(0)
+      record['offset'] = offset
+      handle.write(json.dumps(record) + '\n')
+      count += 1
+  return count
+
+
+def file_identity(filename):
+  """Return the identity of a file as used by the hash cache.
+
+  Returns:
+    tuple - (realpath, size, mtime_ns, inode)
+  """
+  try:
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+  except (IOError, OSError, TypeError), e:
+    raise OperationError(e)
+  return (path, stat.st_size, long(stat.st_mtime * 1000000000), stat.st_ino)
+
+
+class LRUCache(object):
+  """A bounded, thread-safe, least recently used mapping.
+
+  None can not be stored; get returns it for missing keys.
+
+  Attributes:
+    capacity: maximum number of entries
+    hits, misses: lookups which did and did not find an entry
+    evictions: entries dropped to make room for new ones
+  """
+
+  def __init__(self, capacity, name=None):
+    """Create an empty cache.
+
+    Args:
+      capacity: maximum number of entries
+      name: if given, hits, misses and evictions are also counted in
+        metrics_lib as <name>.hits and so on
+    """
+    self.capacity = capacity
+    self.name = name
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    """Return the value of key, or None, and mark it most recently used."""
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+      else:
+        self._entries[key] = value
+        self.hits += 1
+    if self.name:
+      metrics_lib.increment(
+        '%s.%s' % (self.name, 'misses' if value is None else 'hits'))
+    return value
+
+  def put(self, key, value):
+    """Store value under key, evicting the least recently used entries."""
+    evicted = 0
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self.capacity:
+        self._entries.popitem(last=False)
+        evicted += 1
+      self.evictions += evicted
+    if evicted and self.name:
+      metrics_lib.increment('%s.evictions' % self.name, evicted)
+
+  def pop(self, key):
+    """Forget key, if it is cached."""
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+
+# Cached in place of the sync map of pairs which only have an offset
+_NO_SYNC_MAP = object()
+
+
+def _sync_map_key(video_hash, audio_hash):
+  """Return the offset cache key of the sync map of a pair."""
+  return ('sync_map', video_hash, audio_hash)
+
+
+def _offset_cache(size):
+  """Return an offset cache of size entries, or None if size is 0."""
+  if not size:
+    return None
+  return LRUCache(size, 'db.offset_cache')
+
+
+_HEX_DIGEST_RE = re.compile(r'^[0-9a-f]+$')
+# Tag byte of SPARSE_HASH keys stored as blobs
+_SPARSE_KEY_TAG = '\x01'
+
+
+def _encode_key(hash_val):
+  """Return the compact form of a hash key stored in the Offsets table.
+
+  MD5 keys become 16 byte blobs and SPARSE_HASH keys a tag byte plus
+  their 20 byte SHA-1. Any other key is stored as text.
+  """
+  if len(hash_val) == 32 and _HEX_DIGEST_RE.match(hash_val):
+    return sqlite3.Binary(binascii.unhexlify(hash_val))
+  prefix = SPARSE_HASH + ':'
+  if (len(hash_val) == len(prefix) + 40 and hash_val.startswith(prefix)
+      and _HEX_DIGEST_RE.match(hash_val[len(prefix):])):
+    return sqlite3.Binary(
+      _SPARSE_KEY_TAG + binascii.unhexlify(hash_val[len(prefix):]))
+  return hash_val
+
+
+def _decode_key(value):
+  """Return the hash key stored as value by _encode_key."""
+  if not isinstance(value, buffer):
+    return value
+  value = str(value)
+  if len(value) == 16:
+    return binascii.hexlify(value)
+  return '%s:%s' % (SPARSE_HASH, binascii.hexlify(value[1:]))
+
+
+def _is_legacy_key(hash_val):
+  """Return whether hash_val is an untagged key, as the remote uses."""
+  return ':' not in hash_val
+
+
+def _offset_columns(offset):
+  """Return the (Offset, SyncMap) columns storing an offset or SyncMap.
+
+  Constant maps are stored as plain offsets only.
+  """
+  if not isinstance(offset, sync_lib.SyncMap):
+    return offset, None
+  if offset.is_constant():
+    return offset.offset_at(0), None
+  return offset.offset_at(0), sqlite3.Binary(offset.to_bytes())
+
+
+def _load_sync_map(data, video_hash, audio_hash):
+  """Return the SyncMap stored as data, or None if there is none."""
+  if data is None:
+    return None
+  try:
+    return sync_lib.SyncMap.from_bytes(data)
+  except sync_lib.SyncMapError, e:
+    logging.error('Ignoring bad sync map for %s, %s: %s', video_hash,
+                  audio_hash, e)
+    return None
+
+
+class ConnectionManager(object):
+  """Hands out the Sqlite connections of one database.
+
+  All writes go through a single writer connection, one transaction at a
+  time, so writers within the process queue on a lock instead of failing
+  with "database is locked". Given the path of a WAL mode database, each
+  thread reads through a read-only connection of its own, so readers
+  neither wait for each other nor for the writer. Without a path, reads
+  share the writer connection and its lock.
+  """
+
+  def __init__(self, writer, path=None, lock=None,
+               timeout=SQLITE_BUSY_TIMEOUT):
+    """Create a manager.
+
+    Args:
+      writer: open connection to write through
+      path: if given, path of the database to open per-thread readers on
+      lock: lock serializing use of writer, by default a new one
+      timeout: seconds readers wait for locks held by other processes
+    """
+    self.path = path
+    self.timeout = timeout
+    self._writer = writer
+    self._lock = lock or threading.RLock()
+    self._local = threading.local()
+
+  @contextlib.contextmanager
+  def read(self):
+    """Yield a connection to query from the calling thread.
+
+    Raises:
+      OperationError: for Sqlite errors raised by the block
+    """
+    try:
+      if self.path is None:
+        with self._lock:
+          yield self._writer
+        return
+      con = getattr(self._local, 'con', None)
+      if con is None:
+        con = _connect_db(self.path, self.timeout)
+        con.execute('PRAGMA query_only=ON')
+        self._local.con = con
+      yield con
+    except sqlite3.Error, e:
+      raise OperationError(e)
+
+  @contextlib.contextmanager
+  def write(self):
+    """Yield the writer connection, holding the write lock.
+
+    The transaction is committed when the block exits, or rolled back if
+    it raises.
+
+    Raises:
+      OperationError: for Sqlite errors raised by the block or the commit
+    """
+    with self._lock:
+      try:
+        yield self._writer
+        self._writer.commit()
+      except:
+        self._writer.rollback()
+        error = sys.exc_info()[1]
+        if isinstance(error, sqlite3.Error):
+          raise OperationError(error)
+        raise
+
+  def close(self):
+    """Close the writer and the calling thread's reader.
+
+    The readers of other threads are closed as their threads exit.
+    """
+    with self._lock:
+      self._writer.close()
+    con = getattr(self._local, 'con', None)
+    if con is not None:
+      con.close()
+      self._local.con = None
+
+
+class FileHashCache(object):
+  """A persistent cache of file hashes stored in a Sqlite database.
+
+  Entries are keyed on the real path of a file and the hash algorithm,
+  and are only considered valid while the size, modification time and
+  inode of the file are unchanged, so an unmodified file is never read
+  twice. Recently used entries are also kept in memory, so repeated
+  lookups of the same file only cost a stat.
+  """
+
+  _INIT_SQL = """
+  CREATE TABLE IF NOT EXISTS `FileHashes`(
+    `Path` TEXT NOT NULL,
+    `Algorithm` TEXT NOT NULL,
+    `Size` INTEGER NOT NULL,
+    `MtimeNs` INTEGER NOT NULL,
+    `Inode` INTEGER NOT NULL,
+    `Hash` TEXT NOT NULL,
+    PRIMARY KEY(Path, Algorithm));
+  """
+
+  _GET_HASH_SQL = """
+  SELECT Size, MtimeNs, Inode, Hash
+  FROM FileHashes
+  WHERE Path = ? AND Algorithm = ?
+  """
+
+  _PUT_HASH_SQL = """
+  INSERT OR REPLACE INTO FileHashes(Path, Algorithm, Size, MtimeNs, Inode, Hash)
+    VALUES(?, ?, ?, ?, ?, ?)
+  """
+
+  def __init__(self, connections, memory_size=HASH_MEMORY_CACHE_SIZE):
+    """Create the cache table if needed.
+
+    Args:
+      connections: ConnectionManager of the database to store hashes in
+      memory_size: number of hashes also kept in memory
+    """
+    self._connections = connections
+    self._memory = LRUCache(memory_size)
+    self.hits = 0
+    self.misses = 0
+    with self._connections.write() as con:
+      con.executescript(self._INIT_SQL)
+
+  def calculate_hash(self, filename, algorithm=LEGACY_HASH):
+    """Return the hash of filename, reading the file only on a cache miss."""
+    identity = file_identity(filename)
+    hash_val = self.lookup(identity, algorithm)
+    if hash_val is None:
+      # Hash outside the lock so that other files can be hashed in parallel
+      hash_val = HASH_FUNCTIONS[algorithm](identity[0])
+      self.store([(identity, algorithm, hash_val)])
+    return hash_val
+
+  def lookup(self, identity, algorithm):
+    """Return the cached hash of a file, or None if it must be rehashed.
+
+    Args:
+      identity: the file_identity() of the file
+      algorithm: hash algorithm tag
+    """
+    path, size, mtime_ns, inode = identity
+    # identity changes with the file, so stale entries are never matched
+    hash_val = self._memory.get((identity, algorithm))
+    if hash_val is not None:
+      self.hits += 1
+      metrics_lib.increment('db.hash_cache.hits')
+      return hash_val
+    with self._connections.read() as con:
+      row = con.execute(self._GET_HASH_SQL, (path, algorithm)).fetchone()
+    if row and tuple(row[:3]) == (size, mtime_ns, inode):
+      self.hits += 1
+      hash_val = row[3]
+    else:
+      self.misses += 1
+    if hash_val is None:
+      metrics_lib.increment('db.hash_cache.misses')
+      return None
+    metrics_lib.increment('db.hash_cache.hits')
+    self._memory.put((identity, algorithm), hash_val)
+    return hash_val
+
+  def store(self, entries):
+    """Cache (identity, algorithm, hash) entries in one transaction."""
+    with self._connections.write() as con:
+      con.executemany(self._PUT_HASH_SQL, [
+        (identity[0], algorithm) + tuple(identity[1:]) + (hash_val,)
+        for identity, algorithm, hash_val in entries])
+    for identity, algorithm, hash_val in entries:
+      self._memory.put((tuple(identity), algorithm), hash_val)
+
+
 class RiffDatabase(object):
-  """Base class for a database mapping file hashes to offsets."""
+  """Base class for a database mapping file hashes to offsets.
+
+  Offsets are stored under keys of the first of hash_algorithms. Lookups
+  fall back to the remaining algorithms in order, and an offset found
+  under a fallback key is rewritten under the preferred key.
+
+  If offset_cache is set, offsets found or stored through the hashed
+  methods are kept in it and looked up there first, as are sync maps,
+  or the fact that a pair has none beyond its offset. Offsets stored by
+  other processes are not seen until the entry is evicted. The local
+  and remote databases take an offset_cache_size argument, where 0
+  disables the cache.
+  """
+
+  hash_cache = None
+  offset_cache = None
+  hash_algorithms = (SPARSE_HASH,) + LEGACY_HASHES
+
+  def calculate_hash(self, filename, algorithm=None):
+    """Hash filename, consulting the hash cache if one is configured.
+
+    Args:
+      filename: path of the file to hash
+      algorithm: hash algorithm tag, defaults to the preferred algorithm
+    """
+    algorithm = algorithm or self.hash_algorithms[0]
+    if self.hash_cache is None:
+      return HASH_FUNCTIONS[algorithm](filename)
+    return self.hash_cache.calculate_hash(filename, algorithm)
   
   def add_offset(self, video_file, audio_file, offset):
-    video_hash = calculate_hash(video_file)
+    video_hash = self.calculate_hash(video_file)
     logging.debug('Video hash %s', video_hash)
-    audio_hash = calculate_hash(audio_file)
+    audio_hash = self.calculate_hash(audio_file)
     logging.debug('Audio hash %s', audio_hash)
-    return self._add_offset(video_hash, audio_hash, offset)
+    return self.add_hashed_offset(video_hash, audio_hash, offset)
 
   def get_offset(self, video_file, audio_file):
-    video_hash = calculate_hash(video_file)
-    audio_hash = calculate_hash(audio_file)
-    return self._get_offset(video_hash, audio_hash)
+    video_hash = self.calculate_hash(video_file)
+    audio_hash = self.calculate_hash(audio_file)
+    return self.get_hashed_offset(video_hash, audio_hash, video_file,
+                                  audio_file)
+
+  def add_hashed_offset(self, video_hash, audio_hash, offset):
+    """Store offset for a pair of previously calculated file hashes."""
+    self._uncache([(video_hash, audio_hash)])
+    result = self._add_offset(video_hash, audio_hash, offset)
+    self._cache([(video_hash, audio_hash, offset)])
+    return result
+
+  def get_hashed_offset(self, video_hash, audio_hash, video_file=None,
+                        audio_file=None):
+    """Return the offset for a pair of file hashes, or None.
+
+    Args:
+      video_hash, audio_hash: keys of the preferred hash algorithm
+      video_file, audio_file: if given, the files are rehashed with the
+        fallback algorithms when no offset is stored under the given keys
+    """
+    if self.offset_cache is not None:
+      offset = self.offset_cache.get((video_hash, audio_hash))
+      if offset is not None:
+        return offset
+    offset = self._get_offset(video_hash, audio_hash)
+    if offset is not None:
+      self._cache([(video_hash, audio_hash, offset)])
+    if offset is not None or None in (video_file, audio_file):
+      return offset
+    for algorithm in self.hash_algorithms[1:]:
+      offset = self._get_offset(self.calculate_hash(video_file, algorithm),
+                                self.calculate_hash(audio_file, algorithm))
+      if offset is not None:
+        logging.debug('Migrating %s offset to preferred keys', algorithm)
+        self.add_hashed_offset(video_hash, audio_hash, offset)
+        return offset
+    return None
+
+  def add_sync_map(self, video_file, audio_file, sync_map):
+    """Store a sync_lib.SyncMap for a video/audio file pair."""
+    return self.add_hashed_sync_map(self.calculate_hash(video_file),
+                                    self.calculate_hash(audio_file), sync_map)
+
+  def get_sync_map(self, video_file, audio_file):
+    """Return the sync map of a video/audio file pair, or None.
+
+    Pairs with only a plain offset get the constant map of that offset.
+    """
+    return self.get_hashed_sync_map(self.calculate_hash(video_file),
+                                    self.calculate_hash(audio_file),
+                                    video_file, audio_file)
+
+  def add_hashed_sync_map(self, video_hash, audio_hash, sync_map):
+    """Store a sync map for a pair of previously calculated file hashes."""
+    self._uncache([(video_hash, audio_hash)])
+    result = self._add_sync_map(video_hash, audio_hash, sync_map)
+    self._cache([(video_hash, audio_hash, sync_map.offset_at(0))])
+    if self.offset_cache is not None:
+      self.offset_cache.put(_sync_map_key(video_hash, audio_hash), sync_map)
+    return result
+
+  def get_hashed_sync_map(self, video_hash, audio_hash, video_file=None,
+                          audio_file=None):
+    """Return the sync map for a pair of file hashes, or None.
+
+    See get_hashed_offset for the meaning of the arguments.
+    """
+    key = _sync_map_key(video_hash, audio_hash)
+    sync_map = None
+    if self.offset_cache is not None:
+      sync_map = self.offset_cache.get(key)
+    if sync_map is None:
+      sync_map = self._get_sync_map(video_hash, audio_hash)
+      if self.offset_cache is not None:
+        self.offset_cache.put(key, sync_map or _NO_SYNC_MAP)
+    if sync_map is not None and sync_map is not _NO_SYNC_MAP:
+      return sync_map
+    offset = self.get_hashed_offset(video_hash, audio_hash, video_file,
+                                    audio_file)
+    if offset is None:
+      return None
+    return sync_lib.SyncMap.constant(offset)
+
+  def _add_sync_map(self, video_hash, audio_hash, sync_map):
+    # Databases without sync map support only store constant maps
+    if not sync_map.is_constant():
+      raise OperationError('%s can not store sync maps' %
+                           self.__class__.__name__)
+    self._add_offset(video_hash, audio_hash, sync_map.offset_at(0))
+
+  def _get_sync_map(self, video_hash, audio_hash):
+    return None
+
+  def add_offsets(self, triples):
+    """Store offsets for many (video_file, audio_file, offset) triples."""
+    return self.add_hashed_offsets(
+      [(self.calculate_hash(video_file), self.calculate_hash(audio_file),
+        offset) for video_file, audio_file, offset in triples])
+
+  def get_offsets(self, pairs):
+    """Return the offsets for many (video_file, audio_file) pairs.
+
+    Returns:
+      list - the offset, or None, of each pair in order
+    """
+    pairs = list(pairs)
+    hash_pairs = [(self.calculate_hash(video_file),
+                   self.calculate_hash(audio_file))
+                  for video_file, audio_file in pairs]
+    return self.get_hashed_offsets(hash_pairs, pairs)
+
+  def add_hashed_offsets(self, triples):
+    """Store offsets for many (video_hash, audio_hash, offset) triples."""
+    triples = list(triples)
+    self._uncache(triples)
+    result = self._add_offsets(triples)
+    self._cache(triples)
+    return result
+
+  def get_hashed_offsets(self, hash_pairs, file_pairs=None):
+    """Return the offsets for many (video_hash, audio_hash) pairs.
+
+    Args:
+      hash_pairs: pairs of keys of the preferred hash algorithm
+      file_pairs: if given, the matching (video_file, audio_file) pairs,
+        which are rehashed with the fallback algorithms for pairs which
+        have no offset stored under their preferred keys
+
+    Returns:
+      list - the offset, or None, of each pair in order
+    """
+    hash_pairs = list(hash_pairs)
+    if self.offset_cache is None:
+      offsets = self._get_offsets(hash_pairs)
+    else:
+      offsets = [self.offset_cache.get(tuple(pair)) for pair in hash_pairs]
+      missing = [i for i, offset in enumerate(offsets) if offset is None]
+      if missing:
+        fetched = self._get_offsets([hash_pairs[i] for i in missing])
+        for i, offset in zip(missing, fetched):
+          offsets[i] = offset
+        self._cache([tuple(hash_pairs[i]) + (offset,)
+                     for i, offset in zip(missing, fetched)])
+    if file_pairs is None:
+      return offsets
+    for algorithm in self.hash_algorithms[1:]:
+      missing = [i for i, offset in enumerate(offsets) if offset is None]
+      if not missing:
+        break
+      fallback = self._get_offsets(
+        [(self.calculate_hash(file_pairs[i][0], algorithm),
+          self.calculate_hash(file_pairs[i][1], algorithm)) for i in missing])
+      migrated = []
+      for i, offset in zip(missing, fallback):
+        if offset is not None:
+          offsets[i] = offset
+          migrated.append(tuple(hash_pairs[i]) + (offset,))
+      if migrated:
+        logging.debug('Migrating %d %s offsets to preferred keys',
+                      len(migrated), algorithm)
+        self.add_hashed_offsets(migrated)
+    return offsets
+
+  def find_offsets(self, video_hashes, audio_hashes, candidates=None):
+    """Yield (video_hash, audio_hash, offset) for stored combinations.
+
+    The default implementation looks up the candidate pairs in batches,
+    or the full cross product of the given hashes if there are none.
+    That is one lookup per combination, so large libraries should pass
+    candidates.
+
+    Args:
+      video_hashes, audio_hashes: hashes to combine
+      candidates: if given, the (video_hash, audio_hash) pairs worth
+        looking up; databases which can scan their offsets ignore it
+        and find every stored combination
+    """
+    if candidates is None:
+      audio_hashes = list(audio_hashes)
+      candidates = ((video_hash, audio_hash) for video_hash in video_hashes
+                    for audio_hash in audio_hashes)
+    pairs = iter(candidates)
+    while True:
+      chunk = list(itertools.islice(pairs, BATCH_SIZE))
+      if not chunk:
+        return
+      for pair, offset in zip(chunk, self.get_hashed_offsets(chunk)):
+        if offset is not None:
+          yield pair + (offset,)
+
+  def _add_offsets(self, triples):
+    for video_hash, audio_hash, offset in triples:
+      self._add_offset(video_hash, audio_hash, offset)
+
+  def _get_offsets(self, hash_pairs):
+    return [self._get_offset(video_hash, audio_hash)
+            for video_hash, audio_hash in hash_pairs]
+
+  def _cache(self, triples):
+    """Remember the found offsets of (video_hash, audio_hash, offset)."""
+    if self.offset_cache is None:
+      return
+    for video_hash, audio_hash, offset in triples:
+      if offset is not None:
+        self.offset_cache.put((video_hash, audio_hash), offset)
+
+  def _uncache(self, pairs):
+    """Forget the offsets of pairs, or of triples, about to be stored."""
+    if self.offset_cache is None:
+      return
+    for pair in pairs:
+      self.offset_cache.pop(tuple(pair[:2]))
+      self.offset_cache.pop(_sync_map_key(*pair[:2]))
+
+
+class HttpTransport(object):
+  """A pool of persistent HTTP connections to a single server.
+
+  Idle connections are kept open and reused for later requests. GET
+  requests are retried with exponential backoff; other requests are only
+  retried when a reused connection turns out to have been closed by the
+  server, in which case the request can not have been processed.
+
+  Attributes:
+    connections: number of TCP connections opened
+    requests: number of requests completed
+    latencies: seconds taken by each of the most recent requests
+  """
+
+  def __init__(self, url, pool_size=HTTP_POOL_SIZE,
+               connect_timeout=HTTP_CONNECT_TIMEOUT,
+               read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES,
+               backoff=HTTP_RETRY_BACKOFF):
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == 'https':
+      self._connection_class = httplib.HTTPSConnection
+    else:
+      self._connection_class = httplib.HTTPConnection
+    self.host = parts.netloc
+    self.path = parts.path or '/'
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.retries = retries
+    self.backoff = backoff
+    self._idle = Queue.LifoQueue(pool_size)
+    self.connections = 0
+    self.requests = 0
+    self.latencies = collections.deque(maxlen=1000)
+
+  def get(self, params):
+    """Issue a GET with params as the query string and return the body."""
+    return self.request('GET', '%s?%s' % (self.path, urllib.urlencode(params)))
+
+  def post(self, params, path=None):
+    """Issue a form-encoded POST of params and return the body.
+
+    Args:
+      params: dict or sequence of (name, value) pairs
+      path: request path, defaults to the path of the transport url
+    """
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    return self.request('POST', path or self.path, urllib.urlencode(params),
+                        headers)
+
+  def request(self, method, path, body=None, headers=None):
+    """Issue a request, returning the response body.
+
+    Raises:
+      OperationError: if the request failed
+      HttpStatusError: if the request returned a non-200 status
+    """
+    attempt = 0
+    while True:
+      con = None
+      reused = False
+      start = time.time()
+      try:
+        con, reused = self._acquire()
+        con.request(method, path, body, headers or {})
+        response = con.getresponse()
+        data = response.read()
+      except (socket.error, httplib.HTTPException), e:
+        if con is not None:
+          con.close()
+        if (reused and isinstance(e, (httplib.BadStatusLine, socket.error))
+            and not isinstance(e, socket.timeout)):
+          # Most likely a keep-alive connection the server has since closed
+          logging.debug('Stale connection to %s: %s', self.host, e)
+          continue
+        if method != 'GET' or attempt >= self.retries:
+          metrics_lib.increment('db.remote.errors')
+          raise OperationError(e)
+        metrics_lib.increment('db.remote.retries')
+        time.sleep(self.backoff * 2 ** attempt)
+        attempt += 1
+        continue
+      self.latencies.append(time.time() - start)
+      metrics_lib.observe('db.remote.request', self.latencies[-1])
+      self.requests += 1
+      self._release(con, response)
+      if response.status != httplib.OK:
+        raise HttpStatusError(response.status, '%s %s: HTTP %s %s' % (
+          method, path, response.status, response.reason))
+      return data
+
+  def close(self):
+    """Close all idle connections."""
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except Queue.Empty:
+        return
+
+  def _acquire(self):
+    try:
+      return self._idle.get_nowait(), True
+    except Queue.Empty:
+      pass
+    con = self._connection_class(self.host, timeout=self.connect_timeout)
+    con.connect()
+    con.sock.settimeout(self.read_timeout)
+    con.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.connections += 1
+    return con, False
+
+  def _release(self, con, response):
+    if response.will_close:
+      con.close()
+      return
+    try:
+      self._idle.put_nowait(con)
+    except Queue.Full:
+      con.close()
 
 
 class RemoteRiffDatabase(RiffDatabase):
-  """A network-backed riff database."""
+  """A network-backed riff database.
+
+  Batches are POSTed to <url>/batch as repeated form fields, with op=get
+  or op=add. A batch get returns one line per pair, holding the offset
+  or nothing. Servers which do not know the batch endpoint are sent one
+  request per pair instead.
+  """
+
+  # The remote protocol only understands legacy keys
+  hash_algorithms = LEGACY_HASHES
 
-  def __init__(self, url):
+  # Statuses with which a server may reject the batch endpoint
+  _BATCH_UNSUPPORTED = (httplib.BAD_REQUEST, httplib.NOT_FOUND,
+                        httplib.METHOD_NOT_ALLOWED, httplib.NOT_IMPLEMENTED)
+
+  def __init__(self, url, hash_cache=None, transport=None,
+               offset_cache_size=OFFSET_CACHE_SIZE):
     self.url = url
+    self.hash_cache = hash_cache
+    self.offset_cache = _offset_cache(offset_cache_size)
+    self.transport = transport or HttpTransport(url)
+    self.batch_path = self.transport.path.rstrip('/') + '/batch'
+    self.batch_supported = True
+
+  @metrics_lib.timed_function('db.remote.add_offsets')
+  def _add_offsets(self, triples):
+    for start in xrange(0, len(triples), BATCH_SIZE):
+      chunk = triples[start:start + BATCH_SIZE]
+      params = [('op', 'add')]
+      for video_hash, audio_hash, offset in chunk:
+        params.extend([('video_hash', video_hash), ('audio_hash', audio_hash),
+                       ('offset', offset)])
+      if self._post_batch(params) is None:
+        RiffDatabase._add_offsets(self, triples[start:])
+        return
+
+  @metrics_lib.timed_function('db.remote.get_offsets')
+  def _get_offsets(self, hash_pairs):
+    offsets = []
+    for start in xrange(0, len(hash_pairs), BATCH_SIZE):
+      chunk = hash_pairs[start:start + BATCH_SIZE]
+      params = [('op', 'get')]
+      for video_hash, audio_hash in chunk:
+        params.extend([('video_hash', video_hash), ('audio_hash', audio_hash)])
+      response = self._post_batch(params)
+      if response is None:
+        return offsets + RiffDatabase._get_offsets(self, hash_pairs[start:])
+      lines = response.split('\n')
+      if len(lines) != len(chunk):
+        raise OperationError('Expected %d offsets, got %d' % (
+          len(chunk), len(lines)))
+      try:
+        offsets.extend([float(line) if line else None for line in lines])
+      except ValueError, e:
+        raise OperationError(e)
+    return offsets
+
+  def _post_batch(self, params):
+    """POST a batch request, returning None if batches are unsupported."""
+    if not self.batch_supported:
+      return None
+    try:
+      return self.transport.post(params, self.batch_path)
+    except HttpStatusError, e:
+      if e.status not in self._BATCH_UNSUPPORTED:
+        raise
+      logging.info('Remote database does not support batches: %s', e)
+      self.batch_supported = False
+      return None
 
+  @metrics_lib.timed_function('db.remote.add_offset')
   def _add_offset(self, video_hash, audio_hash, offset):
-    data = urllib.urlencode(
+    response = self.transport.post(
       dict(video_hash=video_hash, audio_hash=audio_hash, offset=offset))
-    try:
-      response = urllib2.urlopen(self.url, data=data)
-      logging.debug('Remote response: %s', response)
-    except urllib2.URLError, e:
-      raise OperationError(e)
+    logging.debug('Remote response: %s', response)
 
+  @metrics_lib.timed_function('db.remote.get_offset')
   def _get_offset(self, video_hash, audio_hash):
-    data = urllib.urlencode(
+    logging.debug('Requesting offset for %s, %s', video_hash, audio_hash)
+    response = self.transport.get(
       dict(video_hash=video_hash, audio_hash=audio_hash))
-    url = '%s?%s' % (self.url, data)
-    logging.debug('Requesting offset from url: %s', url)
+    if not response:
+      return None
+    logging.debug('Response: %s', response)
     try:
-      response = urllib2.urlopen(url).read()
-      if response:
-        logging.debug('Response: %s', response)
-        return float(response)
-      else:
-        return None
-    except Exception, e:
+      return float(response)
+    except ValueError, e:
       raise OperationError(e)
     
 
 class LocalRiffDatabase(RiffDatabase):
-  """A riff database backed by a local Sqlite file."""
+  """A riff database backed by a local Sqlite file.
+
+  The database may be used from any thread. Each thread reads through a
+  connection of its own while writes are serialized through one writer
+  connection; see ConnectionManager.
+
+  The schema version is kept in PRAGMA user_version. Version 2 stores
+  hash keys in the compact form of _encode_key, in a WITHOUT ROWID table
+  clustered on its primary key. Version 1 files, with hex keys and a
+  separate unique index, are migrated in place when opened.
+  """
+
+  SCHEMA_VERSION = 2
 
   _INIT_SQL = """
   DROP TABLE IF EXISTS `Offsets`;
   DROP INDEX IF EXISTS `Offsets-VideoAudio`;
 
   CREATE TABLE `Offsets`(
-    `VideoFileHash` TEXT NOT NULL,
-    `AudioFileHash` TEXT NOT NULL,
-    `Offset` REAL NOT NULL);
+    `VideoFileHash` BLOB NOT NULL,
+    `AudioFileHash` BLOB NOT NULL,
+    `Offset` REAL NOT NULL,
+    `SyncMap` BLOB,
+    PRIMARY KEY (VideoFileHash, AudioFileHash)) WITHOUT ROWID;
 
-  CREATE UNIQUE INDEX `Offsets-VideoAudio`
-    ON `Offsets`(VideoFileHash,AudioFileHash);
+  PRAGMA user_version = 2;
   """
 
+  # riff_key() is _encode_key, registered on the connection
+  _MIGRATE_V1_SQL = """
+  BEGIN;
+  CREATE TABLE `OffsetsV2`(
+    `VideoFileHash` BLOB NOT NULL,
+    `AudioFileHash` BLOB NOT NULL,
+    `Offset` REAL NOT NULL,
+    `SyncMap` BLOB,
+    PRIMARY KEY (VideoFileHash, AudioFileHash)) WITHOUT ROWID;
+  INSERT OR REPLACE INTO OffsetsV2
+    SELECT riff_key(VideoFileHash), riff_key(AudioFileHash), Offset, SyncMap
+    FROM Offsets;
+  DROP TABLE Offsets;
+  ALTER TABLE OffsetsV2 RENAME TO Offsets;
+  PRAGMA user_version = 2;
+  COMMIT;
+  """
+
+  # A plain offset keeps the stored sync map if it matches the map's
+  # offset, as when re-importing an export or a client without sync map
+  # support saves the pair again; a different offset replaces the map.
   _ADD_OFFSET_SQL = """
-  INSERT OR REPLACE INTO Offsets(VideoFileHash, AudioFileHash, Offset)
+  INSERT INTO Offsets(VideoFileHash, AudioFileHash, Offset)
     VALUES(?, ?, ?)
-  """
+    ON CONFLICT(VideoFileHash, AudioFileHash) DO UPDATE SET
+      SyncMap = CASE WHEN abs(Offset - excluded.Offset) < %g THEN SyncMap END,
+      Offset = excluded.Offset
+  """ % SYNC_MAP_OFFSET_TOLERANCE
 
   _GET_OFFSET_SQL = """
   SELECT Offset
   FROM Offsets
   WHERE VideoFileHash = ? AND AudioFileHash = ?
   """
+
+  # Databases created before sync maps gain the column on open
+  _ADD_SYNC_MAP_COLUMN_SQL = """
+  ALTER TABLE Offsets ADD COLUMN `SyncMap` BLOB;
+  """
+
+  _ADD_SYNC_MAP_SQL = """
+  INSERT OR REPLACE INTO Offsets(VideoFileHash, AudioFileHash, Offset, SyncMap)
+    VALUES(?, ?, ?, ?)
+  """
+
+  _GET_SYNC_MAP_SQL = """
+  SELECT SyncMap
+  FROM Offsets
+  WHERE VideoFileHash = ? AND AudioFileHash = ?
+  """
+
+  # As _ADD_OFFSET_SQL, but a row with a sync map replaces the stored map
+  _IMPORT_SQL = """
+  INSERT INTO Offsets(VideoFileHash, AudioFileHash, Offset, SyncMap)
+    VALUES(?, ?, ?, ?)
+    ON CONFLICT(VideoFileHash, AudioFileHash) DO UPDATE SET
+      SyncMap = CASE
+        WHEN excluded.SyncMap IS NOT NULL THEN excluded.SyncMap
+        WHEN abs(Offset - excluded.Offset) < %g THEN SyncMap END,
+      Offset = excluded.Offset
+  """ % SYNC_MAP_OFFSET_TOLERANCE
+
+  _EXPORT_SQL = """
+  SELECT VideoFileHash, AudioFileHash, Offset, SyncMap
+  FROM Offsets
+  """
+
+  # Applied to every connection; journal_mode=WAL is persistent
+  _PRAGMA_SQL = """
+  PRAGMA journal_mode=WAL;
+  PRAGMA synchronous=NORMAL;
+  """
+
+  # Applied for the duration of a bulk import; the previous values are
+  # restored afterwards
+  _IMPORT_PRAGMA_SQL = """
+  PRAGMA cache_size=-65536;
+  PRAGMA temp_store=MEMORY;
+  """
+
+  _RESTORE_PRAGMA_SQL = """
+  PRAGMA cache_size=%d;
+  PRAGMA temp_store=%d;
+  """
+
+  _GET_OFFSETS_SQL = """
+  WITH Pairs(VideoFileHash, AudioFileHash) AS (VALUES %s)
+  SELECT Offsets.VideoFileHash, Offsets.AudioFileHash, Offset
+  FROM Pairs JOIN Offsets USING (VideoFileHash, AudioFileHash)
+  """
   
-  def __init__(self, path, overwrite=False):
-    self._con = self._open_db(path, overwrite)
-    self._con.text_factory = str
+  def __init__(self, path, overwrite=False,
+               offset_cache_size=OFFSET_CACHE_SIZE):
+    self.path = path
+    # An in-memory or temporary database is private to its connection, so
+    # reads have to go through the writer
+    reader_path = path if path not in ('', ':memory:') else None
+    self._connections = ConnectionManager(self._open_db(path, overwrite),
+                                          reader_path)
+    self.hash_cache = FileHashCache(self._connections)
+    self.offset_cache = _offset_cache(offset_cache_size)
+
+  def close(self):
+    """Close the connections of the calling thread and the writer."""
+    self._connections.close()
+
+  def import_offsets(self, triples):
+    """Store (video_hash, audio_hash, offset) triples in one transaction.
+
+    triples may be any iterable, including a generator such as
+    read_offsets; it is consumed as it is inserted. An offset may be a
+    sync_lib.SyncMap.
+
+    The offset cache is emptied, as any of its entries may be replaced.
+
+    Returns:
+      int - number of triples stored
+    """
+    if self.offset_cache is not None:
+      self.offset_cache.clear()
+    count = [0]
+    def counted():
+      for video_hash, audio_hash, offset in triples:
+        count[0] += 1
+        yield ((_encode_key(video_hash), _encode_key(audio_hash)) +
+               _offset_columns(offset))
+    with self._connections.write() as con:
+      settings = (con.execute('PRAGMA cache_size').fetchone()[0],
+                  con.execute('PRAGMA temp_store').fetchone()[0])
+      con.executescript(self._IMPORT_PRAGMA_SQL)
+      try:
+        con.executemany(self._IMPORT_SQL, counted())
+        con.commit()
+      finally:
+        # Pragmas can only be changed outside of the import transaction
+        con.rollback()
+        con.executescript(self._RESTORE_PRAGMA_SQL % settings)
+    return count[0]
+
+  def find_offsets(self, video_hashes, audio_hashes, candidates=None):
+    """Yield (video_hash, audio_hash, offset) for every stored combination.
 
+    The table is scanned once rather than probed for each combination,
+    so candidates are not needed.
+    """
+    video_hashes = set(video_hashes)
+    audio_hashes = set(audio_hashes)
+    for video_hash, audio_hash, offset in self.export_offsets():
+      if video_hash in video_hashes and audio_hash in audio_hashes:
+        yield video_hash, audio_hash, offset
+
+  def export_offsets(self, sync_maps=False):
+    """Yield every stored (video_hash, audio_hash, offset) triple.
+
+    Rows are streamed from a separate connection, so the export neither
+    loads the table into memory nor blocks other users of the database.
+    An in-memory database can only be read through its own connection,
+    and is exported from a snapshot of its rows instead.
+
+    Args:
+      sync_maps: yield the sync_lib.SyncMap of pairs which have one in
+        place of their offset
+    """
+    for video_key, audio_key, offset, data in self._export_rows():
+      if sync_maps and data is not None:
+        try:
+          offset = sync_lib.SyncMap.from_bytes(data)
+        except sync_lib.SyncMapError, e:
+          logging.error('Exporting offset of bad sync map: %s', e)
+      yield _decode_key(video_key), _decode_key(audio_key), offset
+
+  def _export_rows(self):
+    if self._connections.path is None:
+      with self._connections.read() as con:
+        rows = con.execute(self._EXPORT_SQL).fetchall()
+      for row in rows:
+        yield row
+      return
+    con = _connect_db(self.path)
+    try:
+      for row in con.execute(self._EXPORT_SQL):
+        yield row
+    finally:
+      con.close()
+
+  @metrics_lib.timed_function('db.local.add_offset')
   def _add_offset(self, video_hash, audio_hash, offset):
-    results = self._con.execute(
-      _ADD_OFFSET_SQL, (video_hash, audio_hash, offset))
-    self._con.commit()
+    with self._connections.write() as con:
+      con.execute(self._ADD_OFFSET_SQL, (
+        _encode_key(video_hash), _encode_key(audio_hash), offset))
 
+  @metrics_lib.timed_function('db.local.add_offsets')
+  def _add_offsets(self, triples):
+    with self._connections.write() as con:
+      con.executemany(self._ADD_OFFSET_SQL, (
+        (_encode_key(video_hash), _encode_key(audio_hash), offset)
+        for video_hash, audio_hash, offset in triples))
+
+  @metrics_lib.timed_function('db.local.get_offsets')
+  def _get_offsets(self, hash_pairs):
+    found = {}
+    with self._connections.read() as con:
+      for start in xrange(0, len(hash_pairs), BATCH_SIZE):
+        chunk = hash_pairs[start:start + BATCH_SIZE]
+        sql = self._GET_OFFSETS_SQL % ', '.join(['(?, ?)'] * len(chunk))
+        params = [_encode_key(key) for pair in chunk for key in pair]
+        for video_key, audio_key, offset in con.execute(sql, params):
+          found[(_decode_key(video_key), _decode_key(audio_key))] = offset
+    return [found.get(tuple(pair)) for pair in hash_pairs]
+
+  def _add_sync_map(self, video_hash, audio_hash, sync_map):
+    with self._connections.write() as con:
+      con.execute(self._ADD_SYNC_MAP_SQL, (
+        _encode_key(video_hash), _encode_key(audio_hash)) +
+        _offset_columns(sync_map))
+
+  def _get_sync_map(self, video_hash, audio_hash):
+    with self._connections.read() as con:
+      row = con.execute(self._GET_SYNC_MAP_SQL, (
+        _encode_key(video_hash), _encode_key(audio_hash))).fetchone()
+    return _load_sync_map(row and row[0], video_hash, audio_hash)
+
+  @metrics_lib.timed_function('db.local.get_offset')
   def _get_offset(self, video_hash, audio_hash):
-    results = self._con.execute(
-      _GET_OFFSET_SQL, (video_hash, audio_hash)).fetchone()
+    with self._connections.read() as con:
+      results = con.execute(self._GET_OFFSET_SQL, (
+        _encode_key(video_hash), _encode_key(audio_hash))).fetchone()
     if results:
       return results[0]
     else:
       return None
 
   def _init_db(self, path):
+    handle = _connect_db(path)
     try:
-      handle = sqlite3.connect(path)
-      handle.executescript(_INIT_SQL)
+      handle.executescript(self._PRAGMA_SQL)
+      handle.executescript(self._INIT_SQL)
       handle.commit()
     except sqlite3.OperationalError, e:
       raise OperationError(e)
@@ -158,20 +1379,641 @@ class LocalRiffDatabase(RiffDatabase):
   def _open_db(self, path, overwrite):
     if not os.path.exists(path) or overwrite:
       return self._init_db(path)
+    handle = _connect_db(path)
     try:
-      handle = sqlite3.connect(path)
-    except sqlite3.OperationalError, e:
+      handle.executescript(self._PRAGMA_SQL)
+      version = handle.execute('PRAGMA user_version').fetchone()[0]
+      if version > self.SCHEMA_VERSION:
+        handle.close()
+        raise OperationError('%s has schema version %d, newer than %d' % (
+          path, version, self.SCHEMA_VERSION))
+      if version < self.SCHEMA_VERSION:
+        self._migrate_v1(handle)
+    except sqlite3.Error, e:
       raise OperationError(e)
     else:
       return handle
 
+  def _migrate_v1(self, handle):
+    """Convert a version 1 Offsets table to version 2 in place."""
+    columns = [row[1] for row in
+               handle.execute('PRAGMA table_info(Offsets)')]
+    if not columns:
+      handle.executescript(self._INIT_SQL)
+      return
+    logging.info('Migrating %s to schema version %d', self.path,
+                 self.SCHEMA_VERSION)
+    start = time.time()
+    if 'SyncMap' not in columns:
+      handle.executescript(self._ADD_SYNC_MAP_COLUMN_SQL)
+    handle.create_function('riff_key', 1, _encode_key)
+    try:
+      handle.executescript(self._MIGRATE_V1_SQL)
+    except sqlite3.Error:
+      handle.rollback()
+      raise
+    # Give the space of the old table and index back to the file system
+    handle.execute('VACUUM')
+    logging.info('Migrated %s in %.1fs', self.path, time.time() - start)
+
+
+class OffsetOutbox(object):
+  """A durable queue of offsets waiting to be sent to a remote database.
+
+  Entries live in an OffsetOutbox table, so nothing queued is lost when
+  the program exits. Queuing an offset for a pair which is already queued
+  replaces the pending value. A background thread sends due entries in
+  batches, retrying failures with exponential backoff; entries which fail
+  max_attempts times are kept as failed until retry_failed is called.
+  A paused outbox only queues entries until resume is called.
+  """
+
+  _INIT_SQL = """
+  CREATE TABLE IF NOT EXISTS `OffsetOutbox`(
+    `VideoFileHash` TEXT NOT NULL,
+    `AudioFileHash` TEXT NOT NULL,
+    `Offset` REAL NOT NULL,
+    `Queued` REAL NOT NULL,
+    `Attempts` INTEGER NOT NULL DEFAULT 0,
+    `NextAttempt` REAL NOT NULL,
+    `LastError` TEXT,
+    PRIMARY KEY(VideoFileHash, AudioFileHash));
+  """
+
+  _QUEUE_SQL = """
+  INSERT OR REPLACE INTO OffsetOutbox(
+    VideoFileHash, AudioFileHash, Offset, Queued, NextAttempt)
+    VALUES(?, ?, ?, ?, ?)
+  """
+
+  _DUE_SQL = """
+  SELECT VideoFileHash, AudioFileHash, Offset, Queued, Attempts
+  FROM OffsetOutbox
+  WHERE Attempts < ? AND NextAttempt <= ?
+  ORDER BY NextAttempt
+  LIMIT ?
+  """
+
+  _NEXT_DUE_SQL = """
+  SELECT MIN(NextAttempt) FROM OffsetOutbox WHERE Attempts < ?
+  """
+
+  _SENT_SQL = """
+  DELETE FROM OffsetOutbox
+  WHERE VideoFileHash = ? AND AudioFileHash = ? AND Queued = ?
+  """
+
+  _FAILED_SQL = """
+  UPDATE OffsetOutbox
+  SET Attempts = ?, NextAttempt = ?, LastError = ?
+  WHERE VideoFileHash = ? AND AudioFileHash = ? AND Queued = ?
+  """
+
+  _LIST_SQL = """
+  SELECT VideoFileHash, AudioFileHash, Offset, Attempts, LastError
+  FROM OffsetOutbox
+  WHERE Attempts %s ?
+  ORDER BY Queued
+  """
+
+  _RETRY_SQL = """
+  UPDATE OffsetOutbox SET Attempts = 0, NextAttempt = ? WHERE Attempts >= ?
+  """
+
+  def __init__(self, con, lock, remote, backoff=OUTBOX_RETRY_BACKOFF,
+               max_backoff=OUTBOX_MAX_BACKOFF,
+               max_attempts=OUTBOX_MAX_ATTEMPTS, paused=False):
+    self._con = con
+    self._lock = lock
+    self.remote = remote
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.max_attempts = max_attempts
+    self.paused = paused
+    self.sent = 0
+    try:
+      with self._lock:
+        self._con.executescript(self._INIT_SQL)
+        self._con.commit()
+    except sqlite3.OperationalError, e:
+      raise OperationError(e)
+    self._wakeup = threading.Event()
+    self._closed = False
+    self._thread = threading.Thread(target=self._run, name='outbox')
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def queue(self, triples, commit=True):
+    """Queue (video_hash, audio_hash, offset) triples for sending."""
+    now = time.time()
+    with self._lock:
+      self._con.executemany(
+        self._QUEUE_SQL, [tuple(triple) + (now, now) for triple in triples])
+      if commit:
+        self._con.commit()
+    self._wakeup.set()
+
+  def pending(self):
+    """Return the (video_hash, audio_hash, offset, attempts, error) queued."""
+    return self._list('<')
+
+  def failed(self):
+    """Return the entries which have given up, in the form of pending()."""
+    return self._list('>=')
+
+  def retry_failed(self):
+    """Requeue all failed entries for immediate sending."""
+    with self._lock:
+      self._con.execute(self._RETRY_SQL, (time.time(), self.max_attempts))
+      self._con.commit()
+    self._wakeup.set()
+
+  def resume(self):
+    """Start sending queued entries, if the outbox was paused."""
+    self.paused = False
+    self._wakeup.set()
+
+  def flush(self):
+    """Send every due entry now, in the calling thread.
 
-def GetRiffDatabase(force_local=False):
-  """Return a remote database if possible, or a local db otherwise."""
+    Returns:
+      int - number of entries left pending
+    """
+    while self._send_due():
+      pass
+    return len(self.pending())
+
+  def close(self):
+    """Stop the background sender. Unsent entries stay queued."""
+    self._closed = True
+    self._wakeup.set()
+    self._thread.join()
+
+  def _list(self, op):
+    with self._lock:
+      return self._con.execute(self._LIST_SQL % op,
+                               (self.max_attempts,)).fetchall()
+
+  def _run(self):
+    while not self._closed:
+      if self.paused:
+        self._wakeup.wait()
+        self._wakeup.clear()
+        continue
+      try:
+        sent = self._send_due()
+      except Exception, e:
+        logging.exception('Error sending queued offsets: %s', e)
+        sent = False
+      if sent:
+        continue
+      with self._lock:
+        next_due = self._con.execute(
+          self._NEXT_DUE_SQL, (self.max_attempts,)).fetchone()[0]
+      timeout = None if next_due is None else max(0, next_due - time.time())
+      self._wakeup.wait(timeout)
+      self._wakeup.clear()
+
+  def _send_due(self):
+    """Send one batch of due entries, returning whether any succeeded."""
+    with self._lock:
+      rows = self._con.execute(
+        self._DUE_SQL, (self.max_attempts, time.time(), BATCH_SIZE)).fetchall()
+    if not rows:
+      return False
+    try:
+      self.remote.add_hashed_offsets([row[:3] for row in rows])
+    except OperationError, e:
+      logging.warning('Error sending %d queued offsets: %s', len(rows), e)
+      now = time.time()
+      with self._lock:
+        self._con.executemany(self._FAILED_SQL, [
+          (attempts + 1,
+           now + min(self.max_backoff, self.backoff * 2 ** attempts),
+           str(e), video_hash, audio_hash, queued)
+          for video_hash, audio_hash, _, queued, attempts in rows])
+        self._con.commit()
+      return False
+    # Entries requeued while the batch was in flight keep their new values
+    with self._lock:
+      self._con.executemany(self._SENT_SQL, [
+        (video_hash, audio_hash, queued)
+        for video_hash, audio_hash, _, queued, _ in rows])
+      self._con.commit()
+    self.sent += len(rows)
+    metrics_lib.increment('db.outbox.sent', len(rows))
+    return True
+
+
+class TieredRiffDatabase(RiffDatabase):
+  """A remote riff database behind a read-through local Sqlite cache.
+
+  Offsets found remotely are cached for positive_ttl seconds, and pairs
+  the remote has no offset for are remembered for negative_ttl seconds.
+  Expired entries are still served when the remote can not be reached.
+
+  Saved offsets are written to the cache and to a durable OffsetOutbox,
+  from which a background thread sends them on to the remote. Sync maps
+  are only kept in the cache; the remote is sent their offset at the
+  start of the video.
+
+  There is no in-memory offset cache, which would serve its entries past
+  their TTL; CachedOffsets is local already.
+
+  While online is False the remote is left alone: lookups are answered
+  from the cache alone, expired entries included, and saved offsets stay
+  queued until go_online is called.
+
+  Given a local LocalRiffDatabase, saved offsets and sync maps are also
+  stored in it, and pairs for which neither the cache nor the remote has
+  an offset are looked up there. Offsets saved while the remote was
+  never reachable are found that way. Lookups then also fall back to the
+  hash algorithms of the local database, whose keys are never sent to
+  the remote.
+
+  Attributes:
+    online: whether the remote is used
+    local: LocalRiffDatabase consulted last, or None
+    hits: lookups answered from a fresh cache entry
+    misses: lookups with no fresh cache entry
+    remote_errors: remote lookups which failed
+    remote_latencies: seconds taken by each of the most recent remote calls
+  """
+
+  _INIT_SQL = """
+  CREATE TABLE IF NOT EXISTS `CachedOffsets`(
+    `VideoFileHash` TEXT NOT NULL,
+    `AudioFileHash` TEXT NOT NULL,
+    `Offset` REAL,
+    `Fetched` REAL NOT NULL,
+    `SyncMap` BLOB,
+    PRIMARY KEY(VideoFileHash, AudioFileHash));
+  """
+
+  # A sync map saved locally survives refreshes returning its offset
+  _PUT_SQL = """
+  INSERT INTO CachedOffsets(VideoFileHash, AudioFileHash, Offset, Fetched)
+    VALUES(?, ?, ?, ?)
+    ON CONFLICT(VideoFileHash, AudioFileHash) DO UPDATE SET
+      SyncMap = CASE WHEN abs(Offset - excluded.Offset) < %g THEN SyncMap END,
+      Offset = excluded.Offset,
+      Fetched = excluded.Fetched
+  """ % SYNC_MAP_OFFSET_TOLERANCE
+
+  _PUT_SYNC_MAP_SQL = """
+  INSERT OR REPLACE INTO CachedOffsets(
+    VideoFileHash, AudioFileHash, Offset, SyncMap, Fetched)
+    VALUES(?, ?, ?, ?, ?)
+  """
+
+  _GET_SYNC_MAP_SQL = """
+  SELECT SyncMap
+  FROM CachedOffsets
+  WHERE VideoFileHash = ? AND AudioFileHash = ?
+  """
+
+  _SCAN_SQL = """
+  SELECT VideoFileHash, AudioFileHash, Offset
+  FROM CachedOffsets
+  WHERE Offset IS NOT NULL
+  """
+
+  _GET_SQL = """
+  SELECT Offset, Fetched
+  FROM CachedOffsets
+  WHERE VideoFileHash = ? AND AudioFileHash = ?
+  """
+
+  def __init__(self, remote, path, positive_ttl=CACHE_POSITIVE_TTL,
+               negative_ttl=CACHE_NEGATIVE_TTL, online=True, local=None):
+    self.remote = remote
+    self.online = online
+    self.local = local
+    # Expired entries are refreshed through the remote, which must not
+    # answer from a cache of its own
+    remote.offset_cache = None
+    self.hash_algorithms = remote.hash_algorithms
+    if local is not None:
+      self.hash_algorithms += tuple(
+        algorithm for algorithm in local.hash_algorithms
+        if algorithm not in self.hash_algorithms)
+    self.positive_ttl = positive_ttl
+    self.negative_ttl = negative_ttl
+    self._con = _connect_db(path)
+    self._lock = threading.RLock()
+    try:
+      self._con.executescript(self._INIT_SQL)
+      self._con.commit()
+    except sqlite3.OperationalError, e:
+      raise OperationError(e)
+    self.hash_cache = FileHashCache(
+      ConnectionManager(self._con, lock=self._lock))
+    self.outbox = OffsetOutbox(self._con, self._lock, remote,
+                               paused=not online)
+    self.hits = 0
+    self.misses = 0
+    self.remote_errors = 0
+    self.remote_latencies = collections.deque(maxlen=1000)
+
+  def close(self):
+    """Stop sending queued offsets; they are sent on the next open."""
+    self.outbox.close()
+    if self.local is not None:
+      self.local.close()
+
+  def go_online(self):
+    """Start refreshing lookups through the remote and sending saves."""
+    self.online = True
+    self.outbox.resume()
+
+  def _add_offset(self, video_hash, audio_hash, offset):
+    self._add_offsets([(video_hash, audio_hash, offset)])
+
+  def _add_offsets(self, triples):
+    if self.local is not None:
+      self.local.add_hashed_offsets(triples)
+    with self._lock:
+      self._put(triples, commit=False)
+      self.outbox.queue(triples)
+
+  def _add_sync_map(self, video_hash, audio_hash, sync_map):
+    if self.local is not None:
+      self.local.add_hashed_sync_map(video_hash, audio_hash, sync_map)
+    offset, data = _offset_columns(sync_map)
+    with self._lock:
+      self._con.execute(self._PUT_SYNC_MAP_SQL, (
+        video_hash, audio_hash, offset, data, time.time()))
+      self.outbox.queue([(video_hash, audio_hash, offset)])
+
+  def _get_sync_map(self, video_hash, audio_hash):
+    with self._lock:
+      row = self._con.execute(self._GET_SYNC_MAP_SQL,
+                              (video_hash, audio_hash)).fetchone()
+    sync_map = _load_sync_map(row and row[0], video_hash, audio_hash)
+    if sync_map is None and self.local is not None:
+      sync_map = self.local._get_sync_map(video_hash, audio_hash)
+    return sync_map
+
+  def find_offsets(self, video_hashes, audio_hashes, candidates=None):
+    """Yield (video_hash, audio_hash, offset) for stored combinations.
+
+    Every combination in the cache, or in the local database, is found
+    without a remote lookup. Only candidate pairs, if given, are looked
+    up further; without candidates nothing is asked of the remote, as
+    the full cross product of a library would take a request per pair.
+    """
+    video_hashes = set(video_hashes)
+    audio_hashes = set(audio_hashes)
+    found = set()
+    with self._lock:
+      rows = self._con.execute(self._SCAN_SQL).fetchall()
+    for video_hash, audio_hash, offset in rows:
+      if video_hash in video_hashes and audio_hash in audio_hashes:
+        found.add((video_hash, audio_hash))
+        yield video_hash, audio_hash, offset
+    if self.local is not None:
+      for triple in self.local.find_offsets(video_hashes, audio_hashes):
+        if triple[:2] not in found:
+          found.add(triple[:2])
+          yield triple
+    if candidates is None:
+      return
+    candidates = (tuple(pair) for pair in candidates
+                  if tuple(pair) not in found)
+    for triple in RiffDatabase.find_offsets(self, video_hashes, audio_hashes,
+                                            candidates):
+      yield triple
+
+  def _get_offset(self, video_hash, audio_hash):
+    return self._get_offsets([(video_hash, audio_hash)])[0]
+
+  def _get_offsets(self, hash_pairs):
+    now = time.time()
+    offsets = []
+    missing = []
+    stale = {}
+    with self._lock:
+      for i, pair in enumerate(hash_pairs):
+        row = self._con.execute(self._GET_SQL, tuple(pair)).fetchone()
+        offsets.append(row and row[0])
+        if row is None:
+          missing.append(i)
+          continue
+        offset, fetched = row
+        ttl = self.negative_ttl if offset is None else self.positive_ttl
+        if now - fetched >= ttl:
+          missing.append(i)
+          stale[i] = offset
+    self.hits += len(hash_pairs) - len(missing)
+    self.misses += len(missing)
+    metrics_lib.increment('db.tiered.hits', len(hash_pairs) - len(missing))
+    metrics_lib.increment('db.tiered.misses', len(missing))
+    # Keys of the local database's own algorithms mean nothing remotely
+    missing = [i for i in missing if _is_legacy_key(hash_pairs[i][0]) and
+               _is_legacy_key(hash_pairs[i][1])]
+    if missing and self.online:
+      try:
+        fetched = self._call_remote(self.remote.get_hashed_offsets,
+                                    [hash_pairs[i] for i in missing])
+      except OperationError:
+        if len(stale) < len(missing) and self.local is None:
+          raise
+        logging.info('Remote lookup failed, using expired cache entries')
+      else:
+        for i, offset in zip(missing, fetched):
+          offsets[i] = offset
+        self._put([tuple(hash_pairs[i]) + (offset,)
+                   for i, offset in zip(missing, fetched)], now)
+    if self.local is None:
+      return offsets
+    unknown = [i for i, offset in enumerate(offsets) if offset is None]
+    if unknown:
+      found = self.local.get_hashed_offsets([hash_pairs[i] for i in unknown])
+      for i, offset in zip(unknown, found):
+        offsets[i] = offset
+    return offsets
+
+  def _put(self, triples, now=None, commit=True):
+    now = now or time.time()
+    with self._lock:
+      self._con.executemany(
+        self._PUT_SQL, [tuple(triple) + (now,) for triple in triples])
+      if commit:
+        self._con.commit()
+
+  def _call_remote(self, func, *args):
+    start = time.time()
+    try:
+      return func(*args)
+    except OperationError:
+      self.remote_errors += 1
+      metrics_lib.increment('db.tiered.remote_errors')
+      raise
+    finally:
+      self.remote_latencies.append(time.time() - start)
+      metrics_lib.observe('db.tiered.remote_call', self.remote_latencies[-1])
+
+
+class ProbingRiffDatabase(RiffDatabase):
+  """A cached remote database handle which does not wait for the network.
+
+  Calls go to an offline TieredRiffDatabase, opened on first use, so
+  lookups are answered from the local cache and saves are queued in its
+  outbox straight away. The Offsets of the LocalRiffDatabase in the same
+  file back the tier, so offsets saved locally are still found and new
+  ones are stored there too. Meanwhile a background thread checks whether the
+  remote server answers within timeout seconds, and if it does, the tier
+  goes online: expired and missing entries are refreshed from the remote
+  and queued saves are sent.
+  """
+
+  def __init__(self, url, path, timeout=PROBE_TIMEOUT, on_switch=None):
+    """Create the handle and start probing url.
+
+    Args:
+      url: url of the remote database
+      path: path of the local Sqlite file
+      timeout: seconds to wait for the remote to connect and to answer
+      on_switch: called with this handle, from the probing thread, once
+        the remote has turned out to be reachable
+    """
+    self.url = url
+    self.path = path
+    self.timeout = timeout
+    self.on_switch = on_switch
+    self.remote = False
+    self._db = None
+    self._lock = threading.Lock()
+    self._probed = threading.Event()
+    thread = threading.Thread(target=self._probe, name='probe')
+    thread.setDaemon(True)
+    thread.start()
+
+  @property
+  def current(self):
+    """The TieredRiffDatabase calls are passed on to."""
+    with self._lock:
+      if self._db is None:
+        local = LocalRiffDatabase(self.path)
+        self._db = TieredRiffDatabase(
+          RemoteRiffDatabase(self.url, offset_cache_size=0), self.path,
+          online=self.remote, local=local)
+      return self._db
+
+  @property
+  def hash_algorithms(self):
+    return self.current.hash_algorithms
+
+  @property
+  def hash_cache(self):
+    return self.current.hash_cache
+
+  @property
+  def offset_cache(self):
+    return self.current.offset_cache
+
+  def wait_for_probe(self, timeout=None):
+    """Wait for the probe to finish, returning whether the remote is used."""
+    self._probed.wait(timeout)
+    return self.remote
+
+  def calculate_hash(self, filename, algorithm=None):
+    return self.current.calculate_hash(filename, algorithm)
+
+  def add_offset(self, video_file, audio_file, offset):
+    return self.current.add_offset(video_file, audio_file, offset)
+
+  def get_offset(self, video_file, audio_file):
+    return self.current.get_offset(video_file, audio_file)
+
+  def add_offsets(self, triples):
+    return self.current.add_offsets(triples)
+
+  def get_offsets(self, pairs):
+    return self.current.get_offsets(pairs)
+
+  def add_hashed_offset(self, video_hash, audio_hash, offset):
+    return self.current.add_hashed_offset(video_hash, audio_hash, offset)
+
+  def get_hashed_offset(self, video_hash, audio_hash, video_file=None,
+                        audio_file=None):
+    return self.current.get_hashed_offset(video_hash, audio_hash, video_file,
+                                          audio_file)
+
+  def add_hashed_offsets(self, triples):
+    return self.current.add_hashed_offsets(triples)
+
+  def get_hashed_offsets(self, hash_pairs, file_pairs=None):
+    return self.current.get_hashed_offsets(hash_pairs, file_pairs)
+
+  def find_offsets(self, video_hashes, audio_hashes, candidates=None):
+    return self.current.find_offsets(video_hashes, audio_hashes, candidates)
+
+  def add_sync_map(self, video_file, audio_file, sync_map):
+    return self.current.add_sync_map(video_file, audio_file, sync_map)
+
+  def get_sync_map(self, video_file, audio_file):
+    return self.current.get_sync_map(video_file, audio_file)
+
+  def add_hashed_sync_map(self, video_hash, audio_hash, sync_map):
+    return self.current.add_hashed_sync_map(video_hash, audio_hash, sync_map)
+
+  def get_hashed_sync_map(self, video_hash, audio_hash, video_file=None,
+                          audio_file=None):
+    return self.current.get_hashed_sync_map(video_hash, audio_hash,
+                                            video_file, audio_file)
+
+  def _probe(self):
+    try:
+      transport = HttpTransport(self.url, connect_timeout=self.timeout,
+                                read_timeout=self.timeout, retries=0)
+      try:
+        transport.request('GET', transport.path)
+      finally:
+        transport.close()
+    except OperationError, e:
+      logging.info('Remote database %s unavailable: %s', self.url, e)
+      return
+    finally:
+      self._probed.set()
+    with self._lock:
+      self.remote = True
+      db = self._db
+    if db is not None:
+      db.go_online()
+    logging.info('Using remote database %s', self.url)
+    if self.on_switch is not None:
+      self.on_switch(self)
+
+
+def GetRiffDatabase(force_local=False, on_switch=None, path=None, url=None):
+  """Return a database handle without waiting for the network.
+
+  Unless force_local is set, the handle is a cached remote database which
+  only uses the remote once it turns out to be reachable; see
+  ProbingRiffDatabase.
+
+  Args:
+    path: local database file, DEFAULT_DB_FILE if not given
+    url: remote database, DEFAULT_REMOTE_URL if not given
+  """
+  path = path or DEFAULT_DB_FILE
   if force_local:
-    return LocalRiffDatabase(DEFAULT_DB_FILE)
+    return LocalRiffDatabase(path)
+  return ProbingRiffDatabase(url or DEFAULT_REMOTE_URL, path,
+                             on_switch=on_switch)
+
+
+def GetHashCache(path):
+  """Return a file hash cache stored in the Sqlite file at path."""
+  return FileHashCache(ConnectionManager(_connect_db(path)))
+
+
+def _connect_db(path, timeout=SQLITE_BUSY_TIMEOUT):
+  """Open a Sqlite connection which may be shared between threads."""
   try:
-    urllib2.urlopen(DEFAULT_REMOTE_URL)
-    return RemoteRiffDatabase(DEFAULT_REMOTE_URL)
-  except urllib2.URLError:
-    return LocalRiffDatabase(DEFAULT_DB_FILE)
+    con = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+  except sqlite3.OperationalError, e:
+    raise OperationError(e)
+  con.text_factory = str
+  return con
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+
+# Upper bounds in seconds of the buckets of timers
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+                0.1, 0.5, 1.0, 5.0, 10.0)
+LOG_INTERVAL = 60.0 # seconds between periodic debug reports
+
+
+class Counter(object):
+  """A count of events."""
+
+  def __init__(self):
+    self.value = 0
+
+  def report(self):
+    return self.value
+
+
+class Histogram(object):
+  """Counts of values in fixed buckets, plus their count, sum and range.
+
+  Attributes:
+    buckets: ascending upper bounds; values above the last one are
+      counted in an overflow bucket
+    counts: list of counts, one per bucket plus the overflow bucket
+  """
+
+  def __init__(self, buckets):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def percentile(self, fraction):
+    """Return the upper bound of the bucket holding fraction (0..1)."""
+    rank = fraction * self.count
+    seen = 0
+    for bound, count in zip(self.buckets, self.counts):
+      seen += count
+      if seen >= rank and count:
+        return bound
+    return self.max
+
+  def report(self):
+    if not self.count:
+      return {'count': 0}
+    buckets = dict(('le_%g' % bound, count) for bound, count in
+                   zip(self.buckets, self.counts) if count)
+    if self.counts[-1]:
+      buckets['overflow'] = self.counts[-1]
+    return {'count': self.count, 'mean': self.total / self.count,
+            'min': self.min, 'max': self.max, 'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99), 'buckets': buckets}
+
+
+class _Timing(object):
+  """Context manager adding the duration of its block to a histogram."""
+
+  def __init__(self, registry, name):
+    self.registry = registry
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.registry.observe(self.name, time.time() - self.start, TIME_BUCKETS)
+    return False
+
+
+class _NullTiming(object):
+  """Context manager used while metrics are disabled."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+_NULL_TIMING = _NullTiming()
+
+
+class Registry(object):
+  """A named set of counters and histograms.
+
+  Recording is a no-op until the registry is enabled, so instrumented
+  code costs an attribute check when metrics are not wanted.
+  """
+
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._histograms = {}
+    self._started = time.time()
+
+  def increment(self, name, count=1):
+    """Add count to the counter name."""
+    if not self.enabled:
+      return
+    with self._lock:
+      counter = self._counters.get(name)
+      if counter is None:
+        counter = self._counters[name] = Counter()
+      counter.value += count
+
+  def observe(self, name, value, buckets=TIME_BUCKETS):
+    """Add value to the histogram name, created with buckets."""
+    if not self.enabled:
+      return
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = Histogram(buckets)
+      histogram.observe(value)
+
+  def timed(self, name):
+    """Return a context manager timing its block into histogram name."""
+    if not self.enabled:
+      return _NULL_TIMING
+    return _Timing(self, name)
+
+  def timed_function(self, name):
+    """Decorator timing every call of a function into histogram name."""
+    def decorator(func):
+      @functools.wraps(func)
+      def wrapper(*args, **kwargs):
+        if not self.enabled:
+          return func(*args, **kwargs)
+        with _Timing(self, name):
+          return func(*args, **kwargs)
+      return wrapper
+    return decorator
+
+  def report(self):
+    """Return all metrics as a dict suitable for JSON."""
+    with self._lock:
+      return {
+        'uptime': time.time() - self._started,
+        'counters': dict((name, counter.report())
+                         for name, counter in self._counters.iteritems()),
+        'histograms': dict((name, histogram.report())
+                           for name, histogram in self._histograms.iteritems()),
+      }
+
+  def dump(self, path):
+    """Write the report as JSON to path."""
+    handle = open(path, 'w')
+    try:
+      json.dump(self.report(), handle, indent=2, sort_keys=True)
+      handle.write('\n')
+    finally:
+      handle.close()
+
+  def start_logging(self, interval=LOG_INTERVAL):
+    """Log the report at debug level every interval seconds."""
+    def log():
+      while True:
+        time.sleep(interval)
+        logging.debug('Metrics: %s', json.dumps(self.report(), sort_keys=True))
+    thread = threading.Thread(target=log, name='metrics-log')
+    thread.daemon = True
+    thread.start()
+
+  def reset(self):
+    with self._lock:
+      self._counters.clear()
+      self._histograms.clear()
+      self._started = time.time()
+
+
+# The process wide registry used by the riffplayer modules
+REGISTRY = Registry()
+
+increment = REGISTRY.increment
+observe = REGISTRY.observe
+timed = REGISTRY.timed
+timed_function = REGISTRY.timed_function
+
+
+def enable():
+  """Start recording into the process wide registry."""
+  REGISTRY.enabled = True
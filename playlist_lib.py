@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import csv
+
+
+class Error(Exception):
+  """Base level error."""
+
+class OperationError(Error):
+  """Operation Error."""
+
+
+class PlaylistItem(object):
+  """A video and riff to be played together.
+
+  Attributes:
+    video_file, riff_file: paths of the media
+    sync_map: Future of the stored sync map, once it is being looked up
+    prefetch: Future of the prefetch_lib.RiffPrefetcher run for the riff,
+      once it is being prefetched
+  """
+
+  def __init__(self, video_file, riff_file):
+    self.video_file = video_file
+    self.riff_file = riff_file
+    self.sync_map = None
+    self.prefetch = None
+
+  def __repr__(self):
+    return 'PlaylistItem(%r, %r)' % (self.video_file, self.riff_file)
+
+
+class Playlist(object):
+  """An ordered queue of PlaylistItems with a current position.
+
+  Attributes:
+    items: list of PlaylistItem
+    position: index of the current item, -1 before the first
+  """
+
+  def __init__(self, items=()):
+    self.items = list(items)
+    self.position = -1
+
+  def add(self, video_file, riff_file):
+    """Append a pair and return its PlaylistItem."""
+    item = PlaylistItem(video_file, riff_file)
+    self.items.append(item)
+    return item
+
+  def current(self):
+    """Return the current item, or None."""
+    if 0 <= self.position < len(self.items):
+      return self.items[self.position]
+    return None
+
+  def peek(self):
+    """Return the item after the current one, or None."""
+    if self.position + 1 < len(self.items):
+      return self.items[self.position + 1]
+    return None
+
+  def advance(self):
+    """Move to and return the next item, or None at the end."""
+    item = self.peek()
+    if item is not None:
+      self.position += 1
+    return item
+
+  def load(self, path):
+    """Append the pairs listed in a file of video<TAB>riff lines.
+
+    Raises:
+      OperationError: if the file can not be read or a line is invalid
+    """
+    try:
+      handle = open(path, 'rb')
+    except IOError, e:
+      raise OperationError(e)
+    try:
+      for line_number, row in enumerate(
+          csv.reader(handle, delimiter='\t'), 1):
+        if not row or row[0].startswith('#'):
+          continue
+        if len(row) != 2:
+          raise OperationError('%s:%d: expected video<TAB>riff' % (
+            path, line_number))
+        self.add(*row)
+    except csv.Error, e:
+      raise OperationError('%s: %s' % (path, e))
+    finally:
+      handle.close()
+
+  def save(self, path):
+    """Write the pairs to a file readable by load()."""
+    try:
+      handle = open(path, 'wb')
+      try:
+        writer = csv.writer(handle, delimiter='\t', lineterminator='\n')
+        for item in self.items:
+          writer.writerow((item.video_file, item.riff_file))
+      finally:
+        handle.close()
+    except IOError, e:
+      raise OperationError(e)
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import array
+import logging
+import mmap
+import os
+import time
+
+import metrics_lib
+
+PREFETCH_BUDGET = 256 * 1048576 # bytes of a riff warmed at load time
+WARM_WINDOW = 1048576 # bytes warmed ahead of a seek
+POSIX_FADV_WILLNEED = 3
+
+# Bit rates in kbps by bit rate index, per (MPEG version 1?, layer)
+_BITRATES = {
+  (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+              416, 448),
+  (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+              384),
+  (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+              320),
+  (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+               256),
+  (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+  (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by sample rate index, per MPEG version field
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000),
+                 0: (11025, 12000, 8000)}
+
+
+class Error(Exception):
+  """Base level error."""
+
+class OperationError(Error):
+  """Operation Error."""
+
+
+def _load_fadvise():
+  """Return libc's posix_fadvise, or None where it is not available."""
+  import ctypes
+  import ctypes.util
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  except OSError:
+    return None
+  func = (getattr(libc, 'posix_fadvise64', None) or
+          getattr(libc, 'posix_fadvise', None))
+  if func is not None:
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                     ctypes.c_int]
+    func.restype = ctypes.c_int
+  return func
+
+_fadvise = None
+_fadvise_loaded = False
+
+
+def _get_fadvise():
+  """Return posix_fadvise, or None, loading it on first use.
+
+  Finding libc runs ldconfig, which is too slow for import time.
+  """
+  global _fadvise, _fadvise_loaded
+  if not _fadvise_loaded:
+    _fadvise = _load_fadvise()
+    _fadvise_loaded = True
+  return _fadvise
+
+
+def _parse_frame_header(header):
+  """Parse the 4 byte header of an MPEG audio frame.
+
+  Returns:
+    (frame length in bytes, samples, sample rate), or None if header is
+    not a valid frame header
+  """
+  if ord(header[0]) != 0xFF:
+    return None
+  b1, b2 = ord(header[1]), ord(header[2])
+  if b1 & 0xE0 != 0xE0:
+    return None
+  version = (b1 >> 3) & 3
+  layer = 4 - ((b1 >> 1) & 3)
+  bitrate_index = b2 >> 4
+  rate_index = (b2 >> 2) & 3
+  if (version == 1 or layer == 4 or bitrate_index in (0, 15)
+      or rate_index == 3):
+    return None
+  mpeg1 = version == 3
+  bitrate = _BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+  sample_rate = _SAMPLE_RATES[version][rate_index]
+  padding = (b2 >> 1) & 1
+  if layer == 1:
+    return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+  if layer == 3 and not mpeg1:
+    return 72 * bitrate // sample_rate + padding, 576, sample_rate
+  return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+
+
+def _id3v2_size(data):
+  """Return the size of the ID3v2 tag data starts with, if any."""
+  if data[:3] != 'ID3' or len(data) < 10:
+    return 0
+  size = 0
+  for byte in data[6:10]:
+    size = (size << 7) | (ord(byte) & 0x7F)
+  footer = ord(data[5]) & 0x10 and 10 or 0
+  return 10 + size + footer
+
+
+class Mp3SeekIndex(object):
+  """The byte offset of every second of an MP3 file.
+
+  VBR files have no fixed relation between time and byte position, so
+  finding the data for a position otherwise means walking the frames
+  from the start.
+
+  An index may cover only the start of a file, so that building it reads
+  no more than a prefetch budget. Positions past its end are estimated
+  from the mean bit rate of the indexed frames.
+
+  Attributes:
+    duration: length of the audio in milliseconds, estimated if the index
+      is partial
+    offsets: array of the byte offset of the frame playing at each second
+    complete: whether the whole file was indexed
+    byte_rate: mean bytes per second of the indexed frames
+    size: size of the file in bytes
+  """
+
+  def __init__(self, offsets, duration, complete=True, byte_rate=None,
+               size=None):
+    self.offsets = offsets
+    self.duration = duration
+    self.complete = complete
+    self.byte_rate = byte_rate
+    self.size = size
+
+  @classmethod
+  def build(cls, path, limit=None):
+    """Index the MP3 file at path by walking its frame headers.
+
+    Args:
+      path: path of the MP3 file
+      limit: if given, only frames starting in the first limit bytes are
+        indexed, so no more of the file is read
+
+    Raises:
+      OperationError: if the file can not be read or has no MPEG frames
+    """
+    try:
+      handle = open(path, 'rb')
+    except IOError, e:
+      raise OperationError(e)
+    try:
+      size = os.fstat(handle.fileno()).st_size
+      if not size:
+        raise OperationError('%s: empty file' % path)
+      data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, mmap.error), e:
+      raise OperationError(e)
+    finally:
+      handle.close()
+    try:
+      return cls._walk(data, size, limit)
+    finally:
+      data.close()
+
+  @classmethod
+  def _walk(cls, data, size, limit=None):
+    offsets = array.array('l')
+    position = _id3v2_size(data[:10])
+    end = size if limit is None else min(size, limit)
+    samples = 0
+    sample_rate = None
+    first = True
+    while position + 4 <= end:
+      frame = _parse_frame_header(data[position:position + 4])
+      if frame is None or position + frame[0] > size:
+        if data[position:position + 3] == 'TAG':
+          break # ID3v1 tag at the end
+        # Lost sync; look for the next frame header
+        position = data.find('\xff', position + 1)
+        if position < 0:
+          break
+        continue
+      length, frame_samples, sample_rate = frame
+      if first:
+        first = False
+        # A Xing/Info frame at the start carries no audio
+        if (data.find('Xing', position, position + length) >= 0 or
+            data.find('Info', position, position + length) >= 0):
+          position += length
+          continue
+      while len(offsets) * sample_rate <= samples:
+        offsets.append(position)
+      samples += frame_samples
+      position += length
+    if sample_rate is None or not offsets:
+      raise OperationError('No MPEG audio frames found')
+    duration = samples * 1000.0 / sample_rate
+    byte_rate = (position - offsets[0]) * 1000.0 / duration
+    if end == size:
+      return cls(offsets, duration, True, byte_rate, size)
+    logging.debug('Indexed %.0f s in the first %d of %d bytes',
+                  duration / 1000, position, size)
+    return cls(offsets, duration + (size - position) * 1000.0 / byte_rate,
+               False, byte_rate, size)
+
+  def byte_offset(self, position):
+    """Return the byte offset of the audio at position milliseconds."""
+    second = max(0, int(position // 1000))
+    if second < len(self.offsets):
+      return self.offsets[second]
+    if self.complete:
+      return self.offsets[-1]
+    beyond = (second - len(self.offsets) + 1) * self.byte_rate
+    return min(self.size - 1, self.offsets[-1] + int(beyond))
+
+
+class RiffPrefetcher(object):
+  """Warms the page cache for a riff and indexes it for seeking.
+
+  run() is meant for a background thread; it reads at most budget bytes
+  of the file into the page cache, using posix_fadvise where available
+  and touching an mmap of the file otherwise, and indexes the frames of
+  MP3 files within those bytes.
+  Afterwards warm() asks for the data around a seek target. It only
+  issues the posix_fadvise hint, which does not wait for the data, so it
+  is safe to call from the GUI thread; without posix_fadvise it does
+  nothing.
+
+  Attributes:
+    index: Mp3SeekIndex, once run() indexed an MP3 file
+    warmed: bytes of the file warmed by run()
+    elapsed: seconds taken by run()
+    method: 'fadvise' or 'mmap', once run() started
+  """
+
+  def __init__(self, path, budget=PREFETCH_BUDGET, window=WARM_WINDOW):
+    self.path = path
+    self.budget = budget
+    self.window = window
+    self.index = None
+    self.warmed = 0
+    self.elapsed = None
+    self.method = None
+
+  def run(self):
+    """Prefetch and index the riff.
+
+    Returns:
+      self
+
+    Raises:
+      OperationError: if the file could not be read
+    """
+    start = time.time()
+    self.method = _get_fadvise() and 'fadvise' or 'mmap'
+    try:
+      size = os.path.getsize(self.path)
+    except OSError, e:
+      raise OperationError(e)
+    self.warmed = min(size, self.budget)
+    if self.warmed:
+      self._advise(0, self.warmed)
+    if self.warmed and os.path.splitext(self.path)[1].lower() == '.mp3':
+      try:
+        self.index = Mp3SeekIndex.build(self.path, self.warmed)
+      except OperationError, e:
+        logging.warning('Unable to index %s: %s', self.path, e)
+    self.elapsed = time.time() - start
+    metrics_lib.observe('prefetch.time', self.elapsed)
+    logging.info('Prefetched %d bytes of %s in %.0f ms (%s%s)', self.warmed,
+                 self.path, self.elapsed * 1000, self.method,
+                 self.index and ', indexed' or '')
+    return self
+
+  def warm(self, position):
+    """Ask for the data at position milliseconds ahead of a seek."""
+    if self.index is None or _get_fadvise() is None:
+      return
+    try:
+      self._advise(self.index.byte_offset(position), self.window, touch=False)
+    except OperationError, e:
+      logging.debug('Unable to warm %s: %s', self.path, e)
+
+  def _advise(self, offset, length, touch=True):
+    """Bring length bytes from offset into the page cache.
+
+    Args:
+      offset, length: the range of the file to bring in
+      touch: read the range through an mmap if posix_fadvise is not
+        available or fails; otherwise return without waiting for it
+    """
+    try:
+      handle = open(self.path, 'rb')
+    except IOError, e:
+      raise OperationError(e)
+    try:
+      length = min(length, os.fstat(handle.fileno()).st_size - offset)
+      if length <= 0:
+        return
+      fadvise = _get_fadvise()
+      if fadvise is not None:
+        if not fadvise(handle.fileno(), offset, length, POSIX_FADV_WILLNEED):
+          return
+      if touch:
+        self._touch(handle, offset, length)
+    finally:
+      handle.close()
+
+  def _touch(self, handle, offset, length):
+    """Fault in a page at a time from an mmap of the file."""
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    try:
+      data = mmap.mmap(handle.fileno(), length + offset - start,
+                       access=mmap.ACCESS_READ, offset=start)
+    except (EnvironmentError, mmap.error, ValueError), e:
+      raise OperationError(e)
+    try:
+      for page in xrange(offset - start, len(data), mmap.PAGESIZE):
+        data[page]
+    finally:
+      data.close()
@@ -0,0 +1,991 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the riffplayer support libraries.
+
+Usage: riffbench.py [options] <benchmark> [<benchmark> ...]
+
+Run with no arguments to list the available benchmarks.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+import BaseHTTPServer
+import cgi
+import hashlib
+import httplib
+import json
+import logging
+import optparse
+import os
+import resource
+import random
+import shutil
+import socket
+import SocketServer
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import wave
+
+import align_lib
+import db_lib
+import metrics_lib
+import prefetch_lib
+import server_lib
+import sim_lib
+import sync_lib
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+  """Register func as a benchmark, named after the function."""
+  BENCHMARKS[func.__name__.replace('bench_', '')] = func
+  return func
+
+
+def _peak_rss_kb():
+  """Return the peak resident set size of this process in kilobytes."""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    peak /= 1024
+  return peak
+
+
+def _make_file(directory, name, size):
+  """Create a file of size pseudo-random bytes and return its path."""
+  path = os.path.join(directory, name)
+  block = os.urandom(1048576)
+  handle = open(path, 'wb')
+  try:
+    while size > 0:
+      handle.write(block[:size])
+      size -= len(block)
+  finally:
+    handle.close()
+  return path
+
+
+def _percentile(values, fraction):
+  """Return the value at fraction (0..1) of the sorted values."""
+  values = sorted(values)
+  if not values:
+    return 0.0
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Speaks the RemoteRiffDatabase protocol against an in-memory dict."""
+
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections += 1
+
+  def do_GET(self):
+    params = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+    key = (params.get('video_hash', [''])[0], params.get('audio_hash', [''])[0])
+    self._reply(self.server.offsets.get(key, ''))
+
+  def do_POST(self):
+    length = int(self.headers.getheader('Content-Length', 0))
+    body = self.rfile.read(length)
+    if self.path.endswith('/batch'):
+      return self._batch(urlparse.parse_qsl(body))
+    params = cgi.parse_qs(body)
+    key = (params['video_hash'][0], params['audio_hash'][0])
+    self.server.offsets[key] = params['offset'][0]
+    self._reply('')
+
+  def _batch(self, params):
+    if not self.server.batch:
+      return self._reply('', 404)
+    op = params.pop(0)[1]
+    values = [value for _, value in params]
+    if op == 'get':
+      keys = zip(values[::2], values[1::2])
+      self._reply('\n'.join(self.server.offsets.get(key, '') for key in keys))
+    else:
+      for i in xrange(0, len(values), 3):
+        self.server.offsets[tuple(values[i:i + 2])] = values[i + 2]
+      self._reply('')
+
+  def _reply(self, body, status=200):
+    if self.server.delay:
+      time.sleep(self.server.delay)
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A local stand-in for the offset server which counts TCP connections.
+
+  Attributes:
+    connections: number of TCP connections accepted
+    offsets: dict of (video_hash, audio_hash) -> offset string
+    delay: seconds to wait before answering each request
+    batch: whether the batch endpoint is supported
+  """
+
+  daemon_threads = True
+
+  def __init__(self, delay=0, batch=True):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInHandler)
+    self.connections = 0
+    self.offsets = {}
+    self.delay = delay
+    self.batch = batch
+    thread = threading.Thread(target=self.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:%d/db' % self.server_address[1]
+
+
+def _legacy_calculate_hash(filename):
+  """The original, whole-sample-in-memory implementation of calculate_hash."""
+  hash_val = hashlib.md5()
+  hash_val.update(open(filename).read(db_lib.HASH_SAMPLE_SIZE))
+  return hash_val.hexdigest()
+
+
+_HASH_IMPLS = {
+  'legacy': _legacy_calculate_hash,
+  'chunked': db_lib.calculate_hash,
+  'mmap': lambda filename: db_lib.calculate_hash(filename, use_mmap=True),
+}
+
+
+def _run_hash_impl(impl, filename, rounds):
+  """Child process side of the hash benchmark; prints digest, secs, rss."""
+  baseline_rss = _peak_rss_kb()
+  start = time.time()
+  for _ in xrange(rounds):
+    digest = _HASH_IMPLS[impl](filename)
+  elapsed = time.time() - start
+  print digest, elapsed, _peak_rss_kb() - baseline_rss
+
+
+@benchmark
+def bench_hash(options):
+  """Compare throughput and peak RSS of the calculate_hash variants."""
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    path = _make_file(tmp_dir, 'sample.bin', db_lib.HASH_SAMPLE_SIZE + 4096)
+    sample_mb = db_lib.HASH_SAMPLE_SIZE / 1048576.0
+    digests = set()
+    for impl in ('legacy', 'chunked', 'mmap'):
+      # Each variant runs in a fresh interpreter so that peak RSS is not
+      # polluted by the variants that ran before it.
+      output = subprocess.Popen(
+        [sys.executable, __file__, '--hash-child', impl, '--rounds',
+         str(options.rounds), path], stdout=subprocess.PIPE).communicate()[0]
+      digest, elapsed, rss_kb = output.split()
+      digests.add(digest)
+      print '%-8s %8.1f MB/s  peak rss +%6d KB' % (
+        impl, sample_mb * options.rounds / float(elapsed), int(rss_kb))
+    print 'digests match: %s' % (len(digests) == 1)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def _legacy_get_offset(url, video_hash, audio_hash):
+  """The original urlopen-per-call implementation of _get_offset."""
+  data = urllib.urlencode(dict(video_hash=video_hash, audio_hash=audio_hash))
+  response = urllib2.urlopen('%s?%s' % (url, data)).read()
+  return float(response) if response else None
+
+
+@benchmark
+def bench_remote(options):
+  """Compare urlopen-per-call with the pooled HttpTransport."""
+  server = StandInServer()
+  server.offsets[('v', 'a')] = '1500.0'
+  calls = options.rounds * 200
+  try:
+    start_connections = server.connections
+    latencies = []
+    for _ in xrange(calls):
+      start = time.time()
+      _legacy_get_offset(server.url, 'v', 'a')
+      latencies.append(time.time() - start)
+    _report_remote('urlopen', calls, latencies,
+                   server.connections - start_connections)
+
+    start_connections = server.connections
+    db = db_lib.RemoteRiffDatabase(server.url, offset_cache_size=0)
+    for _ in xrange(calls):
+      db.get_hashed_offset('v', 'a')
+    _report_remote('pooled', calls, db.transport.latencies,
+                   server.connections - start_connections)
+    db.transport.close()
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def _report_remote(name, calls, latencies, connections):
+  print '%-8s %6d calls %8.0f req/s  p50 %6.2f ms  p99 %6.2f ms  %5d conns' % (
+    name, calls, calls / sum(latencies), _percentile(latencies, 0.5) * 1000,
+    _percentile(latencies, 0.99) * 1000, connections)
+
+
+def _hash_triples(count):
+  """Return count distinct (video_hash, audio_hash, offset) triples."""
+  return [(hashlib.md5('v%d' % i).hexdigest(), hashlib.md5('a%d' % i).hexdigest(),
+           float(i)) for i in xrange(count)]
+
+
+def _time_batch(name, count, db, triples):
+  """Time per-pair and batched stores and lookups of triples against db."""
+  pairs = [triple[:2] for triple in triples]
+  start = time.time()
+  for video_hash, audio_hash, offset in triples:
+    db.add_hashed_offset(video_hash, audio_hash, offset)
+  single_add = time.time() - start
+  start = time.time()
+  for video_hash, audio_hash in pairs:
+    db.get_hashed_offset(video_hash, audio_hash)
+  single_get = time.time() - start
+  start = time.time()
+  db.add_hashed_offsets(triples)
+  batch_add = time.time() - start
+  start = time.time()
+  offsets = db.get_hashed_offsets(pairs)
+  batch_get = time.time() - start
+  assert offsets == [triple[2] for triple in triples]
+  print '%-7s per-pair add %8.0f/s get %8.0f/s   batch add %8.0f/s get %8.0f/s' % (
+    name, count / single_add, count / single_get, count / batch_add,
+    count / batch_get)
+
+
+@benchmark
+def bench_batch(options):
+  """Compare per-pair and batched offset operations for 10k pairs.
+
+  The offset caches are disabled so that every lookup reaches the backend.
+  """
+  count = 10000
+  triples = _hash_triples(count)
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    _time_batch('local', count, db_lib.LocalRiffDatabase(
+      os.path.join(tmp_dir, 'bench.sqlite'), offset_cache_size=0), triples)
+  finally:
+    shutil.rmtree(tmp_dir)
+  server = StandInServer()
+  try:
+    db = db_lib.RemoteRiffDatabase(server.url, offset_cache_size=0)
+    _time_batch('remote', count, db, triples)
+    db.transport.close()
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def _time_lookups(db, video_path, riff_path, calls, method='get_offset'):
+  """Return the mean seconds of calls repeated lookups of a pair.
+
+  Args:
+    method: name of the database method to look the pair up with
+  """
+  lookup = getattr(db, method)
+  start = time.time()
+  for _ in xrange(calls):
+    lookup(video_path, riff_path)
+  return (time.time() - start) / calls
+
+
+@benchmark
+def bench_cache(options):
+  """Repeated lookups of one pair with and without the in-memory caches."""
+  calls = 10000
+  tmp_dir = tempfile.mkdtemp()
+  server = StandInServer()
+  try:
+    video_path = _make_file(tmp_dir, 'video.avi', 4194304)
+    riff_path = _make_file(tmp_dir, 'riff.mp3', 1048576)
+    for name, size in (('uncached', 0), ('cached', db_lib.OFFSET_CACHE_SIZE)):
+      db = db_lib.LocalRiffDatabase(os.path.join(tmp_dir, name + '.sqlite'),
+                                    offset_cache_size=size)
+      db.add_offset(video_path, riff_path, 1500)
+      if not size:
+        db.hash_cache._memory.capacity = 0
+      local = _time_lookups(db, video_path, riff_path, calls)
+      # The player looks pairs up through get_sync_map
+      local_map = _time_lookups(db, video_path, riff_path, calls,
+                                'get_sync_map')
+      remote = db_lib.RemoteRiffDatabase(server.url, db.hash_cache,
+                                         offset_cache_size=size)
+      remote.add_offset(video_path, riff_path, 1500)
+      remote_mean = _time_lookups(remote, video_path, riff_path, calls // 10)
+      remote.transport.close()
+      cache = db.offset_cache or db_lib.LRUCache(0)
+      print ('%-8s local %8.1f us  sync map %8.1f us  remote %8.1f us  '
+             'hits %d misses %d evictions %d' % (
+               name, local * 1e6, local_map * 1e6, remote_mean * 1e6,
+               cache.hits, cache.misses, cache.evictions))
+  finally:
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(tmp_dir)
+
+
+def _stress_loop(func, pairs, stop, seed, results, errors):
+  """Call func on random pairs until stop is set, recording the outcome."""
+  rng = random.Random(seed)
+  calls = 0
+  while not stop.isSet():
+    try:
+      func(*rng.choice(pairs))
+    except (sqlite3.Error, db_lib.Error), e:
+      errors.append(str(e))
+    calls += 1
+  results.append(calls)
+
+
+@benchmark
+def bench_concurrency(options):
+  """Parallel readers against two writers sharing a LocalRiffDatabase file."""
+  seconds = 2.0
+  triples = _hash_triples(10000)
+  pairs = [triple[:2] for triple in triples]
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmp_dir, 'bench.sqlite')
+    db = db_lib.LocalRiffDatabase(path, offset_cache_size=0)
+    db.add_hashed_offsets(triples)
+    # A second handle writes as another process would, through its own
+    # writer connection, so writers also contend inside Sqlite.
+    other = db_lib.LocalRiffDatabase(path, offset_cache_size=0)
+    write = lambda video_hash, audio_hash: db.add_hashed_offset(
+      video_hash, audio_hash, random.random())
+    other_write = lambda video_hash, audio_hash: other.add_hashed_offset(
+      video_hash, audio_hash, random.random())
+    for readers in (1, 2, 4, 8):
+      stop = threading.Event()
+      reads, writes, errors = [], [], []
+      threads = [threading.Thread(target=_stress_loop, args=(
+        db.get_hashed_offset, pairs, stop, i, reads, errors))
+                 for i in xrange(readers)]
+      threads += [threading.Thread(target=_stress_loop, args=(
+        func, pairs, stop, -i, writes, errors))
+                  for i, func in enumerate((write, other_write))]
+      for thread in threads:
+        thread.start()
+      time.sleep(seconds)
+      stop.set()
+      for thread in threads:
+        thread.join()
+      locked = len([error for error in errors if 'locked' in error])
+      print ('%d readers %9.0f reads/s %8.0f writes/s  '
+             'locked errors %d  other errors %d' % (
+               readers, sum(reads) / seconds, sum(writes) / seconds, locked,
+               len(errors) - locked))
+      assert locked == 0, 'database is locked %d times' % locked
+      assert not errors, errors[:5]
+    other.close()
+    db.close()
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def _load_client(address, path, pairs, stop, seed, latencies, errors):
+  """Send a 9:1 mix of lookups and stores over one kept-alive connection."""
+  rng = random.Random(seed)
+  con = httplib.HTTPConnection(*address)
+  while not stop.isSet():
+    video_hash, audio_hash = rng.choice(pairs)
+    start = time.time()
+    try:
+      if rng.random() < 0.9:
+        con.request('GET', '%s?%s' % (path, urllib.urlencode(
+          dict(video_hash=video_hash, audio_hash=audio_hash))))
+      else:
+        con.request('POST', path, urllib.urlencode(dict(
+          video_hash=video_hash, audio_hash=audio_hash, offset=rng.random())),
+                    {'Content-Type': 'application/x-www-form-urlencoded'})
+      response = con.getresponse()
+      response.read()
+      if response.status != httplib.OK:
+        errors.append(response.status)
+    except (httplib.HTTPException, socket.error), e:
+      errors.append(str(e))
+      con.close()
+      con = httplib.HTTPConnection(*address)
+    latencies.append(time.time() - start)
+  con.close()
+
+
+@benchmark
+def bench_server(options):
+  """Load test riffserver at several concurrency levels (--rows offsets)."""
+  seconds = 2.0
+  triples = _hash_triples(options.rows)
+  pairs = [triple[:2] for triple in triples]
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    db = db_lib.LocalRiffDatabase(os.path.join(tmp_dir, 'bench.sqlite'),
+                                  offset_cache_size=server_lib.HOT_CACHE_SIZE)
+    db.import_offsets(triples)
+    server = server_lib.OffsetServer(('127.0.0.1', 0), db)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+      for clients in (1, 4, 16, 64):
+        stop = threading.Event()
+        latencies, errors = [], []
+        threads = [threading.Thread(target=_load_client, args=(
+          server.server_address, '/db', pairs, stop, i, latencies, errors))
+                   for i in xrange(clients)]
+        for client in threads:
+          client.start()
+        time.sleep(seconds)
+        stop.set()
+        for client in threads:
+          client.join()
+        print '%2d clients %8.0f req/s  p50 %6.2f ms  p99 %6.2f ms  %d errors' % (
+          clients, len(latencies) / seconds, _percentile(latencies, 0.5) * 1000,
+          _percentile(latencies, 0.99) * 1000, len(errors))
+      stats = server.stats()
+      print 'cache hits %d misses %d, %d offsets in %d commits' % (
+        stats['cache']['hits'], stats['cache']['misses'],
+        stats['writer']['committed'], stats['writer']['commits'])
+    finally:
+      server.shutdown()
+      server.server_close()
+      db.close()
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def _time_legacy_probe(url, limit):
+  """Time the original blocking urlopen probe, giving up after limit secs."""
+  thread = threading.Thread(target=lambda: urllib2.urlopen(url).read())
+  thread.setDaemon(True)
+  start = time.time()
+  thread.start()
+  thread.join(limit)
+  return time.time() - start, thread.isAlive()
+
+
+@benchmark
+def bench_startup(options):
+  """Time to a usable database handle against a hanging remote server."""
+  limit = 10.0
+  server = StandInServer(delay=3600)
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    elapsed, hung = _time_legacy_probe(server.url, limit)
+    print 'urlopen probe      %8.1f ms%s' % (
+      elapsed * 1000, hung and ' (still blocked, gave up)' or '')
+    start = time.time()
+    db = db_lib.ProbingRiffDatabase(server.url,
+                                    os.path.join(tmp_dir, 'bench.sqlite'),
+                                    timeout=0.5)
+    handle_ready = time.time() - start
+    db.get_hashed_offset('v', 'a')
+    first_lookup = time.time() - start
+    # Saved while the probe is still running
+    db.add_hashed_offset('v', 'a', 1234.0)
+    remote = db.wait_for_probe()
+    probe_done = time.time() - start
+    print 'handle returned    %8.1f ms' % (handle_ready * 1000)
+    print 'first lookup done  %8.1f ms' % (first_lookup * 1000)
+    print 'probe finished     %8.1f ms (remote used: %s)' % (
+      probe_done * 1000, remote)
+    assert db.get_hashed_offset('v', 'a') == 1234.0
+    assert [entry[:3] for entry in db.current.outbox.pending()] == [
+      ('v', 'a', 1234.0)]
+    db.current.close()
+  finally:
+    shutil.rmtree(tmp_dir)
+    server.shutdown()
+    server.server_close()
+
+
+def _time_import(modules, rounds):
+  """Return the best wall time in seconds of a fresh process importing."""
+  code = ('import time; start = time.time(); import %s; '
+          'print time.time() - start' % ', '.join(modules))
+  times = []
+  for _ in xrange(rounds):
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=os.path.dirname(__file__) or '.')
+    times.append(float(output))
+  return min(times)
+
+
+@benchmark
+def bench_imports(options):
+  """Import time of the modules on the player's startup path."""
+  player = ['metrics_lib', 'playlist_lib', 'prefetch_lib', 'sync_lib',
+            'worker_lib']
+  eager = _time_import(player + ['db_lib'], options.rounds)
+  lazy = _time_import(player, options.rounds)
+  print 'with db_lib        %8.1f ms' % (eager * 1000)
+  print 'db_lib deferred    %8.1f ms' % (lazy * 1000)
+
+
+@benchmark
+def bench_first_paint(options):
+  """Time from launch to the painted window and to its loaded bitmaps."""
+  try:
+    import wx
+  except ImportError:
+    print 'wx is not installed'
+    return
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    # The player runs in tmp_dir, with a copy of its bitmaps, so its
+    # database is created there, and probes a remote which refuses
+    # connections instead of the real one.
+    src_dir = os.path.abspath(os.path.dirname(__file__) or '.')
+    shutil.copytree(os.path.join(src_dir, 'res'),
+                    os.path.join(tmp_dir, 'res'))
+    stats = os.path.join(tmp_dir, 'stats.json')
+    first_paint = []
+    bitmaps = []
+    for _ in xrange(options.rounds):
+      subprocess.check_call(
+        [sys.executable, os.path.join(src_dir, 'riffplayer.py'),
+         '--exit-after-startup', '--stats', stats,
+         '--db', os.path.join(tmp_dir, 'riffdb.sqlite'),
+         '--remote', 'http://127.0.0.1:1/db'], cwd=tmp_dir)
+      handle = open(stats)
+      try:
+        histograms = json.load(handle)['histograms']
+      finally:
+        handle.close()
+      first_paint.append(histograms['startup.first_paint']['max'])
+      bitmaps.append(histograms['startup.bitmaps']['max'])
+    print 'first paint        %8.1f ms' % (min(first_paint) * 1000)
+    print 'bitmaps loaded     %8.1f ms' % (min(bitmaps) * 1000)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+@benchmark
+def bench_import(options):
+  """Bulk import and export rates of LocalRiffDatabase (--rows rows)."""
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    csv_path = os.path.join(tmp_dir, 'offsets.csv')
+    handle = open(csv_path, 'wb')
+    db_lib.write_offsets(
+      ((hashlib.md5('v%d' % i).hexdigest(), hashlib.md5('a%d' % i).hexdigest(),
+        float(i)) for i in xrange(options.rows)), handle, 'csv')
+    handle.close()
+    db = db_lib.LocalRiffDatabase(os.path.join(tmp_dir, 'bench.sqlite'))
+    start = time.time()
+    handle = open(csv_path, 'rb')
+    count = db.import_offsets(db_lib.read_offsets(handle, 'csv'))
+    handle.close()
+    elapsed = time.time() - start
+    print 'import %8d rows %6.1f s %9.0f rows/s' % (count, elapsed,
+                                                   count / elapsed)
+    start = time.time()
+    count = db_lib.write_offsets(db.export_offsets(),
+                                 open(os.devnull, 'wb'), 'csv')
+    elapsed = time.time() - start
+    print 'export %8d rows %6.1f s %9.0f rows/s' % (count, elapsed,
+                                                   count / elapsed)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+_POSIX_FADV_DONTNEED = 4
+
+# The Offsets table as created before schema version 2
+_V1_SCHEMA_SQL = """
+CREATE TABLE `Offsets`(
+  `VideoFileHash` TEXT NOT NULL,
+  `AudioFileHash` TEXT NOT NULL,
+  `Offset` REAL NOT NULL,
+  `SyncMap` BLOB);
+CREATE UNIQUE INDEX `Offsets-VideoAudio`
+  ON `Offsets`(VideoFileHash,AudioFileHash);
+"""
+
+
+def _write_v1_db(path, triples):
+  """Create a schema version 1 database holding triples."""
+  con = sqlite3.connect(path)
+  # The pragmas LocalRiffDatabase imports with, for a fair comparison
+  con.executescript(db_lib.LocalRiffDatabase._PRAGMA_SQL)
+  con.executescript(db_lib.LocalRiffDatabase._IMPORT_PRAGMA_SQL)
+  con.executescript(_V1_SCHEMA_SQL)
+  con.executemany('INSERT INTO Offsets(VideoFileHash, AudioFileHash, Offset) '
+                  'VALUES(?, ?, ?)', triples)
+  con.commit()
+  con.close()
+
+
+def _drop_page_cache(path):
+  """Ask the OS to forget the cached pages of path, where supported."""
+  fadvise = prefetch_lib._get_fadvise()
+  if fadvise is None:
+    return
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    fadvise(fd, 0, 0, _POSIX_FADV_DONTNEED)
+  finally:
+    os.close(fd)
+
+
+def _time_cold_lookups(path, pairs, encode=lambda key: key):
+  """Time lookups of pairs, each on a fresh connection to path.
+
+  Both schemas are queried with the same plain SQL, so that only the
+  table layout differs; encode converts keys to their stored form.
+  """
+  latencies = []
+  for video_hash, audio_hash in pairs:
+    _drop_page_cache(path)
+    con = sqlite3.connect(path)
+    start = time.time()
+    con.execute('SELECT Offset FROM Offsets WHERE VideoFileHash = ? AND '
+                'AudioFileHash = ?',
+                (encode(video_hash), encode(audio_hash))).fetchone()
+    latencies.append(time.time() - start)
+    con.close()
+  return latencies
+
+
+@benchmark
+def bench_schema(options):
+  """File size, insert rate and cold lookups of schema v1 and v2 (--rows)."""
+  triples = _hash_triples(options.rows)
+  probes = random.Random(1).sample(triples, min(200, len(triples)))
+  probes = [triple[:2] for triple in probes]
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    v1_path = os.path.join(tmp_dir, 'v1.sqlite')
+    start = time.time()
+    _write_v1_db(v1_path, triples)
+    v1_insert = time.time() - start
+    v1_size = os.path.getsize(v1_path)
+    v2_path = os.path.join(tmp_dir, 'v2.sqlite')
+    db = db_lib.LocalRiffDatabase(v2_path)
+    start = time.time()
+    db.import_offsets(triples)
+    v2_insert = time.time() - start
+    db.close()
+    v2_size = os.path.getsize(v2_path)
+    v1_cold = _time_cold_lookups(v1_path, probes)
+    v2_cold = _time_cold_lookups(v2_path, probes, db_lib._encode_key)
+    for name, size, insert, cold in (('v1', v1_size, v1_insert, v1_cold),
+                                     ('v2', v2_size, v2_insert, v2_cold)):
+      print '%s %8d rows %7.1f MB %9.0f rows/s  cold p50 %6.3f ms  p99 %6.3f ms' % (
+        name, len(triples), size / 1048576.0, len(triples) / insert,
+        _percentile(cold, 0.5) * 1000, _percentile(cold, 0.99) * 1000)
+    start = time.time()
+    db_lib.LocalRiffDatabase(v1_path).close()
+    print 'migrated v1 to v2 in %.1f s, %.1f MB' % (
+      time.time() - start, os.path.getsize(v1_path) / 1048576.0)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+# Worst accepted offset estimate on the synthetic signals: half an
+# envelope sample
+ALIGN_MAX_ERROR = 500.0 / align_lib.ENVELOPE_RATE # ms
+ALIGN_MIN_CONFIDENCE = 0.5
+
+
+def _synthetic_audio(seconds, rate, seed):
+  """Return mono float samples of random noise bursts over quiet noise."""
+  numpy = align_lib.numpy
+  rng = numpy.random.RandomState(seed)
+  samples = rng.normal(0, 200, seconds * rate)
+  for start in rng.randint(0, len(samples) - rate, seconds * 2):
+    length = rng.randint(rate // 50, rate // 4)
+    samples[start:start + length] += rng.normal(0, 6000, length)
+  return samples
+
+
+def _write_wav(path, samples, rate, channels=1):
+  """Write float samples as 16 bit PCM, duplicated to channels."""
+  numpy = align_lib.numpy
+  pcm = numpy.clip(samples, -32768, 32767).astype('<i2')
+  if channels > 1:
+    pcm = numpy.repeat(pcm, channels)
+  wav = wave.open(path, 'wb')
+  wav.setnchannels(channels)
+  wav.setsampwidth(2)
+  wav.setframerate(rate)
+  wav.writeframes(pcm.tostring())
+  wav.close()
+
+
+@benchmark
+def bench_align(options):
+  """Offset detection accuracy on synthetic signals and 2 hour timing."""
+  if align_lib.numpy is None:
+    print 'numpy is not installed'
+    return
+  numpy = align_lib.numpy
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    rate = 8000
+    video = _synthetic_audio(120, rate, 1)
+    video_path = os.path.join(tmp_dir, 'video.wav')
+    _write_wav(video_path, video, rate, channels=2)
+    for shift_ms in (-15000.0, -1234.5, 0.0, 420.0, 33333.3):
+      # The riff is the film audio shifted by shift_ms, quieter, over
+      # louder independent commentary, at a different sample rate.
+      riff_rate = 11025
+      shift = int(round(shift_ms * riff_rate / 1000.0))
+      film = numpy.interp(numpy.arange(len(video) * riff_rate // rate)
+                          * float(rate) / riff_rate,
+                          numpy.arange(len(video)), video) * 0.3
+      if shift >= 0:
+        film = numpy.concatenate([numpy.zeros(shift), film])
+      else:
+        film = film[-shift:]
+      riff = film + _synthetic_audio(len(film) // riff_rate + 1, riff_rate,
+                                     2)[:len(film)]
+      riff_path = os.path.join(tmp_dir, 'riff.wav')
+      _write_wav(riff_path, riff, riff_rate)
+      start = time.clock()
+      alignment = align_lib.estimate_offset(video_path, riff_path)
+      print 'shift %9.1f ms  estimate %9.1f ms  error %6.1f ms  ' \
+            'confidence %.2f  cpu %.2fs' % (
+              shift_ms, alignment.offset, alignment.offset - shift_ms,
+              alignment.confidence, time.clock() - start)
+      assert abs(alignment.offset - shift_ms) <= ALIGN_MAX_ERROR, shift_ms
+      assert alignment.confidence >= ALIGN_MIN_CONFIDENCE, shift_ms
+
+    seconds = 2 * 3600
+    long_path = os.path.join(tmp_dir, 'long.wav')
+    _write_wav(long_path, _synthetic_audio(600, 44100, 3), 44100, channels=2)
+    start = time.clock()
+    align_lib.wav_envelope(long_path)
+    envelope_cpu = time.clock() - start
+    print 'envelope of 10 min 44.1kHz stereo: cpu %.2fs (x12 for 2 hours)' % (
+      envelope_cpu)
+    rng = numpy.random.RandomState(4)
+    video_env = rng.exponential(1.0, seconds * align_lib.ENVELOPE_RATE)
+    riff_env = numpy.concatenate([rng.exponential(1.0, 4321), video_env])
+    riff_env += rng.exponential(1.0, len(riff_env))
+    start = time.clock()
+    alignment = align_lib.envelope_offset(video_env, riff_env)
+    print 'correlation of 2 hour envelopes: offset %.1f ms (expected 43210), ' \
+          'cpu %.2fs' % (alignment.offset, time.clock() - start)
+    assert abs(alignment.offset - 43210) <= ALIGN_MAX_ERROR
+    assert alignment.confidence >= ALIGN_MIN_CONFIDENCE
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+_SLOW_SEEK = {'rate_error': 0.002, 'jitter': 5, 'seek_latency': 400}
+_SLOW_NO_RATE = dict(_SLOW_SEEK, rate_supported=False)
+_NO_LEAD = {'compensate_seeks': False}
+# (name, riff SimulatedMedia options, sync map rate, video seek interval,
+#  SyncController options)
+SYNC_SCENARIOS = [
+  ('ideal', {}, 1.0, None, {}),
+  ('skew', {'rate_error': 0.002, 'jitter': 5}, 1.0, None, {}),
+  ('jitter', {'rate_error': 0.0005, 'jitter': 30, 'tell_resolution': 10},
+   1.0, None, {}),
+  ('pal', {'jitter': 5}, sync_lib.PAL_SPEEDUP, None, {}),
+  ('seeking', {'rate_error': 0.002, 'jitter': 5, 'seek_latency': 150},
+   1.0, 600000, {}),
+  ('no-rate', {'rate_error': 0.002, 'jitter': 5, 'rate_supported': False},
+   1.0, None, {}),
+  ('slow-seek', _SLOW_SEEK, 1.0, 300000, {}),
+  ('  no lead', _SLOW_SEEK, 1.0, 300000, _NO_LEAD),
+  ('slow-norate', _SLOW_NO_RATE, 1.0, None, {}),
+  ('  no lead', _SLOW_NO_RATE, 1.0, None, _NO_LEAD),
+]
+_SIM_HOUR = 3600000
+# Most riff rate changes accepted per simulated hour in any scenario
+SYNC_MAX_RATE_CHANGES = 400
+_SIM_STEP = 20
+_DRIFT_SAMPLE = 100
+
+
+def _simulate_sync(riff_options, map_rate, seek_interval, controller_options):
+  """Play a simulated hour and return (drifts, riff, engine, cpu seconds)."""
+  clock = sim_lib.SimulatedTime()
+  video = sim_lib.SimulatedMedia(clock, _SIM_HOUR * 2, jitter=2, seed=1)
+  riff = sim_lib.SimulatedMedia(clock, _SIM_HOUR * 3, seed=2, **riff_options)
+  engine = sync_lib.SyncEngine(video, riff, **controller_options)
+  rng = random.Random(3)
+  cpu = 0.0
+  start = time.clock()
+  engine.set_sync_map(sync_lib.SyncMap([(0, 5000, map_rate)]))
+  video.Play()
+  riff.Play()
+  engine.start()
+  cpu += time.clock() - start
+  drifts = []
+  for now in xrange(_SIM_STEP, _SIM_HOUR + 1, _SIM_STEP):
+    clock.advance(_SIM_STEP)
+    if seek_interval and now % seek_interval == 0:
+      video.Seek(rng.uniform(0, _SIM_HOUR))
+      start = time.clock()
+      engine.apply()
+      cpu += time.clock() - start
+    if now % sync_lib.SYNC_INTERVAL == 0:
+      start = time.clock()
+      engine.tick()
+      cpu += time.clock() - start
+    if now % _DRIFT_SAMPLE == 0:
+      target = engine.sync_map.riff_position(video.position)
+      drifts.append(abs(riff.position - target))
+  return drifts, riff, engine, cpu
+
+
+@benchmark
+def bench_sync(options):
+  """Sync accuracy of SyncEngine over a simulated hour per scenario."""
+  print '%-11s %8s %8s %8s %6s %6s %8s %11s' % (
+    'scenario', 'mean ms', 'p99 ms', 'max ms', 'seeks', 'rates',
+    'lat err', 'cpu ms/hour')
+  for (name, riff_options, map_rate, seek_interval,
+       controller_options) in SYNC_SCENARIOS:
+    drifts, riff, engine, cpu = _simulate_sync(
+      riff_options, map_rate, seek_interval, controller_options)
+    latency = engine.controller.latency_model.stats()
+    print '%-11s %8.1f %8.1f %8.1f %6d %6d %8.1f %11.1f' % (
+      name, sum(drifts) / len(drifts), _percentile(drifts, 0.99),
+      max(drifts), riff.seeks, riff.rate_changes, latency['mean_error'],
+      cpu * 1000)
+    assert riff.rate_changes <= SYNC_MAX_RATE_CHANGES, name
+
+
+def _write_vbr_mp3(path, seconds, seed):
+  """Write an MPEG-1 layer III file of silent frames at random bit rates."""
+  rng = random.Random(seed)
+  bitrates = prefetch_lib._BITRATES[(True, 3)]
+  handle = open(path, 'wb')
+  try:
+    for _ in xrange(int(seconds * 44100 / 1152)):
+      index = rng.choice((5, 9, 11, 14))
+      length = 144 * bitrates[index] * 1000 // 44100
+      handle.write('\xff\xfb' + chr(index << 4) + '\x00' +
+                   '\x00' * (length - 4))
+  finally:
+    handle.close()
+
+
+@benchmark
+def bench_prefetch(options):
+  """Riff prefetch and VBR MP3 seek index on a 30 minute file."""
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmp_dir, 'riff.mp3')
+    _write_vbr_mp3(path, 1800, 1)
+    prefetcher = prefetch_lib.RiffPrefetcher(path).run()
+    print 'prefetch %.1f MB (%s) and index: %.0f ms' % (
+      prefetcher.warmed / 1048576.0, prefetcher.method,
+      prefetcher.elapsed * 1000)
+    index = prefetcher.index
+    targets = [random.uniform(0, index.duration) for _ in xrange(100)]
+    start = time.time()
+    for target in targets:
+      index.byte_offset(target)
+    indexed = (time.time() - start) / len(targets)
+    start = time.time()
+    for target in targets[:5]:
+      # Locating a position without an index means walking the frames
+      prefetch_lib.Mp3SeekIndex.build(path).byte_offset(target)
+    scanned = (time.time() - start) / 5
+    print 'locate position: indexed %.3f ms, full frame walk %.1f ms' % (
+      indexed * 1000, scanned * 1000)
+    start = time.time()
+    for target in targets:
+      prefetcher.warm(target)
+    print 'warm before seek: %.3f ms' % (
+      (time.time() - start) * 1000 / len(targets))
+    # A budget below the file size indexes only the warmed start
+    budget = 4 * 1048576
+    partial = prefetch_lib.RiffPrefetcher(path, budget).run()
+    errors = [abs(partial.index.byte_offset(target) -
+                  index.byte_offset(target)) / index.byte_rate
+              for target in targets]
+    print ('budget %.0f MB: indexed %.0f of %.0f s in %.0f ms, '
+           'estimate error p50 %.1f s  max %.1f s' % (
+             budget / 1048576.0, len(partial.index.offsets),
+             index.duration / 1000, partial.elapsed * 1000,
+             _percentile(errors, 0.5), max(errors)))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def _noop():
+  pass
+
+
+@benchmark
+def bench_metrics(options):
+  """Cost of metrics_lib instrumentation, disabled and enabled."""
+  calls = 1000000
+  registry = metrics_lib.Registry()
+  timed_noop = registry.timed_function('noop')(_noop)
+  def run_plain():
+    for _ in xrange(calls):
+      _noop()
+  def run_decorated():
+    for _ in xrange(calls):
+      timed_noop()
+  def run_counter():
+    for _ in xrange(calls):
+      registry.increment('noop')
+  for enabled in (False, True):
+    registry.enabled = enabled
+    for name, func in (('plain call', run_plain),
+                       ('timed_function', run_decorated),
+                       ('increment', run_counter)):
+      start = time.clock()
+      func()
+      elapsed = time.clock() - start
+      print '%-8s %-16s %7.3f us/call' % (
+        enabled and 'enabled' or 'disabled', name, elapsed * 1e6 / calls)
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage=__doc__.strip())
+  parser.add_option('--rounds', type='int', default=5,
+                    help='repetitions per measurement')
+  parser.add_option('--rows', type='int', default=1000000,
+                    help='rows for the import, schema and server benchmarks')
+  parser.add_option('--hash-child', help=optparse.SUPPRESS_HELP)
+  options, args = parser.parse_args(argv[1:])
+  if options.hash_child:
+    _run_hash_impl(options.hash_child, args[0], options.rounds)
+    return 0
+  if not args:
+    for name in sorted(BENCHMARKS):
+      print '%-12s %s' % (name, BENCHMARKS[name].__doc__)
+    return 0
+  for name in args:
+    if name not in BENCHMARKS:
+      parser.error('unknown benchmark: %s' % name)
+  for name in args:
+    print '== %s' % name
+    BENCHMARKS[name](options)
+  return 0
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.WARNING)
+  sys.exit(main(sys.argv))
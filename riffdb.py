@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Bulk import and export of riff offsets.
+
+Usage: riffdb.py [options] import <file> [<file> ...]
+       riffdb.py [options] export [<file>]
+
+Files are CSV (with a video_hash,audio_hash,offset header row) or JSON
+lines, chosen by extension or --format. JSON lines may also carry a
+sync_map, a list of [video_ms, riff_ms, rate] breakpoints; CSV files
+only hold plain offsets. Export writes to standard output when no file
+is given.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+import logging
+import optparse
+import sys
+import time
+
+import db_lib
+
+
+def import_files(db, filenames, fmt=None):
+  """Import every file in filenames into db, returning the row count."""
+  total = 0
+  for filename in filenames:
+    start = time.time()
+    handle = open(filename, 'rb')
+    try:
+      count = db.import_offsets(
+        db_lib.read_offsets(handle, fmt or db_lib.offset_format(filename)))
+    finally:
+      handle.close()
+    elapsed = time.time() - start
+    logging.info('Imported %d offsets from %s in %.1fs (%.0f rows/s)', count,
+                 filename, elapsed, count / max(elapsed, 1e-6))
+    total += count
+  return total
+
+
+def export_file(db, filename=None, fmt=None):
+  """Export all offsets in db to filename, or stdout, returning the count."""
+  if filename is None:
+    fmt = fmt or 'csv'
+    return db_lib.write_offsets(db.export_offsets(fmt == 'jsonl'),
+                                sys.stdout, fmt)
+  fmt = fmt or db_lib.offset_format(filename)
+  handle = open(filename, 'wb')
+  try:
+    return db_lib.write_offsets(db.export_offsets(fmt == 'jsonl'), handle,
+                                fmt)
+  finally:
+    handle.close()
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage=__doc__.strip())
+  parser.add_option('--db', default=db_lib.DEFAULT_DB_FILE,
+                    help='local database file [default: %default]')
+  parser.add_option('--format', choices=db_lib.OFFSET_FORMATS,
+                    help='file format, overriding the file extension')
+  parser.add_option('-v', '--verbose', action='store_true',
+                    help='log progress')
+  options, args = parser.parse_args(argv[1:])
+  logging.basicConfig(level=options.verbose and logging.INFO or logging.WARNING)
+  if not args or args[0] not in ('import', 'export'):
+    parser.error('expected import or export')
+  command, filenames = args[0], args[1:]
+  try:
+    db = db_lib.LocalRiffDatabase(options.db)
+    if command == 'import':
+      if not filenames:
+        parser.error('no files to import')
+      import_files(db, filenames, options.format)
+    else:
+      if len(filenames) > 1:
+        parser.error('export takes at most one file')
+      export_file(db, filenames and filenames[0] or None, options.format)
+  except (db_lib.OperationError, IOError), e:
+    logging.error('%s failed: %s', command, e)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
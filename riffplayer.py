@@ -28,24 +28,218 @@ __version__ = '0.3'
 GPL = __doc__
 
 import logging
+import optparse
 import os
 import sys
 import time
 
+# Taken before the GUI toolkit is imported, for the startup timings
+_START_TIME = time.time()
+
 import wx
 import wx.media
 
-import db_lib
+import metrics_lib
+import playlist_lib
+import prefetch_lib
+import sync_lib
+import worker_lib
+
+_IMPORTED_TIME = time.time()
+
+
+class _LazyModule(object):
+  """A module imported on first attribute access.
+
+  Keeps modules which are slow to import, and not needed to show the
+  window, off the startup path.
+  """
+
+  def __init__(self, name):
+    self._name = name
+    self._module = None
+
+  def __getattr__(self, attr):
+    if self._module is None:
+      start = time.time()
+      self._module = __import__(self._name)
+      metrics_lib.observe('startup.import.%s' % self._name,
+                          time.time() - start)
+    return getattr(self._module, attr)
+
+# Pulls in sqlite3 and the networking modules. Freezers can not see this
+# import, so the module is listed in LAZY_MODULES of setup.py.
+db_lib = _LazyModule('db_lib')
 
 RIFF_FILE_FILTER = 'MP3 Files (*.mp3)|*.mp3|AAC Files (*.aac)|*.aac'
 VIDEO_FILE_FILTER = '*.*'
 
 RES_DIR = 'res'
+# Optional sprite sheet holding all bitmaps, written by --pack-sprites.
+# The index has a "name x y width height" line per bitmap.
+SPRITE_SHEET = 'sprites.png'
+SPRITE_INDEX = 'sprites.txt'
+# Size of every bitmap, and of the placeholders shown until they load
+BITMAP_SIZE = (24, 24)
+BITMAP_FILES = {
+  'play': 'media-playback-start.png',
+  'pause': 'media-playback-pause.png',
+  'stop': 'media-playback-stop.png',
+  'video': 'emblem-videos.png',
+  'riff': 'emblem-sound.png',
+  'locked': 'locked.png',
+  'unlocked': 'unlocked.png',
+  'save': 'document-save.png',
+  'volume': 'audio-volume-high.png',
+  'fullscreen': 'view-fullscreen.png',
+}
 
 # Sizing related constants
 _NO_RESIZE = 0
 _LINEAR_RESIZE = 1
 
+# Position labels and sliders are refreshed this many times per second
+# while playing
+REFRESH_RATE = 10
+
+
+class RefreshStats(object):
+  """Counts UI refresh passes and media Tell() calls.
+
+  Attributes:
+    passes, tell_calls: totals
+    passes_per_sec, tells_per_sec: rates over the last second of playback
+  """
+
+  def __init__(self):
+    self.passes = 0
+    self.tell_calls = 0
+    self.passes_per_sec = 0.0
+    self.tells_per_sec = 0.0
+    self._since = time.time()
+    self._counted = (0, 0)
+
+  def refresh(self):
+    """Count a refresh pass, updating the rates once a second."""
+    self.passes += 1
+    now = time.time()
+    elapsed = now - self._since
+    if elapsed < 1.0:
+      return
+    passes, tell_calls = self._counted
+    self.passes_per_sec = (self.passes - passes) / elapsed
+    self.tells_per_sec = (self.tell_calls - tell_calls) / elapsed
+    self._since = now
+    self._counted = (self.passes, self.tell_calls)
+    logging.debug('UI refresh: %.1f passes/s, %.1f Tell calls/s',
+                  self.passes_per_sec, self.tells_per_sec)
+
+
+class _TellCounter(object):
+  """A MediaCtrl proxy counting calls to Tell() in a RefreshStats.
+
+  The MediaCtrl is returned by get_media, so it may be created lazily.
+  """
+
+  def __init__(self, get_media, stats):
+    self._get_media = get_media
+    self._stats = stats
+
+  def Tell(self):
+    self._stats.tell_calls += 1
+    metrics_lib.increment('ui.tell_calls')
+    return self._get_media().Tell()
+
+  def __getattr__(self, name):
+    return getattr(self._get_media(), name)
+
+
+class BitmapLoader(object):
+  """Loads named bitmaps on first use and caches them.
+
+  Bitmaps are cut from the sprite sheet if res_dir has one, and
+  otherwise read from their own files.
+  """
+
+  def __init__(self, res_dir=RES_DIR, files=BITMAP_FILES):
+    self.res_dir = res_dir
+    self.files = files
+    self._bitmaps = {}
+    self._sheet = None
+    self._index = None
+    self._placeholder = None
+
+  @property
+  def placeholder(self):
+    """A transparent bitmap of BITMAP_SIZE."""
+    if self._placeholder is None:
+      self._placeholder = wx.EmptyBitmapRGBA(BITMAP_SIZE[0], BITMAP_SIZE[1],
+                                             alpha=0)
+    return self._placeholder
+
+  def _LoadIndex(self):
+    self._index = {}
+    try:
+      handle = open(os.path.join(self.res_dir, SPRITE_INDEX))
+    except IOError:
+      return
+    try:
+      for line in handle:
+        fields = line.split()
+        if len(fields) == 5:
+          self._index[fields[0]] = wx.Rect(*[int(f) for f in fields[1:]])
+    finally:
+      handle.close()
+
+  def __getitem__(self, name):
+    bitmap = self._bitmaps.get(name)
+    if bitmap is not None:
+      return bitmap
+    if self._index is None:
+      self._LoadIndex()
+    if name in self._index:
+      if self._sheet is None:
+        self._sheet = wx.Bitmap(os.path.join(self.res_dir, SPRITE_SHEET))
+      bitmap = self._sheet.GetSubBitmap(self._index[name])
+    else:
+      bitmap = wx.Bitmap(os.path.join(self.res_dir, self.files[name]))
+    self._bitmaps[name] = bitmap
+    return bitmap
+
+
+def PackSprites(res_dir=RES_DIR, files=BITMAP_FILES):
+  """Write the bitmaps side by side into a sprite sheet and its index."""
+  images = []
+  for name in sorted(files):
+    image = wx.Image(os.path.join(res_dir, files[name]))
+    if not image.HasAlpha():
+      image.InitAlpha()
+    images.append((name, image))
+  width = sum(image.GetWidth() for _, image in images)
+  height = max(image.GetHeight() for _, image in images)
+  data = bytearray(width * height * 3)
+  alpha = bytearray(width * height)
+  index = []
+  x = 0
+  for name, image in images:
+    w, h = image.GetWidth(), image.GetHeight()
+    image_data = image.GetData()
+    image_alpha = image.GetAlphaData()
+    for y in xrange(h):
+      start = y * width + x
+      data[start * 3:(start + w) * 3] = image_data[y * w * 3:(y + 1) * w * 3]
+      alpha[start:start + w] = image_alpha[y * w:(y + 1) * w]
+    index.append('%s %d 0 %d %d\n' % (name, x, w, h))
+    x += w
+  sheet = wx.ImageFromData(width, height, str(data))
+  sheet.SetAlphaData(str(alpha))
+  sheet.SaveFile(os.path.join(res_dir, SPRITE_SHEET), wx.BITMAP_TYPE_PNG)
+  handle = open(os.path.join(res_dir, SPRITE_INDEX), 'w')
+  try:
+    handle.writelines(index)
+  finally:
+    handle.close()
+
 
 class AudioFrame(wx.Frame):
   """Separate audio frame."""
@@ -55,8 +249,17 @@ class AudioFrame(wx.Frame):
 class RiffPlayerFrame(wx.Frame):
   """The main riffplayer frame."""
 
-  def __init__(self, parent, title):
-    """Initialize the main riff player frame."""
+  def __init__(self, parent, title, sync_interval=sync_lib.SYNC_INTERVAL,
+               prefetch_budget=prefetch_lib.PREFETCH_BUDGET):
+    """Initialize the main riff player frame.
+
+    Args:
+      parent: parent window
+      title: frame title
+      sync_interval: milliseconds between riff sync corrections
+      prefetch_budget: bytes of a riff to read ahead when it is chosen,
+        0 to disable prefetching
+    """
     wx.Frame.__init__(self, parent, wx.ID_ANY, title=title, size = (700, 500))
     self.Bind(wx.EVT_CLOSE, self.Destroy)
     self.SetMinSize((700, 500))
@@ -64,46 +267,85 @@ class RiffPlayerFrame(wx.Frame):
     self.video_file = None
     self.riff_file = None
     self.db = None
-    self.synced = False
-    self.offset = 0
+    self.offset_service = None
+    # Incremented for every offset lookup so that results of lookups for
+    # a previous choice of files can be recognized and dropped.
+    self._offset_request = 0
+    self.sync_interval = sync_interval
+    self.prefetch_budget = prefetch_budget
+    self.prefetch_pool = worker_lib.WorkerPool(1, name='prefetch')
+    self.playlist = playlist_lib.Playlist()
+    # Hidden media controls holding the next playlist item
+    self._standby_video = None
+    self._standby_riff = None
+    self._standby_item = None
+    # Seconds taken by the last switch between playlist items
+    self.last_gap = None
+    self.refresh_stats = RefreshStats()
+    # Close the window once startup has finished, for timing it
+    self.exit_after_startup = False
 
 
     self._InitResources()
     self._InitControls()
     self._InitMenu()
+    # Position queries go through these so that they are counted
+    self.video_clock = _TellCounter(lambda: self.video, self.refresh_stats)
+    self.riff_clock = _TellCounter(lambda: self.riff, self.refresh_stats)
+    self.sync_engine = sync_lib.SyncEngine(self.video_clock, self.riff_clock)
+    self._UpdateControls()
 
   def _InitResources(self):
-    """Initialize image resources."""
-    self.bmp = {
-      'play': wx.Bitmap(os.path.join(RES_DIR, 'media-playback-start.png')),
-      'pause': wx.Bitmap(os.path.join(RES_DIR, 'media-playback-pause.png')),
-      'stop': wx.Bitmap(os.path.join(RES_DIR, 'media-playback-stop.png')),
-      'video': wx.Bitmap(os.path.join(RES_DIR, 'emblem-videos.png')),
-      'riff': wx.Bitmap(os.path.join(RES_DIR, 'emblem-sound.png')),
-      'locked': wx.Bitmap(os.path.join(RES_DIR, 'locked.png')),
-      'unlocked': wx.Bitmap(os.path.join(RES_DIR, 'unlocked.png')),
-      'save': wx.Bitmap(os.path.join(RES_DIR, 'document-save.png')),
-      'volume': wx.Bitmap(os.path.join(RES_DIR, 'audio-volume-high.png')),
-      'fullscreen': wx.Bitmap(os.path.join(RES_DIR, 'view-fullscreen.png'))
-     }
+    """Initialize image resources; bitmaps are loaded after first paint."""
+    self.bmp = BitmapLoader()
+    # Name of the bitmap of each control, by control attribute
+    self._bitmap_names = {}
+    self._bitmaps_loaded = False
+
+  def _SetBitmap(self, control, name):
+    """Show the named bitmap on a control, once bitmaps are loaded.
+
+    Args:
+      control: attribute name of a BitmapButton or StaticBitmap
+      name: key of BITMAP_FILES
+    """
+    if self._bitmap_names.get(control) == name:
+      return
+    self._bitmap_names[control] = name
+    if self._bitmaps_loaded:
+      self._ShowBitmap(control, name)
+
+  def _ShowBitmap(self, control, name):
+    control = getattr(self, control)
+    if isinstance(control, wx.StaticBitmap):
+      control.SetBitmap(self.bmp[name])
+    else:
+      control.SetBitmapLabel(self.bmp[name])
+
+  def _LoadBitmaps(self):
+    """Replace the placeholders of the controls with their bitmaps."""
+    self._bitmaps_loaded = True
+    for control, name in self._bitmap_names.iteritems():
+      self._ShowBitmap(control, name)
+    elapsed = time.time() - _START_TIME
+    metrics_lib.observe('startup.bitmaps', elapsed)
+    logging.info('Startup: bitmaps loaded at %.0f ms', elapsed * 1000)
+    if self.exit_after_startup:
+      self.Close()
 
   def _InitControls(self):
     """Build the visible controls."""
     # The main video panel, defaulted to a black background
-    self.video = wx.media.MediaCtrl(self)
-    self.video.SetBackgroundColour('#000000')
-    
-    # The riff audio is handled by a separate MediaCtl instance which
-    # is associated with its own frame
-    audio_frame = AudioFrame(self, None, '')
-    self.riff = wx.media.MediaCtrl(audio_frame)
+    self.video = self._CreateVideoCtrl()
+    self._riff = None
 
     self.control_panel = wx.Panel(self)
+    self.control_panel.Bind(wx.EVT_PAINT, self._OnFirstPaint)
     control_box = wx.BoxSizer(wx.VERTICAL)
     self.control_panel.SetSizer(control_box)
 
     self.video_select_button = wx.BitmapButton(self.control_panel,
-                                               bitmap=self.bmp['video'])
+                                               bitmap=self.bmp.placeholder)
     self.video_select_button.SetToolTip(wx.ToolTip('Select video'))
 
     self.video_slider = wx.Slider(self.control_panel, value=0, minValue=0,
@@ -112,42 +354,54 @@ class RiffPlayerFrame(wx.Frame):
     self.video_timer = wx.StaticText(self.control_panel, label=' 00:00:00')
 
     self.riff_select_button = wx.BitmapButton(self.control_panel,
-                                              bitmap=self.bmp['riff'])
+                                              bitmap=self.bmp.placeholder)
     self.riff_select_button.SetToolTip(wx.ToolTip('Select riff'))
 
     self.riff_slider = wx.Slider(self.control_panel, value=0, minValue=0, maxValue=1000)
 
     self.riff_timer = wx.StaticText(self.control_panel, label=' 00:00:00')
 
-    self.play_button = wx.BitmapButton(self.control_panel, bitmap=self.bmp['play'])
+    self.play_button = wx.BitmapButton(self.control_panel, bitmap=self.bmp.placeholder)
     self.play_button.SetToolTip(wx.ToolTip('Start Playback'))
 
-    self.stop_button = wx.BitmapButton(self.control_panel, bitmap=self.bmp['stop'])
+    self.stop_button = wx.BitmapButton(self.control_panel, bitmap=self.bmp.placeholder)
     self.stop_button.SetToolTip(wx.ToolTip('Stop Playback'))
 
     self.fullscreen_button = wx.BitmapButton(self.control_panel,
-                                             bitmap=self.bmp['fullscreen'])
+                                             bitmap=self.bmp.placeholder)
     self.fullscreen_button.SetToolTip(wx.ToolTip('Toogle fullscreen'))
 
-    self.sync_button = wx.BitmapButton(self.control_panel, bitmap=self.bmp['unlocked'])
+    self.sync_button = wx.BitmapButton(self.control_panel, bitmap=self.bmp.placeholder)
     self.sync_button.SetToolTip(wx.ToolTip('Lock sync'))
 
     self.offset_button = wx.Button(self.control_panel, label='Offset: 0.0',
                                    style=wx.NO_BORDER)
     self.save_offset_button = wx.BitmapButton(self.control_panel,
-                                              bitmap=self.bmp['save'])
+                                              bitmap=self.bmp.placeholder)
     self.save_offset_button.SetToolTip(wx.ToolTip('Save Current Offset'))
     self.video_volume_label = wx.StaticText(self.control_panel, label='Video:')
     self.video_volume_bmp = wx.StaticBitmap(self.control_panel,
-                                            bitmap=self.bmp['volume'])
+                                            bitmap=self.bmp.placeholder)
     self.video_volume_slider = wx.Slider(self.control_panel, value=50,
                                          minValue=0, maxValue=100)
     self.riff_volume_label = wx.StaticText(self.control_panel, label='Riff:')
     self.riff_volume_bmp = wx.StaticBitmap(self.control_panel,
-                                           bitmap=self.bmp['volume'])
+                                           bitmap=self.bmp.placeholder)
     self.riff_volume_slider = wx.Slider(self.control_panel, value=50,
                                         minValue=0, maxValue=100)
 
+    # The real bitmaps are loaded once the window has been painted
+    for control, name in (('video_select_button', 'video'),
+                          ('riff_select_button', 'riff'),
+                          ('play_button', 'play'),
+                          ('stop_button', 'stop'),
+                          ('fullscreen_button', 'fullscreen'),
+                          ('sync_button', 'unlocked'),
+                          ('save_offset_button', 'save'),
+                          ('video_volume_bmp', 'volume'),
+                          ('riff_volume_bmp', 'volume')):
+      self._SetBitmap(control, name)
+
     controls1 = wx.BoxSizer(wx.HORIZONTAL)
     controls2 = wx.BoxSizer(wx.HORIZONTAL)
     controls3 = wx.BoxSizer(wx.HORIZONTAL)
@@ -195,10 +449,46 @@ class RiffPlayerFrame(wx.Frame):
     self.Bind(wx.EVT_SLIDER, self.OnRiffVolumeSliderUpdate,
               self.riff_volume_slider)
 
-    self.Bind(wx.EVT_UPDATE_UI, self.OnUpdateUI)
-    self.Bind(wx.EVT_IDLE, self.OnIdle)
+    self.sync_timer = wx.Timer(self)
+    self.Bind(wx.EVT_TIMER, self.OnSyncTimer, self.sync_timer)
+    self.refresh_timer = wx.Timer(self)
+    self.Bind(wx.EVT_TIMER, self.OnRefreshTimer, self.refresh_timer)
 
 
+  def _CreateVideoCtrl(self):
+    video = wx.media.MediaCtrl(self)
+    video.SetBackgroundColour('#000000')
+    self.Bind(wx.media.EVT_MEDIA_LOADED, self.OnMediaLoaded, video)
+    self.Bind(wx.media.EVT_MEDIA_FINISHED, self.OnMediaFinished, video)
+    return video
+
+  def _CreateRiffCtrl(self):
+    # The riff audio is handled by a separate MediaCtl instance which
+    # is associated with its own frame
+    audio_frame = AudioFrame(self, None, '')
+    riff = wx.media.MediaCtrl(audio_frame)
+    self.Bind(wx.media.EVT_MEDIA_LOADED, self.OnMediaLoaded, riff)
+    return riff
+
+  @property
+  def riff(self):
+    """The riff MediaCtrl, created when first needed."""
+    if self._riff is None:
+      self._riff = self._CreateRiffCtrl()
+    return self._riff
+
+  def _OnFirstPaint(self, event):
+    """Report the startup timings once the window is first painted."""
+    event.Skip()
+    self.control_panel.Unbind(wx.EVT_PAINT)
+    now = time.time()
+    metrics_lib.observe('startup.imports', _IMPORTED_TIME - _START_TIME)
+    metrics_lib.observe('startup.first_paint', now - _START_TIME)
+    logging.info('Startup: imports %.0f ms, first paint %.0f ms',
+                 (_IMPORTED_TIME - _START_TIME) * 1000,
+                 (now - _START_TIME) * 1000)
+    wx.CallAfter(self._LoadBitmaps)
+
   def _InitMenu(self):
     """Init the OS menu."""
     self.menu_bar = wx.MenuBar()
@@ -211,12 +501,22 @@ class RiffPlayerFrame(wx.Frame):
     self.menu_db_select = wx.MenuItem(self.file_menu, wx.ID_ANY, 'Open &Database')
     self.file_menu.AppendItem(self.menu_video_select)
     self.file_menu.AppendItem(self.menu_riff_select)
+    self.menu_playlist_add = wx.MenuItem(self.file_menu, wx.ID_ANY,
+                                         'Add to &Playlist')
     self.file_menu.AppendItem(self.menu_db_select)
+    self.file_menu.AppendItem(self.menu_playlist_add)
 
     self.menu_play = wx.MenuItem(self.control_menu, wx.ID_ANY, '&Play/Pause')
     self.menu_sync = wx.MenuItem(self.control_menu, wx.ID_ANY, '&Sync Lock')
     self.control_menu.AppendItem(self.menu_play)
+    self.menu_next = wx.MenuItem(self.control_menu, wx.ID_ANY, '&Next Title')
+    # For riffs of a film played along with a PAL transfer, which runs
+    # 25/24 as fast
+    self.menu_pal = wx.MenuItem(self.control_menu, wx.ID_ANY,
+                                'P&AL Speedup', kind=wx.ITEM_CHECK)
     self.control_menu.AppendItem(self.menu_sync)
+    self.control_menu.AppendItem(self.menu_next)
+    self.control_menu.AppendItem(self.menu_pal)
 
     self.menu_hashes = wx.MenuItem(self.tools_menu, wx.ID_ANY, 'Show &Hashes')
     self.menu_enter_offset = wx.MenuItem(self.tools_menu, wx.ID_ANY,
@@ -237,8 +537,11 @@ class RiffPlayerFrame(wx.Frame):
     self.Bind(wx.EVT_MENU, self.OnChooseVideo, self.menu_video_select)
     self.Bind(wx.EVT_MENU, self.OnChooseRiff, self.menu_riff_select)
     self.Bind(wx.EVT_MENU, self.OnChooseDb, self.menu_db_select)
+    self.Bind(wx.EVT_MENU, self.OnAddToPlaylist, self.menu_playlist_add)
+    self.Bind(wx.EVT_MENU, self.OnNextTitle, self.menu_next)
     self.Bind(wx.EVT_MENU, self.OnPlayPause, self.menu_play)
     self.Bind(wx.EVT_MENU, self.OnToggleSync, self.menu_sync)
+    self.Bind(wx.EVT_MENU, self.OnTogglePal, self.menu_pal)
     self.Bind(wx.EVT_MENU, self.OnShowHash, self.menu_hashes)
     self.Bind(wx.EVT_MENU, self.OnEnterOffset, self.menu_enter_offset)
     self.Bind(wx.EVT_MENU, self.OnSaveOffset, self.menu_save_offset)
@@ -247,33 +550,173 @@ class RiffPlayerFrame(wx.Frame):
 
   def Play(self):
     """Start playback."""
-    self.play_button.SetBitmapLabel(self.bmp['pause'])
+    self._SetBitmap('play_button', 'pause')
     self.video.Play()
     self.riff.Play()
-    try:
-      self.video_slider.SetMax(self.video.Length())
-      self.riff_slider.SetMax(self.riff.Length())
-    except Exception, e:
-      logging.error('Error setting slider max values: %s', e)
+    self._UpdateSliderRange()
+    self.sync_engine.start()
+    self.sync_timer.Start(self.sync_interval)
+    self.refresh_timer.Start(1000 // REFRESH_RATE)
 
   def Pause(self):
     """Pause playback."""
-    self.play_button.SetBitmapLabel(self.bmp['play'])
+    self._SetBitmap('play_button', 'play')
+    self._StopTimers()
+    self.sync_engine.stop()
     self.video.Pause()
-    self.riff.Pause()
+    if self._riff is not None:
+      self._riff.Pause()
+    self._RefreshPositions()
 
   def Stop(self):
     """Stop playback."""
-    self.play_button.SetBitmapLabel(self.bmp['play'])
+    self._SetBitmap('play_button', 'play')
     self.video_slider.SetValue(0)
     self.riff_slider.SetValue(0)
+    self._StopTimers()
+    self.sync_engine.stop()
     self.video.Stop()
-    self.riff.Stop()
+    if self._riff is not None:
+      self._riff.Stop()
+    self._RefreshPositions()
+
+  def _StopTimers(self):
+    self.sync_timer.Stop()
+    self.refresh_timer.Stop()
+
+  def _UpdateSliderRange(self):
+    try:
+      self.video_slider.SetMax(self.video.Length())
+      if self._riff is not None:
+        self.riff_slider.SetMax(self._riff.Length())
+    except Exception, e:
+      logging.error('Error setting slider max values: %s', e)
+
+  def OnMediaLoaded(self, event):
+    """Event handler for media load completion."""
+    self._UpdateSliderRange()
+    self._UpdateControls()
+    self._RefreshPositions()
+
+  def OnMediaFinished(self, event):
+    """Event handler for the end of a video."""
+    if event.GetEventObject() is not self.video:
+      return
+    if self.playlist.peek() is not None:
+      self.AdvancePlaylist()
+    else:
+      self.Pause()
+
+  def OnAddToPlaylist(self, event):
+    """Event handler for adding a video and riff to the playlist."""
+    video_file = self._ChooseFile(filter=VIDEO_FILE_FILTER)
+    if video_file is None:
+      return
+    riff_file = self._ChooseFile(filter=RIFF_FILE_FILTER)
+    if riff_file is None:
+      return
+    self.playlist.add(video_file, riff_file)
+    if self.playlist.current() is None:
+      self.AdvancePlaylist(play=False)
+    else:
+      self._PrepareNext()
+
+  def OnNextTitle(self, event):
+    """Event handler for skipping to the next playlist item."""
+    if self.playlist.peek() is not None:
+      self.AdvancePlaylist()
+
+  def _PrepareNext(self):
+    """Resolve the next playlist item's offset and open its media.
+
+    The hashes and stored sync map are looked up in the background, and
+    the media are loaded into hidden controls, so AdvancePlaylist only
+    has to swap them in.
+    """
+    item = self.playlist.peek()
+    if item is None or item is self._standby_item:
+      return
+    if self.offset_service is not None and item.sync_map is None:
+      item.sync_map = self.offset_service.get_sync_map(item.video_file,
+                                                       item.riff_file)
+    if self._standby_video is None:
+      self._standby_video = self._CreateVideoCtrl()
+      self._standby_video.Hide()
+      self._standby_riff = self._CreateRiffCtrl()
+    self._standby_video.Load(item.video_file)
+    self._standby_riff.Load(item.riff_file)
+    self._standby_item = item
+    if self.prefetch_budget and item.prefetch is None:
+      item.prefetch = self.prefetch_pool.submit(prefetch_lib.RiffPrefetcher(
+        item.riff_file, self.prefetch_budget).run)
+
+  def AdvancePlaylist(self, play=True):
+    """Switch to the next playlist item.
+
+    Args:
+      play: whether to start playing it
+    """
+    start = time.time()
+    item = self.playlist.advance()
+    if item is None:
+      return
+    self._StopTimers()
+    self.sync_engine.stop()
+    # The previous title's offset does not carry over. Unlocking restores
+    # the normal rate of the riff, which must happen before it becomes
+    # the standby riff.
+    self.sync_engine.unlock()
+    self.video.Stop()
+    if self._riff is not None:
+      self._riff.Stop()
+    if item is self._standby_item:
+      sizer = self.GetSizer()
+      sizer.Detach(self.video)
+      self.video.Hide()
+      sizer.Insert(0, self._standby_video, _LINEAR_RESIZE, flag=wx.EXPAND)
+      self._standby_video.Show()
+      self.Layout()
+      self.video, self._standby_video = self._standby_video, self.video
+      self._riff, self._standby_riff = self._standby_riff, self._riff
+      self._standby_item = None
+      # The standby controls were created at the default volume
+      self.OnVideoVolumeSliderUpdate(None)
+      self.OnRiffVolumeSliderUpdate(None)
+    else:
+      self.video.Load(item.video_file)
+      self.riff.Load(item.riff_file)
+    self.video_file = item.video_file
+    self.riff_file = item.riff_file
+    self.sync_engine.select_riff(self.riff_file)
+    self._PrefetchRiff(item.prefetch)
+    if item.sync_map is None:
+      self._LoadOffset()
+    else:
+      self._offset_request += 1
+      request = self._offset_request
+      if item.sync_map.done():
+        self._OnOffsetLoaded(request, item.sync_map)
+      else:
+        item.sync_map.add_done_callback(
+          lambda future: wx.CallAfter(self._OnOffsetLoaded, request, future))
+    self._UpdateSliderRange()
+    self._UpdateControls()
+    if play:
+      self.Play()
+      self.last_gap = time.time() - start
+      metrics_lib.observe('playlist.gap', self.last_gap)
+      logging.info('Playlist: switched to %s in %.1f ms', item,
+                   self.last_gap * 1000)
+    else:
+      self._RefreshPositions()
+    self._PrepareNext()
 
   def OnPlayPause(self, event):
     """Event handler for play button events."""
-    if wx.media.MEDIASTATE_PLAYING in (self.video.GetState(),
-                                       self.riff.GetState()):
+    states = [self.video.GetState()]
+    if self._riff is not None:
+      states.append(self._riff.GetState())
+    if wx.media.MEDIASTATE_PLAYING in states:
       self.Pause()
     elif not self.video_file or not self.riff_file:
       return
@@ -294,6 +737,7 @@ class RiffPlayerFrame(wx.Frame):
       self.riff.Seek(pos)
     except Exception, e:
       logging.error('Error performing riff slider sync: %s', e)
+    self._RefreshPositions()
 
   def OnVideoSliderUpdate(self, event):
     pos = self.video_slider.GetValue()
@@ -302,6 +746,7 @@ class RiffPlayerFrame(wx.Frame):
       self._ApplyOffset()
     except Exception, e:
       logging.error('Error performing video slider sync: %s', e)
+    self._RefreshPositions()
 
   def OnVideoVolumeSliderUpdate(self, event):
     """Event handler for video volume adjustment."""
@@ -318,10 +763,39 @@ class RiffPlayerFrame(wx.Frame):
     self.Stop()
     self.riff_file = self._ChooseFile(filter=RIFF_FILE_FILTER)
     self.riff.Load(self.riff_file)
+    self.sync_engine.select_riff(self.riff_file)
+    self._PrefetchRiff()
     logging.debug('Riff file: %s', self.riff_file)
     self._LoadOffset()
     self._ApplyOffset()
+    self._UpdateControls()
   
+  def _PrefetchRiff(self, future=None):
+    """Start warming the cache for the riff, and indexing it for seeks.
+
+    Args:
+      future: Future of a RiffPrefetcher already started for the riff,
+        as by _PrepareNext, to use instead of starting another
+    """
+    self.sync_engine.controller.seek_hook = None
+    if not self.riff_file or not self.prefetch_budget:
+      return
+    if future is None:
+      future = self.prefetch_pool.submit(prefetch_lib.RiffPrefetcher(
+        self.riff_file, self.prefetch_budget).run)
+    future.add_done_callback(
+      lambda future: wx.CallAfter(self._OnRiffPrefetched, future))
+
+  def _OnRiffPrefetched(self, future):
+    """Use the seek index of a prefetched riff, if still current."""
+    try:
+      prefetcher = future.result()
+    except prefetch_lib.OperationError, e:
+      logging.warning('Error prefetching riff: %s', e)
+      return
+    if prefetcher.path == self.riff_file:
+      self.sync_engine.controller.seek_hook = prefetcher.warm
+
   def OnChooseVideo(self, event):
     """Event handler for video selection."""
     self.Stop()
@@ -330,6 +804,7 @@ class RiffPlayerFrame(wx.Frame):
     logging.debug('Video file: %s', self.video_file)
     self._LoadOffset()
     self._ApplyOffset()
+    self._UpdateControls()
 
   def OnChooseDb(self, event):
     """Event handler for database selection."""
@@ -345,53 +820,78 @@ class RiffPlayerFrame(wx.Frame):
       return
 
   def SetDb(self, db):
+    if self.offset_service is not None:
+      self.offset_service.pool.shutdown(wait=False)
     self.db = db
+    self.offset_service = worker_lib.OffsetService(db)
     self._LoadOffset()
     self._ApplyOffset()
+    self._UpdateControls()
+    # Lookups made through the old database are no longer wanted
+    for item in self.playlist.items[self.playlist.position + 1:]:
+      item.sync_map = None
+    self._standby_item = None
+    self._PrepareNext()
 
   def SetOffset(self, offset):
     logging.debug('Setting offset to: %s', offset)
-    self.offset = offset
-    self.synced = True
-    self._ApplyOffset()
+    self.SetSyncMap(
+      sync_lib.SyncMap.linear(0.0, offset, self.sync_engine.rate))
 
-  def _CalculateOffset(self):
-    """Calculate current riff->video offset.
+  def SetSyncMap(self, sync_map):
+    """Sync the riff to the video according to a sync_lib.SyncMap."""
+    logging.debug('Setting sync map to: %s', sync_map)
+    try:
+      self.sync_engine.set_sync_map(sync_map)
+    except Exception, e:
+      logging.debug('Error applying offset: %s', e)
+    self._UpdateControls()
+
+  def _CurrentSyncMap(self):
+    """Return the sync map locking the riff to the video where both are.
 
     Returns:
-      int - offset in milliseconds
+      sync_lib.SyncMap - at the PAL speedup rate if that is enabled
     """
-    offset = 0
     try:
-      vid_position_milli = self.video.Tell()
-      riff_position_milli = self.riff.Tell()
-      offset = riff_position_milli - vid_position_milli
+      return self.sync_engine.current_map()
     except Exception, e:
       logging.error('Offset calculation error: %s', e)
-    return offset
+    return sync_lib.SyncMap.linear(0.0, 0.0, self.sync_engine.rate)
 
   def _LoadOffset(self):
-    """Attempt to load offset for current files from db."""
+    """Start loading the offset for the current files from db.
+
+    The lookup runs in the background; the offset is applied by
+    _OnOffsetLoaded once it completes.
+    """
+    self._offset_request += 1
     if None in (self.video_file, self.riff_file, self.db):
       return
-    offset = self.db.get_offset(self.video_file, self.riff_file)
-    if offset is not None:
-      self.SetOffset(offset)
+    request = self._offset_request
+    future = self.offset_service.get_sync_map(self.video_file, self.riff_file)
+    future.add_done_callback(
+      lambda future: wx.CallAfter(self._OnOffsetLoaded, request, future))
+
+  def _OnOffsetLoaded(self, request, future):
+    """Apply the result of a background offset lookup."""
+    if request != self._offset_request:
+      logging.debug('Dropping stale offset lookup %s', request)
+      return
+    try:
+      sync_map = future.result()
+    except db_lib.OperationError, e:
+      logging.error('Error loading offset: %s', e)
+      return
+    if sync_map is not None:
+      self.SetSyncMap(sync_map)
 
 
+  @metrics_lib.timed_function('ui.apply_offset')
   def _ApplyOffset(self):
-    """Apply current offset if required."""
-    if not self.synced or None in (self.video, self.riff):
-      return
+    """Seek the riff into sync now, if required."""
     try:
-      vid_position_milli = self.video.Tell()
-      riff_duration_milli = self.riff.Length()
-      riff_position_milli = self.riff.Tell()
-      new_riff_pos = min(riff_duration_milli, max(vid_position_milli + self.offset, 0))
-      # allow for tiny amounts of drift to minimize seeking
-      if abs(new_riff_pos - riff_position_milli) > 100:
-        logging.debug('Sync: Seeking riff to: %s', new_riff_pos)
-        self.riff.Seek(new_riff_pos)
+      self.sync_engine.apply()
     except Exception, e:
       logging.debug('Error applying offset: %s', e)
     
@@ -400,50 +900,69 @@ class RiffPlayerFrame(wx.Frame):
     if None in (self.video_file, self.riff_file, self.db):
       self._ErrorMsg('Unable to save offset')
       return
-    self.db.add_offset(self.video_file, self.riff_file, self.offset)
-    logging.debug('Saved offset')
+    future = self.offset_service.add_sync_map(self.video_file, self.riff_file,
+                                              self.sync_engine.sync_map)
+    future.add_done_callback(
+      lambda future: wx.CallAfter(self._OnOffsetSaved, future))
+
+  def _OnOffsetSaved(self, future):
+    """Report the result of a background offset save."""
+    error = future.exception()
+    if error is not None:
+      self._ErrorMsg('Error saving offset: %s' % error)
+    else:
+      logging.debug('Saved offset')
       
   def OnToggleSync(self, event):
     """Event handler for sync button."""
-    self.synced = (self.synced == False)
-    if self.synced:
-      self.sync_button.SetBitmapLabel(self.bmp['locked'])
-      self.SetOffset(self._CalculateOffset())
+    if not self.sync_engine.synced:
+      self.SetSyncMap(self._CurrentSyncMap())
     else:
-      self.sync_button.SetBitmapLabel(self.bmp['unlocked'])
+      self.sync_engine.unlock()
+      self._UpdateControls()
 
-  def OnIdle(self, event):
-    """Event handler for the Idle task.
-    
-    Used to update non-gui background processes
-    """
-    if not int(time.time()) % 5:
-      self._ApplyOffset()
+  def OnTogglePal(self, event):
+    """Event handler for the PAL speedup menu item."""
+    rate = self.menu_pal.IsChecked() and sync_lib.PAL_SPEEDUP or 1.0
+    try:
+      self.sync_engine.set_rate(rate)
+    except Exception, e:
+      logging.debug('Error applying offset: %s', e)
+    self._UpdateControls()
+
+  def OnSyncTimer(self, event):
+    """Event handler for the sync timer, running while playing."""
+    try:
+      with metrics_lib.timed('ui.sync_tick'):
+        self.sync_engine.tick()
+    except Exception, e:
+      logging.debug('Error applying offset: %s', e)
 
-  def OnUpdateUI(self, event):
-    """Event handler for the EVT_UPDATE_UI psuedo-signal."""
-    new_offset_label = 'Offset: %s' % self.offset
+  def _UpdateControls(self):
+    """Update control states after a change of files, database or sync."""
+    synced = self.sync_engine.synced
+    new_offset_label = 'Offset: %d' % self.sync_engine.offset
     old_offset_label = self.offset_button.GetLabel()
     if new_offset_label != old_offset_label:
       self.offset_button.SetLabel(new_offset_label)
-    if self.video_file and self.riff_file:
-      self.play_button.Enable()
-    else:
-      self.play_button.Disable()
-    if self.synced:
-      self.riff_slider.Disable()
-      if self.db:
-        self.save_offset_button.Enable()
-      if self.sync_button.GetBitmapLabel() != self.bmp['locked']:
-        self.sync_button.SetBitmapLabel(self.bmp['locked'])
-    else:
-      self.riff_slider.Enable()
-      self.save_offset_button.Disable()
-      if self.sync_button.GetBitmapLabel() != self.bmp['unlocked']:
-        self.sync_button.SetBitmapLabel(self.bmp['unlocked'])
+    self.play_button.Enable(bool(self.video_file and self.riff_file))
+    self.riff_slider.Enable(not synced)
+    self.save_offset_button.Enable(synced and self.db is not None)
+    self._SetBitmap('sync_button', synced and 'locked' or 'unlocked')
+
+  def OnRefreshTimer(self, event):
+    """Event handler for the refresh timer, running while playing."""
+    self._RefreshPositions()
+
+  @metrics_lib.timed_function('ui.refresh')
+  def _RefreshPositions(self):
+    """Update the position labels and sliders."""
+    self.refresh_stats.refresh()
     try:
-      vid_position_milli = self.video.Tell()
-      riff_position_milli = self.riff.Tell()
+      vid_position_milli = self.video_clock.Tell()
+      riff_position_milli = -1
+      if self._riff is not None:
+        riff_position_milli = self.riff_clock.Tell()
       if vid_position_milli >= 0:
         # blindly redrawing the labels on each update causes funky flashing
         # in windows
@@ -531,7 +1050,8 @@ class RiffPlayerFrame(wx.Frame):
     """Event handler for manualy entered offset."""
     offset = None
     dlg = wx.NumberEntryDialog(self, 'Enter offset (in milliseconds)', 'Offset',
-                               'Offset', self.offset, 0, 10800000)
+                               'Offset', int(self.sync_engine.offset), 0,
+                               10800000)
     if dlg.ShowModal() == wx.ID_OK:
       offset = dlg.GetValue()
     dlg.Destroy()
@@ -555,9 +1075,60 @@ class RiffPlayer(wx.App):
   def SetDb(self, db):
     self.frame.SetDb(db)
 
+  def OnDbSwitched(self, db):
+    """Reload the offset once the remote database of db is reachable."""
+    if self.frame.db is db:
+      self.frame.SetDb(db)
+
 if __name__ == '__main__':
-  logging.basicConfig(level=logging.WARNING)
+  parser = optparse.OptionParser()
+  parser.add_option('--stats', metavar='FILE',
+                    help='write a JSON performance report to FILE at exit')
+  parser.add_option('--stats-log', type='float', metavar='SECONDS',
+                    help='log performance metrics every SECONDS (with -v)')
+  parser.add_option('--prefetch-budget', type='int', metavar='MB',
+                    default=prefetch_lib.PREFETCH_BUDGET // 1048576,
+                    help='megabytes of a riff to read ahead, 0 to disable '
+                    '[default: %default]')
+  parser.add_option('--playlist', metavar='FILE',
+                    help='play the video<TAB>riff pairs listed in FILE')
+  parser.add_option('--pack-sprites', action='store_true',
+                    help='pack the bitmaps in %s into a sprite sheet' % RES_DIR)
+  parser.add_option('--db', metavar='FILE',
+                    help='local offset database [default: riffdb.sqlite]')
+  parser.add_option('--remote', metavar='URL',
+                    help='remote offset database [default: openriff.com]')
+  parser.add_option('--exit-after-startup', action='store_true',
+                    help='quit once the window is up, for timing startup')
+  parser.add_option('-v', '--verbose', action='store_true',
+                    help='log debug messages')
+  options, args = parser.parse_args()
+  if options.pack_sprites:
+    app = wx.App(False)
+    PackSprites()
+    sys.exit(0)
+  logging.basicConfig(
+    level=options.verbose and logging.DEBUG or logging.WARNING)
+  if options.stats or options.stats_log:
+    metrics_lib.enable()
+  if options.stats_log:
+    metrics_lib.REGISTRY.start_logging(options.stats_log)
   app = RiffPlayer(0)
-  app.SetDb(db_lib.GetRiffDatabase())
+  app.frame.prefetch_budget = options.prefetch_budget * 1048576
+  app.frame.exit_after_startup = options.exit_after_startup
+  if options.playlist:
+    try:
+      app.frame.playlist.load(options.playlist)
+    except playlist_lib.OperationError, e:
+      parser.error('unable to load playlist: %s' % e)
+    app.frame.AdvancePlaylist(play=False)
+  # The database is opened once the window is up. It is usable with the
+  # local database straight away; offsets are looked up again if the
+  # remote database turns out to be reachable.
+  wx.CallAfter(lambda: app.SetDb(db_lib.GetRiffDatabase(
+    on_switch=lambda db: wx.CallAfter(app.OnDbSwitched, db),
+    path=options.db, url=options.remote)))
   app.MainLoop()
+  if options.stats:
+    metrics_lib.REGISTRY.dump(options.stats)
     
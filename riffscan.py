@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Index a media library and list the video/riff pairs with stored offsets.
+
+Usage: riffscan.py [options] <directory> [<directory> ...]
+
+Matches are printed one per line as: offset<TAB>video<TAB>riff
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+import logging
+import optparse
+import sys
+import time
+
+import db_lib
+import metrics_lib
+import scan_lib
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage=__doc__.strip())
+  parser.add_option('--db', default=db_lib.DEFAULT_DB_FILE,
+                    help='local database and index file [default: %default]')
+  parser.add_option('--remote', action='store_true',
+                    help='look offsets up in the remote database')
+  parser.add_option('--processes', type='int',
+                    help='hashing processes [default: number of CPUs]')
+  parser.add_option('-v', '--verbose', action='store_true',
+                    help='log progress')
+  parser.add_option('--stats', metavar='FILE',
+                    help='write a JSON performance report to FILE at exit')
+  options, args = parser.parse_args(argv[1:])
+  logging.basicConfig(level=options.verbose and logging.INFO or logging.WARNING)
+  if not args:
+    parser.error('no directories to scan')
+  if options.stats:
+    metrics_lib.enable()
+  start = time.time()
+  try:
+    if options.remote:
+      db = db_lib.TieredRiffDatabase(
+        db_lib.RemoteRiffDatabase(db_lib.DEFAULT_REMOTE_URL), options.db)
+    else:
+      db = db_lib.LocalRiffDatabase(options.db)
+    result = scan_lib.LibraryScanner(db, processes=options.processes).scan(args)
+  except db_lib.OperationError, e:
+    logging.error('Scan failed: %s', e)
+    return 1
+  for video_path, riff_path, offset in result.matches:
+    print '%s\t%s\t%s' % (offset, video_path, riff_path)
+  for path, error in result.errors:
+    logging.warning('Unable to hash %s: %s', path, error)
+  logging.info('%d videos, %d riffs, %d hashed, %d from index, %d matches '
+               'in %.1fs', len(result.videos), len(result.riffs),
+               result.hashed, result.reused, len(result.matches),
+               time.time() - start)
+  if options.stats:
+    metrics_lib.REGISTRY.dump(options.stats)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
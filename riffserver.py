@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Serve a local riff database over the protocol of RemoteRiffDatabase.
+
+Usage: riffserver.py [options]
+
+Point a player at the server with a remote URL of http://<host>:<port>/db.
+Statistics are served as JSON from http://<host>:<port>/db/stats.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+import logging
+import optparse
+import sys
+
+import db_lib
+import server_lib
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage=__doc__.strip())
+  parser.add_option('--db', default=db_lib.DEFAULT_DB_FILE,
+                    help='database file to serve [default: %default]')
+  parser.add_option('--host', default='',
+                    help='address to listen on [default: all]')
+  parser.add_option('--port', type='int', default=8080,
+                    help='port to listen on [default: %default]')
+  parser.add_option('--cache-size', type='int',
+                    default=server_lib.HOT_CACHE_SIZE,
+                    help='offsets kept in memory [default: %default]')
+  parser.add_option('--commit-interval', type='float',
+                    default=server_lib.COMMIT_INTERVAL,
+                    help='seconds stored offsets may wait to be committed '
+                    '[default: %default]')
+  parser.add_option('-v', '--verbose', action='store_true',
+                    help='log every request')
+  options, args = parser.parse_args(argv[1:])
+  logging.basicConfig(level=options.verbose and logging.DEBUG or logging.INFO)
+  if args:
+    parser.error('unexpected arguments')
+  try:
+    db = db_lib.LocalRiffDatabase(options.db,
+                                  offset_cache_size=options.cache_size)
+    server = server_lib.OffsetServer((options.host, options.port), db,
+                                     options.commit_interval)
+  except (db_lib.OperationError, IOError), e:
+    logging.error('Unable to start: %s', e)
+    return 1
+  logging.info('Serving %s on port %d', options.db, server.server_address[1])
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
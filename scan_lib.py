@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import collections
+import logging
+import multiprocessing
+import os
+
+import db_lib
+
+RIFF_EXTENSIONS = frozenset(['.mp3', '.aac'])
+VIDEO_EXTENSIONS = frozenset([
+  '.avi', '.divx', '.flv', '.m2ts', '.m4v', '.mkv', '.mov', '.mp4', '.mpeg',
+  '.mpg', '.ogm', '.ogv', '.ts', '.vob', '.webm', '.wmv'])
+
+# Index entries written per transaction while hashing
+_STORE_BATCH = 64
+
+
+class ScanResult(object):
+  """The outcome of a library scan.
+
+  Attributes:
+    videos: dict of video path -> {algorithm: hash}
+    riffs: dict of riff path -> {algorithm: hash}
+    hashed: number of hashes calculated by this scan
+    reused: number of hashes taken from the index
+    errors: list of (path, error message) for files which could not be read
+    matches: list of (video path, riff path, offset), one per pair of
+      library files with a stored offset
+  """
+
+  def __init__(self):
+    self.videos = {}
+    self.riffs = {}
+    self.hashed = 0
+    self.reused = 0
+    self.errors = []
+    self.matches = []
+
+
+def walk_media(roots):
+  """Yield (kind, path) for every video and riff file below roots."""
+  for root in roots:
+    for dirpath, dirnames, filenames in os.walk(root):
+      dirnames.sort()
+      for filename in sorted(filenames):
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in VIDEO_EXTENSIONS:
+          yield 'video', os.path.join(dirpath, filename)
+        elif ext in RIFF_EXTENSIONS:
+          yield 'riff', os.path.join(dirpath, filename)
+
+
+def _hash_job(job):
+  """Hash one file in a worker process."""
+  identity, algorithm = job
+  try:
+    hash_val = db_lib.HASH_FUNCTIONS[algorithm](identity[0])
+    return identity, algorithm, hash_val, None
+  except db_lib.OperationError, e:
+    return identity, algorithm, None, str(e)
+
+
+class LibraryScanner(object):
+  """Hashes a media library in parallel and finds its stored offsets.
+
+  Hashes are kept in a FileHashCache, so a rescan only reads files whose
+  size, modification time or inode changed. When scanning for a
+  LocalRiffDatabase its own hash cache is used, and the player benefits
+  from the scan as well.
+
+  Offsets are matched with RiffDatabase.find_offsets. Databases which
+  can not scan their stored offsets, such as a remote database, are
+  only asked about videos and riffs in the same directory, which keeps
+  the number of lookups proportional to the size of the library.
+  """
+
+  def __init__(self, db, hash_cache=None, algorithms=None, processes=None):
+    """Create a scanner.
+
+    Args:
+      db: RiffDatabase to look up offsets in
+      hash_cache: FileHashCache to index files in, defaults to the cache
+        of db or else one in db_lib.DEFAULT_DB_FILE
+      algorithms: hash algorithms to index, defaults to those of db
+      processes: number of hashing processes, defaults to the CPU count
+    """
+    self.db = db
+    self.hash_cache = (hash_cache or db.hash_cache or
+                       db_lib.GetHashCache(db_lib.DEFAULT_DB_FILE))
+    self.algorithms = algorithms or db.hash_algorithms
+    self.processes = processes or multiprocessing.cpu_count()
+
+  def scan(self, roots):
+    """Index every media file below roots and match them against db.
+
+    Returns:
+      ScanResult
+    """
+    result = ScanResult()
+    jobs = []
+    for kind, path in walk_media(roots):
+      try:
+        identity = db_lib.file_identity(path)
+      except db_lib.OperationError, e:
+        result.errors.append((path, str(e)))
+        continue
+      hashes = (result.videos if kind == 'video' else result.riffs)
+      hashes = hashes.setdefault(identity[0], {})
+      for algorithm in self.algorithms:
+        hash_val = self.hash_cache.lookup(identity, algorithm)
+        if hash_val is None:
+          jobs.append((identity, algorithm))
+        else:
+          hashes[algorithm] = hash_val
+          result.reused += 1
+    logging.info('Found %d videos and %d riffs, %d hashes to calculate',
+                 len(result.videos), len(result.riffs), len(jobs))
+    if jobs:
+      self._hash(jobs, result)
+    self._match(result)
+    return result
+
+  def _hash(self, jobs, result):
+    """Calculate the hashes for jobs across a process pool."""
+    pool = multiprocessing.Pool(min(self.processes, len(jobs)))
+    pending = []
+    try:
+      for identity, algorithm, hash_val, error in pool.imap_unordered(
+          _hash_job, jobs, chunksize=4):
+        if error is not None:
+          result.errors.append((identity[0], error))
+          continue
+        path = identity[0]
+        files = result.videos if path in result.videos else result.riffs
+        files[path][algorithm] = hash_val
+        result.hashed += 1
+        pending.append((identity, algorithm, hash_val))
+        if len(pending) >= _STORE_BATCH:
+          self.hash_cache.store(pending)
+          pending = []
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+      if pending:
+        self.hash_cache.store(pending)
+
+  def _match(self, result):
+    """Find the stored offsets for pairs of library files."""
+    found = collections.OrderedDict()
+    for algorithm in self.algorithms:
+      video_paths = _paths_by_hash(result.videos, algorithm)
+      riff_paths = _paths_by_hash(result.riffs, algorithm)
+      if not video_paths or not riff_paths:
+        continue
+      for video_hash, audio_hash, offset in self.db.find_offsets(
+          video_paths, riff_paths, _neighbour_pairs(result, algorithm)):
+        for video_path in video_paths[video_hash]:
+          for riff_path in riff_paths[audio_hash]:
+            found.setdefault((video_path, riff_path), offset)
+    result.matches = [pair + (offset,) for pair, offset in found.iteritems()]
+
+
+def _neighbour_pairs(result, algorithm):
+  """Yield the (video_hash, riff_hash) of files sharing a directory."""
+  riffs = collections.defaultdict(set)
+  for path, hashes in result.riffs.iteritems():
+    if algorithm in hashes:
+      riffs[os.path.dirname(path)].add(hashes[algorithm])
+  seen = set()
+  for path, hashes in result.videos.iteritems():
+    if algorithm not in hashes:
+      continue
+    for riff_hash in riffs.get(os.path.dirname(path), ()):
+      pair = (hashes[algorithm], riff_hash)
+      if pair not in seen:
+        seen.add(pair)
+        yield pair
+
+
+def _paths_by_hash(files, algorithm):
+  """Invert {path: {algorithm: hash}} into {hash: [path, ...]}."""
+  paths = collections.defaultdict(list)
+  for path, hashes in files.iteritems():
+    if algorithm in hashes:
+      paths[hashes[algorithm]].append(path)
+  return paths
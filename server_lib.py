@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import BaseHTTPServer
+import json
+import logging
+import SocketServer
+import threading
+import time
+import urlparse
+
+import db_lib
+import metrics_lib
+
+HOT_CACHE_SIZE = 262144 # offsets kept in memory by the server
+COMMIT_INTERVAL = 0.05 # seconds a stored offset may wait for its commit
+COMMIT_BATCH = 1000 # pending offsets which trigger an early commit
+COMMIT_RETRY_DELAY = 1.0 # seconds to wait after a failed commit
+
+
+class OffsetWriter(object):
+  """Stores offsets in batches from a background thread.
+
+  Offsets wait in memory for up to commit_interval seconds, or until
+  commit_batch of them are pending, and are then written in a single
+  transaction. Pending offsets are visible through get, so readers never
+  see a stored offset disappear while its commit is outstanding.
+
+  Clients are told an offset is stored before it is committed, so a
+  batch which fails to be written is put back and retried after
+  COMMIT_RETRY_DELAY seconds. Only offsets still failing at close are
+  lost.
+
+  Attributes:
+    commits: number of transactions written
+    committed: number of offsets written
+    errors: number of failed attempts to write a batch
+  """
+
+  def __init__(self, db, commit_interval=COMMIT_INTERVAL,
+               commit_batch=COMMIT_BATCH):
+    self.db = db
+    self.commit_interval = commit_interval
+    self.commit_batch = commit_batch
+    self.commits = 0
+    self.committed = 0
+    self.errors = 0
+    self._pending = {}
+    self._flushing = {}
+    self._lock = threading.Lock()
+    self._wake = threading.Condition(self._lock)
+    self._closed = False
+    self._thread = threading.Thread(target=self._run, name='offset-writer')
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def pending(self):
+    """Return the number of offsets waiting to be written."""
+    with self._lock:
+      return len(self._pending) + len(self._flushing)
+
+  def add(self, triples):
+    """Queue (video_hash, audio_hash, offset) triples for writing."""
+    with self._lock:
+      idle = not self._pending
+      for video_hash, audio_hash, offset in triples:
+        self._pending[(video_hash, audio_hash)] = offset
+      if idle or len(self._pending) >= self.commit_batch:
+        self._wake.notify()
+
+  def get(self, pair):
+    """Return the offset waiting to be written for pair, or None."""
+    with self._lock:
+      offset = self._pending.get(pair)
+      if offset is None:
+        offset = self._flushing.get(pair)
+      return offset
+
+  def close(self):
+    """Write the remaining offsets and stop the writer thread."""
+    with self._lock:
+      self._closed = True
+      self._wake.notify()
+    self._thread.join()
+
+  def _run(self):
+    while True:
+      with self._lock:
+        while not self._pending and not self._closed:
+          self._wake.wait()
+        if len(self._pending) < self.commit_batch and not self._closed:
+          # Let more offsets arrive before paying for a transaction
+          self._wake.wait(self.commit_interval)
+        if not self._pending and self._closed:
+          return
+        self._flushing, self._pending = self._pending, {}
+        closed = self._closed
+      if not self._flush(closed) and not closed:
+        time.sleep(COMMIT_RETRY_DELAY)
+
+  def _flush(self, closed):
+    """Write the offsets being flushed, returning whether that worked."""
+    triples = [pair + (offset,) for pair, offset in
+               self._flushing.iteritems()]
+    try:
+      self.db.add_hashed_offsets(triples)
+    except db_lib.Error, e:
+      self.errors += 1
+      with self._lock:
+        if closed:
+          logging.error('Dropped %d offsets: %s', len(triples), e)
+        else:
+          logging.error('Unable to write %d offsets, retrying: %s',
+                        len(triples), e)
+          # Offsets stored since the batch was taken are newer
+          for pair, offset in self._flushing.iteritems():
+            self._pending.setdefault(pair, offset)
+        self._flushing = {}
+      return False
+    self.commits += 1
+    self.committed += len(triples)
+    with self._lock:
+      self._flushing = {}
+    return True
+
+
+class _OffsetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers the RemoteRiffDatabase protocol.
+
+  GET <path>?video_hash=&audio_hash= returns the offset, or nothing, and
+  a GET without parameters an empty body;
+  POST <path> with video_hash, audio_hash and offset form fields stores
+  one. POST <path>/batch handles op=get and op=add batches, and
+  GET <path>/stats returns the server statistics as JSON. Lookups which
+  fail in the database are answered with status 500 and the error.
+  """
+
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    start = time.time()
+    url = urlparse.urlsplit(self.path)
+    if url.path.endswith('/stats'):
+      self._reply(json.dumps(self.server.stats(), indent=2, sort_keys=True),
+                  content_type='application/json')
+      return
+    params = urlparse.parse_qs(url.query)
+    if not params:
+      # A bare GET is how clients check that the server is reachable
+      return self._reply('')
+    try:
+      pair = (params['video_hash'][0], params['audio_hash'][0])
+    except KeyError:
+      return self._fail('expected video_hash and audio_hash')
+    offsets = self._get_offsets([pair])
+    if offsets is None:
+      return
+    offset = offsets[0]
+    self._reply('' if offset is None else repr(offset))
+    self.server.metrics.observe('server.get', time.time() - start)
+
+  def do_POST(self):
+    start = time.time()
+    try:
+      length = int(self.headers.getheader('Content-Length') or 0)
+    except ValueError:
+      length = -1
+    if length < 0:
+      return self._fail('invalid Content-Length')
+    params = urlparse.parse_qsl(self.rfile.read(length))
+    if urlparse.urlsplit(self.path).path.endswith('/batch'):
+      return self._batch(params, start)
+    params = dict(params)
+    try:
+      triple = (params['video_hash'], params['audio_hash'],
+                float(params['offset']))
+    except (KeyError, ValueError):
+      return self._fail('expected video_hash, audio_hash and offset')
+    self.server.writer.add([triple])
+    self._reply('')
+    self.server.metrics.observe('server.add', time.time() - start)
+
+  def _batch(self, params, start):
+    if not params or params[0][0] != 'op' or params[0][1] not in ('get', 'add'):
+      return self._fail('expected op=get or op=add')
+    op = params[0][1]
+    values = [value for _, value in params[1:]]
+    if op == 'get':
+      if len(values) % 2:
+        return self._fail('expected video_hash, audio_hash pairs')
+      offsets = self._get_offsets(zip(values[::2], values[1::2]))
+      if offsets is None:
+        return
+      self._reply('\n'.join('' if offset is None else repr(offset)
+                            for offset in offsets))
+    else:
+      try:
+        triples = [(values[i], values[i + 1], float(values[i + 2]))
+                   for i in xrange(0, len(values), 3)]
+      except (IndexError, ValueError):
+        return self._fail('expected video_hash, audio_hash, offset triples')
+      self.server.writer.add(triples)
+      self._reply('')
+    self.server.metrics.observe('server.batch_' + op, time.time() - start)
+
+  def _get_offsets(self, pairs):
+    """Look pairs up, replying with an error and returning None on failure."""
+    try:
+      return self.server.get_offsets(pairs)
+    except db_lib.Error, e:
+      logging.error('Lookup of %d offsets failed: %s', len(pairs), e)
+      self.server.metrics.increment('server.errors')
+      self._reply(str(e), 500)
+      return None
+
+  def _fail(self, message):
+    self.server.metrics.increment('server.bad_requests')
+    self._reply(message, 400)
+
+  def _reply(self, body, status=200, content_type='text/plain'):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, fmt, *args):
+    logging.debug('%s %s', self.address_string(), fmt % args)
+
+
+class OffsetServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A threaded HTTP server for a LocalRiffDatabase.
+
+  Connections are kept alive and served by a thread each. Offsets are
+  looked up in the in-memory offset cache of db before Sqlite, and
+  stored offsets are committed in batches by an OffsetWriter, so a
+  stored offset may be lost if the process dies within commit_interval
+  seconds of storing it.
+
+  Attributes:
+    db: the LocalRiffDatabase served
+    writer: OffsetWriter storing offsets in db
+    metrics: metrics_lib.Registry of request timings
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, db, commit_interval=COMMIT_INTERVAL,
+               commit_batch=COMMIT_BATCH):
+    """Bind the server.
+
+    Args:
+      address: (host, port) to listen on; port 0 picks a free port
+      db: LocalRiffDatabase to serve
+      commit_interval, commit_batch: see OffsetWriter
+    """
+    BaseHTTPServer.HTTPServer.__init__(self, address, _OffsetHandler)
+    self.db = db
+    self.writer = OffsetWriter(db, commit_interval, commit_batch)
+    self.metrics = metrics_lib.Registry(enabled=True)
+
+  def get_offsets(self, pairs):
+    """Return the offset, or None, of each (video_hash, audio_hash) pair."""
+    offsets = [self.writer.get(pair) for pair in pairs]
+    missing = [i for i, offset in enumerate(offsets) if offset is None]
+    if missing:
+      found = self.db.get_hashed_offsets([pairs[i] for i in missing])
+      for i, offset in zip(missing, found):
+        offsets[i] = offset
+    return offsets
+
+  def stats(self):
+    """Return the server statistics as a dict suitable for JSON."""
+    cache = self.db.offset_cache or db_lib.LRUCache(0)
+    report = self.metrics.report()
+    report.update({
+      'cache': {'size': len(cache), 'capacity': cache.capacity,
+                'hits': cache.hits, 'misses': cache.misses,
+                'evictions': cache.evictions},
+      'writer': {'pending': self.writer.pending(),
+                 'commits': self.writer.commits,
+                 'committed': self.writer.committed,
+                 'errors': self.writer.errors},
+    })
+    return report
+
+  def server_close(self):
+    """Stop listening and write the offsets still pending."""
+    BaseHTTPServer.HTTPServer.server_close(self)
+    self.writer.close()
@@ -7,6 +7,9 @@ import sys
 
 from setuptools import setup
 
+# Imported lazily by riffplayer.py, so the module finders do not see them
+LAZY_MODULES = ['db_lib']
+
 if sys.platform == 'darwin':
   import py2app
   extra_options = dict(
@@ -17,6 +20,7 @@ if sys.platform == 'darwin':
         py2app=dict(
           iconfile='res/riffplayer.icns',
           packages='wx',
+          includes=LAZY_MODULES,
           site_packages=True,
           plist=dict(
             CFBundleName='OpenRiff Player',
@@ -39,7 +43,8 @@ elif sys.platform == 'win32':
         py2exe=dict(
           compressed=1,
           optimize=2,
-          bundle_files=1
+          bundle_files=1,
+          includes=LAZY_MODULES,
         )
       ),
       windows=[
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import random
+
+import sync_lib
+
+
+class SimulatedTime(object):
+  """A manually advanced clock shared by simulated media.
+
+  Attributes:
+    now: current time in milliseconds
+  """
+
+  def __init__(self):
+    self.now = 0.0
+
+  def advance(self, milliseconds):
+    self.now += milliseconds
+
+
+class SimulatedMedia(sync_lib.MediaClock):
+  """Deterministic stand-in for a playing media control.
+
+  Positions advance with a SimulatedTime. The media clock runs fast or
+  slow by rate_error, Tell() adds seeded Gaussian jitter and rounds down
+  to tell_resolution, and a seek stalls playback for seek_latency.
+
+  Attributes:
+    tells, seeks, rate_changes: counters of calls made by the controller
+  """
+
+  def __init__(self, time, length, rate_error=0.0, jitter=0.0,
+               seek_latency=0.0, tell_resolution=1, rate_supported=True,
+               seed=0):
+    """Create simulated media, paused at position 0.
+
+    Args:
+      time: SimulatedTime driving playback
+      length: media length in milliseconds
+      rate_error: relative error of the media clock, e.g. 0.001 for a
+        clock running 0.1% fast
+      jitter: standard deviation of Tell() errors in milliseconds
+      seek_latency: milliseconds playback stalls after a seek
+      tell_resolution: granularity of Tell() in milliseconds
+      rate_supported: whether SetPlaybackRate works
+      seed: random seed for the jitter
+    """
+    self.time = time
+    self.length = length
+    self.rate_error = rate_error
+    self.jitter = jitter
+    self.seek_latency = seek_latency
+    self.tell_resolution = tell_resolution
+    self.rate_supported = rate_supported
+    self.playing = False
+    self.rate = 1.0
+    self.tells = 0
+    self.seeks = 0
+    self.rate_changes = 0
+    self._random = random.Random(seed)
+    self._anchor_position = 0.0
+    self._anchor_time = time.now
+
+  @property
+  def position(self):
+    """The true position in milliseconds, without jitter."""
+    position = self._anchor_position
+    if self.playing and self.time.now > self._anchor_time:
+      speed = self.rate * (1.0 + self.rate_error)
+      position += (self.time.now - self._anchor_time) * speed
+    return min(position, self.length)
+
+  def _rebase(self):
+    position = self.position
+    self._anchor_time = max(self._anchor_time, self.time.now)
+    self._anchor_position = position
+
+  def Play(self):
+    self._rebase()
+    self.playing = True
+
+  def Pause(self):
+    self._rebase()
+    self.playing = False
+
+  def Tell(self):
+    self.tells += 1
+    position = self.position
+    if self.jitter:
+      position += self._random.gauss(0, self.jitter)
+    position = max(0, int(position))
+    return position - position % self.tell_resolution
+
+  def Length(self):
+    return self.length
+
+  def Seek(self, position):
+    self.seeks += 1
+    self._anchor_position = float(min(max(position, 0), self.length))
+    self._anchor_time = self.time.now + self.seek_latency
+
+  def SetPlaybackRate(self, rate):
+    if not self.rate_supported:
+      return False
+    self._rebase()
+    self.rate = rate
+    self.rate_changes += 1
+    return True
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import array
+import bisect
+import collections
+import logging
+import math
+import sys
+
+import metrics_lib
+
+# Playback rate of a riff recorded against a 24fps film, when played
+# along with a PAL (25fps) transfer of it.
+PAL_SPEEDUP = 25.0 / 24.0
+
+# SyncController defaults, all in milliseconds unless noted
+SYNC_INTERVAL = 200 # between controller ticks
+DRIFT_TOLERANCE = 20 # drift left alone
+SEEK_THRESHOLD = 750 # drift corrected by seeking rather than by rate
+# Drift seeked away when the riff rate cannot be adjusted
+FALLBACK_SEEK_THRESHOLD = 100
+CORRECTION_TIME = 4000 # time over which rate nudging removes drift
+MAX_RATE_ADJUST = 0.03 # largest relative change of the riff rate
+RATE_STEP = 0.001 # rate adjustments are rounded to this, limiting calls
+RATE_HYSTERESIS = 1.5 # rate steps a new rate must differ by
+NOISE_MARGIN = 3.0 # drift within this many noise deviations is left alone
+RATE_HOLD = 2000 # least video time between drift correcting rate changes
+TRIM_GAIN = 0.02 # how fast a steady clock difference is learned
+DRIFT_SMOOTHING = 0.15 # weight of a new drift sample in the filter
+DRIFT_HISTORY = 3000 # drift samples kept for reporting
+LATENCY_WEIGHT = 0.3 # weight of a new sample in the seek latency model
+MAX_SEEK_LEAD = 2000 # cap on the seek latency compensation
+# Ticks to wait for a seeked riff to resume before judging the seek
+SEEK_SETTLE_TICKS = 5
+# Upper bounds of the buckets of the sync.drift histogram, in milliseconds
+DRIFT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 5000)
+
+
+class Error(Exception):
+  """Base level error."""
+
+class SyncMapError(Error):
+  """Invalid sync map."""
+
+
+class SyncMap(object):
+  """A piecewise-linear mapping from video positions to riff positions.
+
+  Each breakpoint (video_ms, riff_ms, rate) says that from video_ms on,
+  until the next breakpoint, the riff position is
+  riff_ms + (video - video_ms) * rate. Positions before the first
+  breakpoint follow the first segment. A single breakpoint at 0 with
+  rate 1.0 is the classic constant offset.
+
+  Breakpoints are kept in flat arrays of doubles and looked up with
+  bisect, so evaluating a map is O(log n).
+  """
+
+  def __init__(self, breakpoints):
+    """Create a sync map.
+
+    Args:
+      breakpoints: sequence of (video_ms, riff_ms, rate)
+
+    Raises:
+      SyncMapError: if breakpoints is empty or has repeated positions
+    """
+    breakpoints = sorted(breakpoints)
+    if not breakpoints:
+      raise SyncMapError('A sync map needs at least one breakpoint')
+    self._video = array.array('d', [point[0] for point in breakpoints])
+    self._riff = array.array('d', [point[1] for point in breakpoints])
+    self._rate = array.array('d', [point[2] for point in breakpoints])
+    for i in xrange(1, len(self._video)):
+      if self._video[i] == self._video[i - 1]:
+        raise SyncMapError('Repeated breakpoint at %s' % self._video[i])
+
+  @classmethod
+  def constant(cls, offset):
+    """Return the map of a constant offset, in milliseconds."""
+    return cls([(0.0, float(offset), 1.0)])
+
+  @classmethod
+  def linear(cls, video_ms, riff_ms, rate=1.0):
+    """Return the map of a single segment through video_ms and riff_ms.
+
+    A rate of 1.0 gives the constant map of that offset.
+    """
+    if rate == 1.0:
+      return cls.constant(riff_ms - video_ms)
+    return cls([(float(video_ms), float(riff_ms), rate)])
+
+  @classmethod
+  def from_bytes(cls, data):
+    """Return the map serialized by to_bytes."""
+    values = array.array('d')
+    try:
+      values.fromstring(str(data))
+    except ValueError, e:
+      raise SyncMapError(e)
+    if sys.byteorder == 'big':
+      values.byteswap()
+    if len(values) % 3:
+      raise SyncMapError('Truncated sync map')
+    return cls(zip(values[0::3], values[1::3], values[2::3]))
+
+  def to_bytes(self):
+    """Serialize the map as little-endian doubles."""
+    values = array.array('d')
+    for point in self.breakpoints():
+      values.extend(point)
+    if sys.byteorder == 'big':
+      values.byteswap()
+    return values.tostring()
+
+  def breakpoints(self):
+    """Return the list of (video_ms, riff_ms, rate) breakpoints."""
+    return zip(self._video, self._riff, self._rate)
+
+  def is_constant(self):
+    """Return whether the map is a plain constant offset."""
+    return len(self._video) == 1 and self._rate[0] == 1.0
+
+  def riff_position(self, video_ms):
+    """Return the riff position matching video position video_ms."""
+    i = max(0, bisect.bisect_right(self._video, video_ms) - 1)
+    return self._riff[i] + (video_ms - self._video[i]) * self._rate[i]
+
+  def rate_at(self, video_ms):
+    """Return the riff playback rate at video position video_ms."""
+    return self._rate[max(0, bisect.bisect_right(self._video, video_ms) - 1)]
+
+  def offset_at(self, video_ms):
+    """Return the riff minus video position at video position video_ms."""
+    return self.riff_position(video_ms) - video_ms
+
+  def __eq__(self, other):
+    return (isinstance(other, SyncMap) and
+            self.breakpoints() == other.breakpoints())
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'SyncMap(%r)' % self.breakpoints()
+
+
+class MediaClock(object):
+  """The interface of the media controls synced by SyncController.
+
+  wx.media.MediaCtrl provides it as is; sim_lib.SimulatedMedia
+  implements it without a display or real media. Positions and lengths
+  are in milliseconds.
+  """
+
+  def Tell(self):
+    """Return the current position, or a negative value if unknown."""
+    raise NotImplementedError
+
+  def Length(self):
+    """Return the length of the media."""
+    raise NotImplementedError
+
+  def Seek(self, position):
+    """Move to position."""
+    raise NotImplementedError
+
+  def SetPlaybackRate(self, rate):
+    """Set the playback rate, returning False if it is not supported."""
+    raise NotImplementedError
+
+
+class SeekLatencyModel(object):
+  """An exponentially weighted estimate of the seek latency of a file.
+
+  The latency is the time playback effectively stands still after a
+  seek, learned from where a seeked riff turns out to be once it plays.
+
+  Attributes:
+    latency: predicted latency in milliseconds
+    samples: number of observed seeks
+    last_error, max_error: errors of the predictions, in milliseconds
+  """
+
+  def __init__(self, weight=LATENCY_WEIGHT):
+    self.weight = weight
+    self.latency = 0.0
+    self.samples = 0
+    self.last_error = None
+    self.max_error = 0.0
+    self._error_total = 0.0
+
+  def predict(self):
+    """Return the expected latency of the next seek."""
+    return self.latency
+
+  def observe(self, latency):
+    """Learn from a seek which took latency milliseconds."""
+    error = latency - self.latency
+    self.last_error = error
+    self.max_error = max(self.max_error, abs(error))
+    self._error_total += abs(error)
+    if self.samples:
+      self.latency += self.weight * error
+    else:
+      self.latency = latency
+    self.latency = max(0.0, min(MAX_SEEK_LEAD, self.latency))
+    self.samples += 1
+    metrics_lib.observe('sync.seek_latency', latency, DRIFT_BUCKETS)
+    metrics_lib.observe('sync.seek_latency_error', abs(error), DRIFT_BUCKETS)
+
+  def stats(self):
+    """Return the model and its error statistics as a dict."""
+    return {'latency': self.latency, 'samples': self.samples,
+            'last_error': self.last_error, 'max_error': self.max_error,
+            'mean_error': self.samples and self._error_total / self.samples}
+
+
+class SyncController(object):
+  """Keeps a riff in sync with a video.
+
+  tick() is meant to be called at a fixed interval while playing. Each
+  tick samples both positions, smooths the drift between the riff and
+  where the sync map says it should be, and corrects it by nudging the
+  riff playback rate. Only drift beyond seek_threshold, e.g. after the
+  video was seeked, is corrected with a riff seek. If the riff does not
+  support rate changes drift beyond FALLBACK_SEEK_THRESHOLD is seeked
+  away instead.
+
+  To avoid hunting after jittery positions, drift is only corrected once
+  it stands out from the measured noise, and a new correcting rate is
+  kept for at least rate_hold milliseconds of video.
+
+  Seeks made while playing aim ahead by the latency predicted by
+  latency_model, which learns from the outcome of every such seek.
+
+  video and riff are MediaClock implementations.
+
+  Attributes:
+    drift: filtered drift in milliseconds, positive when the riff is ahead
+    noise: running variance of the raw drift around the filtered drift
+    drift_history: deque of recent (video_ms, raw drift) samples
+    ticks, seeks, rate_changes: counters
+    latency_model: SeekLatencyModel of the riff
+    seek_hook: if set, called with the target of every riff seek just
+      before it is made, e.g. to prefetch the data there
+  """
+
+  def __init__(self, video, riff, sync_map=None, tolerance=DRIFT_TOLERANCE,
+               seek_threshold=SEEK_THRESHOLD, correction_time=CORRECTION_TIME,
+               max_rate_adjust=MAX_RATE_ADJUST, smoothing=DRIFT_SMOOTHING,
+               history=DRIFT_HISTORY, compensate_seeks=True,
+               rate_hold=RATE_HOLD):
+    self.video = video
+    self.riff = riff
+    self.sync_map = sync_map or SyncMap.constant(0)
+    self.tolerance = tolerance
+    self.seek_threshold = seek_threshold
+    self.correction_time = correction_time
+    self.max_rate_adjust = max_rate_adjust
+    self.smoothing = smoothing
+    self.rate_hold = rate_hold
+    self.rate_supported = True
+    self.rate = 1.0
+    self.drift = None
+    self._correcting = False
+    # Video position of the last drift correcting rate change
+    self._rate_changed_at = None
+    self.noise = 0.0
+    # Learned relative clock difference between the riff and the video
+    self.trim = 0.0
+    self.drift_history = collections.deque(maxlen=history)
+    self.ticks = 0
+    self.seeks = 0
+    self.rate_changes = 0
+    self.latency_model = SeekLatencyModel()
+    self.compensate_seeks = compensate_seeks
+    # (position, lead, ticks waited) of a seek whose outcome is pending
+    self._seek_probe = None
+    self.seek_hook = None
+
+  def reset(self):
+    """Forget the filtered drift, e.g. after playback was interrupted."""
+    self.drift = None
+    self._correcting = False
+
+  def release(self):
+    """Stop controlling the riff and restore its normal rate."""
+    self.reset()
+    self._set_rate(1.0)
+
+  def _target(self, video_ms):
+    """Return the riff position for video_ms, clamped to the riff."""
+    return min(self.riff.Length(),
+               max(self.sync_map.riff_position(video_ms), 0))
+
+  def _set_rate(self, rate):
+    if rate == self.rate or not self.rate_supported:
+      return
+    if self.riff.SetPlaybackRate(rate) is False:
+      logging.debug('Riff playback rate not adjustable, seeking instead')
+      self.rate_supported = False
+      self.rate = 1.0
+      return
+    self.rate = rate
+    self.rate_changes += 1
+    metrics_lib.increment('sync.rate_changes')
+
+  def _seek(self, position):
+    logging.debug('Sync: Seeking riff to: %s', position)
+    if self.seek_hook is not None:
+      self.seek_hook(position)
+    self.riff.Seek(position)
+    self.seeks += 1
+    metrics_lib.increment('sync.seeks')
+    self.reset()
+    self._seek_probe = None
+
+  def _seek_ahead(self, target, rate):
+    """Seek to target while playing, leading by the predicted latency."""
+    lead = 0.0
+    if self.compensate_seeks:
+      lead = self.latency_model.predict() * rate
+    position = min(self.riff.Length(), target + lead)
+    self._seek(position)
+    self._seek_probe = (position, lead, 0)
+
+  def _check_seek(self, riff_ms, drift, rate):
+    """Learn from the last seek once the riff plays again.
+
+    Returns:
+      bool - whether the riff is still settling after the seek
+    """
+    position, lead, waited = self._seek_probe
+    if riff_ms <= position + self.tolerance and waited < SEEK_SETTLE_TICKS:
+      self._seek_probe = (position, lead, waited + 1)
+      return True
+    self._seek_probe = None
+    if waited < SEEK_SETTLE_TICKS:
+      self.latency_model.observe((lead - drift) / rate)
+    return False
+
+  def sync(self, playing=False):
+    """Seek the riff into sync at once, if it is noticeably out of sync.
+
+    Args:
+      playing: whether the media are playing, so the seek should lead
+    """
+    video_ms = self.video.Tell()
+    target = self._target(video_ms)
+    map_rate = self.sync_map.rate_at(video_ms)
+    if abs(self.riff.Tell() - target) > self.tolerance:
+      if playing:
+        self._seek_ahead(target, map_rate)
+      else:
+        self._seek(target)
+    self._set_rate(map_rate)
+
+  def tick(self):
+    """Sample the positions and correct the drift."""
+    self.ticks += 1
+    video_ms = self.video.Tell()
+    riff_ms = self.riff.Tell()
+    if video_ms < 0 or riff_ms < 0:
+      return
+    target = self._target(video_ms)
+    drift = riff_ms - target
+    self.drift_history.append((video_ms, drift))
+    metrics_lib.observe('sync.drift', abs(drift), DRIFT_BUCKETS)
+    map_rate = self.sync_map.rate_at(video_ms)
+    if self._seek_probe and self._check_seek(riff_ms, drift, map_rate):
+      return
+    seek_threshold = self.seek_threshold
+    if not self.rate_supported:
+      seek_threshold = max(self.tolerance, FALLBACK_SEEK_THRESHOLD)
+    if abs(drift) > seek_threshold:
+      self._seek_ahead(target, map_rate)
+      self._set_rate(map_rate)
+      return
+    if self.drift is None:
+      self.drift = float(drift)
+    else:
+      error = drift - self.drift
+      self.noise += self.smoothing * (error * error - self.noise)
+      self.drift += self.smoothing * error
+    tolerance = max(self.tolerance, NOISE_MARGIN * math.sqrt(
+      self.noise * self.smoothing / (2.0 - self.smoothing)))
+    # Correct once the drift exceeds tolerance, until it is halved again
+    if abs(self.drift) > tolerance:
+      self._correcting = True
+    elif abs(self.drift) < tolerance / 2.0:
+      self._correcting = False
+    adjust = 0.0
+    if self._correcting:
+      adjust = -self.drift / self.correction_time
+      self.trim += TRIM_GAIN * adjust
+      self.trim = max(-self.max_rate_adjust,
+                      min(self.max_rate_adjust, self.trim))
+    adjust = max(-self.max_rate_adjust,
+                 min(self.max_rate_adjust, self.trim + adjust))
+    rate = map_rate * (1.0 + round(adjust / RATE_STEP) * RATE_STEP)
+    # Ignore single steps of the rate caused by noise in the drift, and
+    # hold each correction for a while rather than hunting after it
+    if abs(rate - self.rate) < RATE_HYSTERESIS * RATE_STEP:
+      return
+    if (self._rate_changed_at is not None and
+        0 <= video_ms - self._rate_changed_at < self.rate_hold):
+      return
+    self._rate_changed_at = video_ms
+    self._set_rate(rate)
+
+
+class SyncEngine(object):
+  """The sync state of a video and riff pair, independent of any GUI.
+
+  Attributes:
+    synced: whether the riff is locked to the video
+    sync_map: SyncMap applied while synced
+    rate: riff rate of the maps of offsets locked by set_offset and lock,
+      PAL_SPEEDUP for a riff of a film played along with a PAL transfer
+    controller: the SyncController correcting drift
+    latency_models: dict of riff key -> SeekLatencyModel
+  """
+
+  def __init__(self, video, riff, **controller_options):
+    """Create a sync engine.
+
+    Args:
+      video, riff: MediaClock implementations
+      controller_options: keyword arguments for SyncController
+    """
+    self.video = video
+    self.riff = riff
+    self.synced = False
+    self.playing = False
+    self.sync_map = SyncMap.constant(0)
+    self.rate = 1.0
+    self.controller = SyncController(video, riff, self.sync_map,
+                                     **controller_options)
+    self.latency_models = {}
+
+  def select_riff(self, key):
+    """Use the seek latency model of the riff identified by key.
+
+    Whether the riff rate can be adjusted is found out again, as it
+    depends on the riff.
+    """
+    model = self.latency_models.get(key)
+    if model is None:
+      model = self.latency_models[key] = SeekLatencyModel()
+    self.controller.latency_model = model
+    self.controller.rate_supported = True
+
+  @property
+  def offset(self):
+    """The offset in milliseconds at the start of the video."""
+    return self.sync_map.offset_at(0)
+
+  def set_offset(self, offset):
+    """Lock the riff to the video at offset from the start of the video."""
+    self.set_sync_map(SyncMap.linear(0.0, offset, self.rate))
+
+  def set_sync_map(self, sync_map):
+    """Lock the riff to the video according to sync_map."""
+    self.sync_map = sync_map
+    self.controller.sync_map = sync_map
+    self.synced = True
+    self.apply()
+
+  def set_rate(self, rate):
+    """Change the rate of offsets locked from now on.
+
+    If synced, the riff stays locked through its current position, now
+    at rate.
+    """
+    self.rate = rate
+    if self.synced:
+      position = max(0, self.video.Tell())
+      self.set_sync_map(SyncMap.linear(
+        position, self.sync_map.riff_position(position), rate))
+
+  def calculate_offset(self):
+    """Return the current riff position minus the video position."""
+    return self.riff.Tell() - self.video.Tell()
+
+  def current_map(self):
+    """Return the map locking the riff to the video where both are now."""
+    return SyncMap.linear(self.video.Tell(), self.riff.Tell(), self.rate)
+
+  def lock(self):
+    """Lock the riff to the video at their current positions."""
+    self.set_sync_map(self.current_map())
+
+  def unlock(self):
+    """Let the riff play freely."""
+    self.synced = False
+    self.controller.release()
+
+  def start(self):
+    """Prepare for playback starting or resuming."""
+    self.playing = True
+    self.controller.reset()
+
+  def stop(self):
+    """Note that playback was paused or stopped."""
+    self.playing = False
+
+  def apply(self):
+    """Seek the riff into sync now, if synced and required."""
+    if self.synced:
+      self.controller.sync(self.playing)
+
+  def tick(self):
+    """Correct drift; call at a fixed interval while playing."""
+    if self.synced:
+      self.controller.tick()
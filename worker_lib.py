@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Copyright (c) 2008 Jon Allie <jon@jonallie.com>
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__author__ = 'Jon Allie (jon@jonallie.com)'
+
+
+import logging
+import Queue
+import sys
+import threading
+
+DEFAULT_WORKERS = 4
+
+
+class Error(Exception):
+  """Base level error."""
+
+class TimeoutError(Error):
+  """A result was not available in time."""
+
+
+class Future(object):
+  """The pending result of a call submitted to a WorkerPool."""
+
+  def __init__(self):
+    self._condition = threading.Condition()
+    self._done = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def done(self):
+    return self._done
+
+  def result(self, timeout=None):
+    """Wait for and return the result, re-raising any exception."""
+    self._wait(timeout)
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def exception(self, timeout=None):
+    """Wait for and return the exception raised by the call, if any."""
+    self._wait(timeout)
+    if self._exc_info:
+      return self._exc_info[1]
+    return None
+
+  def add_done_callback(self, func):
+    """Call func(future) once the result is set, in the setting thread.
+
+    If the future is already done, func is called immediately.
+    """
+    with self._condition:
+      if not self._done:
+        self._callbacks.append(func)
+        return
+    self._run_callback(func)
+
+  def set_result(self, result):
+    self._finish(result, None)
+
+  def set_exception(self, exc_info):
+    """Set the outcome to an exception, given as a sys.exc_info() tuple."""
+    self._finish(None, exc_info)
+
+  def _wait(self, timeout):
+    with self._condition:
+      if not self._done:
+        self._condition.wait(timeout)
+      if not self._done:
+        raise TimeoutError('Result not available after %s seconds' % timeout)
+
+  def _finish(self, result, exc_info):
+    with self._condition:
+      self._result = result
+      self._exc_info = exc_info
+      self._done = True
+      callbacks, self._callbacks = self._callbacks, []
+      self._condition.notify_all()
+    for func in callbacks:
+      self._run_callback(func)
+
+  def _run_callback(self, func):
+    try:
+      func(self)
+    except Exception, e:
+      logging.exception('Error in future callback: %s', e)
+
+
+def chain(futures, func, *args):
+  """Return a future for func(*results + args) once all futures are done.
+
+  func runs in the thread that completes the last of futures. If any of
+  futures failed, the returned future fails with the first such error.
+  """
+  result = Future()
+  pending = [len(futures)]
+  lock = threading.Lock()
+
+  def on_done(unused_future):
+    with lock:
+      pending[0] -= 1
+      if pending[0]:
+        return
+    try:
+      values = tuple(future.result() for future in futures)
+      result.set_result(func(*(values + args)))
+    except Exception:
+      result.set_exception(sys.exc_info())
+
+  for future in futures:
+    future.add_done_callback(on_done)
+  return result
+
+
+class WorkerPool(object):
+  """A fixed-size pool of daemon threads executing submitted calls."""
+
+  def __init__(self, num_workers=DEFAULT_WORKERS, name='worker'):
+    self._queue = Queue.Queue()
+    self._threads = []
+    for i in xrange(num_workers):
+      thread = threading.Thread(target=self._work, name='%s-%d' % (name, i))
+      thread.setDaemon(True)
+      thread.start()
+      self._threads.append(thread)
+
+  def submit(self, func, *args, **kwargs):
+    """Schedule func(*args, **kwargs) and return a Future for its result."""
+    future = Future()
+    self._queue.put((future, func, args, kwargs))
+    return future
+
+  def shutdown(self, wait=True):
+    """Stop the workers once the queued calls have been processed."""
+    for _ in self._threads:
+      self._queue.put(None)
+    if wait:
+      for thread in self._threads:
+        thread.join()
+
+  def _work(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      future, func, args, kwargs = item
+      try:
+        future.set_result(func(*args, **kwargs))
+      except Exception:
+        future.set_exception(sys.exc_info())
+
+
+class OffsetService(object):
+  """Runs riff database operations on a worker pool.
+
+  Both files of a pair are hashed in parallel, and every method returns
+  a Future so that callers such as the GUI thread never block on file
+  or database I/O.
+  """
+
+  def __init__(self, db, pool=None):
+    self.db = db
+    self.pool = pool or WorkerPool(name='offset')
+
+  def get_offset(self, video_file, audio_file):
+    """Return a Future for the stored offset of a video/audio file pair."""
+    return chain(self._hash_pair(video_file, audio_file),
+                 self.db.get_hashed_offset, video_file, audio_file)
+
+  def add_offset(self, video_file, audio_file, offset):
+    """Return a Future which completes once offset has been stored."""
+    return chain(self._hash_pair(video_file, audio_file),
+                 self.db.add_hashed_offset, offset)
+
+  def get_sync_map(self, video_file, audio_file):
+    """Return a Future for the sync map of a video/audio file pair."""
+    return chain(self._hash_pair(video_file, audio_file),
+                 self.db.get_hashed_sync_map, video_file, audio_file)
+
+  def add_sync_map(self, video_file, audio_file, sync_map):
+    """Return a Future which completes once sync_map has been stored."""
+    return chain(self._hash_pair(video_file, audio_file),
+                 self.db.add_hashed_sync_map, sync_map)
+
+  def _hash_pair(self, video_file, audio_file):
+    return [self.pool.submit(self.db.calculate_hash, video_file),
+            self.pool.submit(self.db.calculate_hash, audio_file)]